@@ -0,0 +1,181 @@
+import base64
+import binascii
+import io
+import os
+import pickle
+import zlib
+
+from django.utils.crypto import constant_time_compare, salted_hmac
+
+from cart import constants
+
+# cookie购物车数据格式:
+# 'c1.' + urlsafe_base64(flag + [nonce] + payload + hmac)
+# flag: 1字节，FLAG_ZLIB表示payload经过zlib压缩，FLAG_NONCE表示flag之后有nonce
+# nonce: 每次写入cookie时随机生成，内容相同的购物车每次写入的cookie也不同，
+#     登录合并时用cookie数据的摘要区分同一份数据的重试和之后重新写入的数据
+# payload: 按sku_id升序排列的若干条记录，每条记录为两个varint:
+#     sku_id与上一条记录sku_id的差值，count * 2 + selected
+# hmac: 对flag + payload的签名，防止客户端篡改
+COOKIE_CART_PREFIX = 'c1.'
+FLAG_ZLIB = 0x01
+FLAG_NONCE = 0x02
+HMAC_SALT = 'cart.codec.cookie_cart'
+
+
+def _write_varint(value, buf):
+    """将非负整数编码为varint追加到buf中"""
+    while value >= 0x80:
+        buf.append((value & 0x7f) | 0x80)
+        value >>= 7
+    buf.append(value)
+
+
+def _read_varint(data, pos):
+    """从data的pos位置读取一个varint，返回(值，下一个位置)"""
+    value = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+        if shift > 63:
+            raise ValueError('varint too long')
+
+
+def _sign(data):
+    return salted_hmac(HMAC_SALT, data).digest()[:constants.CART_COOKIE_HMAC_LENGTH]
+
+
+def encode_cookie_cart(cart_dict):
+    """
+    将购物车字典编码为cookie中保存的字符串:
+    cart_dict: {
+        '<sku_id>': {
+            'count': '<count>',
+            'selected': '<selected>'
+        },
+        ...
+    }
+    """
+    payload = bytearray()
+    last_sku_id = 0
+    for sku_id in sorted(cart_dict):
+        count_selected = cart_dict[sku_id]
+        _write_varint(sku_id - last_sku_id, payload)
+        _write_varint(count_selected['count'] * 2 + (1 if count_selected['selected'] else 0), payload)
+        last_sku_id = sku_id
+
+    flag = FLAG_NONCE
+    payload = bytes(payload)
+    if len(payload) > constants.CART_COOKIE_COMPRESS_THRESHOLD:
+        compressed = zlib.compress(payload, 9)
+        if len(compressed) < len(payload):
+            flag |= FLAG_ZLIB
+            payload = compressed
+
+    data = bytes([flag]) + os.urandom(constants.CART_COOKIE_NONCE_LENGTH) + payload
+    token = base64.urlsafe_b64encode(data + _sign(data)).rstrip(b'=')
+
+    return COOKIE_CART_PREFIX + token.decode()
+
+
+def decode_cookie_cart(cookie_cart):
+    """
+    解析cookie中保存的购物车数据，数据无效时返回空字典:
+    {
+        '<sku_id>': {
+            'count': '<count>',
+            'selected': '<selected>'
+        },
+        ...
+    }
+    """
+    if not cookie_cart:
+        return {}
+
+    if not cookie_cart.startswith(COOKIE_CART_PREFIX):
+        # 兼容旧的pickle+base64格式
+        return _decode_legacy_cookie_cart(cookie_cart)
+
+    token = cookie_cart[len(COOKIE_CART_PREFIX):]
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+    except (binascii.Error, ValueError):
+        return {}
+
+    hmac_length = constants.CART_COOKIE_HMAC_LENGTH
+    if len(raw) < hmac_length + 1:
+        return {}
+
+    data, signature = raw[:-hmac_length], raw[-hmac_length:]
+    if not constant_time_compare(_sign(data), signature):
+        return {}
+
+    flag, payload = data[0], data[1:]
+    if flag & FLAG_NONCE:
+        payload = payload[constants.CART_COOKIE_NONCE_LENGTH:]
+    try:
+        if flag & FLAG_ZLIB:
+            payload = zlib.decompress(payload)
+
+        cart_dict = {}
+        sku_id = 0
+        pos = 0
+        while pos < len(payload):
+            delta, pos = _read_varint(payload, pos)
+            value, pos = _read_varint(payload, pos)
+            sku_id += delta
+            if sku_id < 1 or value >> 1 < 1:
+                continue
+            cart_dict[sku_id] = {
+                'count': value >> 1,
+                'selected': bool(value & 1)
+            }
+    except (zlib.error, ValueError, IndexError):
+        return {}
+
+    return cart_dict
+
+
+class _SafeUnpickler(pickle.Unpickler):
+    """只允许还原基本数据类型，禁止加载任何类和函数"""
+    def find_class(self, module, name):
+        raise pickle.UnpicklingError('global %s.%s is forbidden' % (module, name))
+
+
+def _decode_legacy_cookie_cart(cookie_cart):
+    """解析旧的pickle+base64格式的cookie购物车数据"""
+    try:
+        cart_dict = _SafeUnpickler(io.BytesIO(base64.b64decode(cookie_cart))).load()
+    except Exception:
+        return {}
+
+    if not isinstance(cart_dict, dict):
+        return {}
+
+    # 旧格式的数据没有签名，sku_id和count不是正整数的记录直接忽略
+    res = {}
+    for sku_id, count_selected in cart_dict.items():
+        try:
+            count = count_selected['count']
+            selected = bool(count_selected['selected'])
+        except (TypeError, KeyError):
+            continue
+
+        if not _is_positive_int(sku_id) or not _is_positive_int(count):
+            continue
+
+        res[sku_id] = {
+            'count': count,
+            'selected': selected
+        }
+
+    return res
+
+
+def _is_positive_int(value):
+    return isinstance(value, int) and not isinstance(value, bool) and value > 0
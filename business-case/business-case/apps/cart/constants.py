@@ -1,2 +1,14 @@
 # 购物车cookie的有效期
 CART_COOKIE_EXPIRES = 365 * 24 * 60 * 60
+
+# cookie购物车数据超过该字节数时进行zlib压缩
+CART_COOKIE_COMPRESS_THRESHOLD = 64
+
+# cookie购物车数据签名的字节数
+CART_COOKIE_HMAC_LENGTH = 12
+
+# cookie购物车数据中随机nonce的字节数
+CART_COOKIE_NONCE_LENGTH = 4
+
+# 购物车批量修改一次最多包含的操作数量
+CART_BATCH_MAX_OPS = 50
@@ -0,0 +1,42 @@
+import base64
+import pickle
+import random
+import timeit
+
+from django.core.management.base import BaseCommand
+
+from cart.codec import encode_cookie_cart, decode_cookie_cart
+
+
+class Command(BaseCommand):
+    help = '对比cookie购物车数据的编码格式与旧的pickle+base64格式的大小和编解码速度'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[1, 5, 20, 50], help='购物车中的商品数量')
+        parser.add_argument('--number', type=int, default=10000, help='每项测试的执行次数')
+
+    def handle(self, *args, **options):
+        number = options['number']
+
+        self.stdout.write('%6s %12s %12s %14s %14s %14s %14s' % (
+            'items', 'pickle(B)', 'codec(B)', 'pickle enc(us)', 'codec enc(us)', 'pickle dec(us)', 'codec dec(us)'))
+
+        for size in options['sizes']:
+            sku_ids = random.sample(range(1, 100000), size)
+            cart_dict = {sku_id: {'count': random.randint(1, 10), 'selected': random.random() < 0.5}
+                         for sku_id in sku_ids}
+
+            pickle_cookie = base64.b64encode(pickle.dumps(cart_dict)).decode()
+            codec_cookie = encode_cookie_cart(cart_dict)
+
+            assert decode_cookie_cart(codec_cookie) == cart_dict
+
+            timings = [
+                timeit.timeit(lambda: base64.b64encode(pickle.dumps(cart_dict)).decode(), number=number),
+                timeit.timeit(lambda: encode_cookie_cart(cart_dict), number=number),
+                timeit.timeit(lambda: pickle.loads(base64.b64decode(pickle_cookie)), number=number),
+                timeit.timeit(lambda: decode_cookie_cart(codec_cookie), number=number),
+            ]
+
+            self.stdout.write('%6s %12s %12s %14.2f %14.2f %14.2f %14.2f' % (
+                (size, len(pickle_cookie), len(codec_cookie)) + tuple(t / number * 1e6 for t in timings)))
@@ -0,0 +1,202 @@
+import re
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+from django_redis import get_redis_connection
+
+from cart.models import CartArchive
+from cart.storage import CART_SUMMARY_KEY
+from goods.models import SKU
+from users.models import User
+
+# 购物车相关的键名: cart_<user_id>、cart_packed_<user_id>，以及可能单独残留的cart_selected_<user_id>、cart_summary_<user_id>
+CART_KEY_RE = re.compile(r'^cart_(?:packed_|selected_|summary_)?(\d+)$')
+# 浏览记录的键名: history_<user_id>
+HISTORY_KEY_RE = re.compile(r'^history_(\d+)$')
+
+# 删除用户的记录: 任何一个key在SCAN之后被设置了有效期(期间有写操作)时不删除，返回-1
+# KEYS: 用户相关的所有key
+DELETE_IF_PERSISTENT_SCRIPT = """
+for i = 1, #KEYS do
+    if redis.call('ttl', KEYS[i]) >= 0 then
+        return -1
+    end
+end
+return redis.call('del', unpack(KEYS))
+"""
+
+
+def get_cart_keys(user_id):
+    """用户购物车相关的所有key"""
+    return ['cart_%s' % user_id, 'cart_selected_%s' % user_id, 'cart_packed_%s' % user_id,
+            CART_SUMMARY_KEY % user_id]
+
+
+def read_carts(redis_conn, user_ids):
+    """
+    在一个管道中读取用户两种存储格式的购物车记录，不修改任何记录(不转换存储格式，也不刷新有效期):
+    两种格式中都有的商品取较大的数量，勾选状态以旧格式为准，与单hash格式转换时的规则一致
+    :return {'<user_id>': {'<sku_id>': {'count':, 'selected':}, ...}, ...}
+    """
+    pl = redis_conn.pipeline(transaction=False)
+    for user_id in user_ids:
+        pl.hgetall('cart_%s' % user_id)
+        pl.smembers('cart_selected_%s' % user_id)
+        pl.hgetall('cart_packed_%s' % user_id)
+    res = iter(pl.execute())
+
+    carts = {}
+    for user_id in user_ids:
+        cart_redis, cart_selected_redis, cart_packed_redis = next(res), next(res), next(res)
+
+        cart_dict = {}
+        for sku_id, value in cart_packed_redis.items():
+            value = int(value)
+            cart_dict[int(sku_id)] = {'count': value // 2, 'selected': value % 2 == 1}
+        for sku_id, count in cart_redis.items():
+            packed_count = cart_dict.get(int(sku_id), {}).get('count', 0)
+            cart_dict[int(sku_id)] = {'count': max(int(count), packed_count),
+                                      'selected': sku_id in cart_selected_redis}
+
+        carts[user_id] = cart_dict
+
+    return carts
+
+
+def get_history_keys(user_id):
+    """用户浏览记录的key"""
+    return ['history_%s' % user_id]
+
+
+class Command(BaseCommand):
+    help = '分批清理redis中长期未访问且没有设置有效期的购物车和浏览记录，其余记录补充设置有效期'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='每次SCAN的键数量')
+        parser.add_argument('--idle-days', type=int, default=90, help='超过该天数未访问的记录会被删除')
+        parser.add_argument('--archive', action='store_true', help='删除购物车之前归档到数据库(tb_cart_archive)')
+        parser.add_argument('--skip-histories', action='store_true', help='不处理浏览记录')
+        parser.add_argument('--dry-run', action='store_true', help='只统计可以回收的键数量和内存，不进行修改')
+
+    def handle(self, *args, **options):
+        self.options = options
+        self.idle_seconds = options['idle_days'] * 24 * 60 * 60
+
+        self.collect('购物车', get_redis_connection('cart'), 'cart_*', CART_KEY_RE, get_cart_keys,
+                     settings.CART_EXPIRES, self.archive_carts if options['archive'] else None)
+
+        if not options['skip_histories']:
+            self.collect('浏览记录', get_redis_connection('histories'), 'history_*', HISTORY_KEY_RE,
+                         get_history_keys, settings.HISTORY_EXPIRES)
+
+    def collect(self, name, redis_conn, match, key_re, get_keys, expires, archive=None):
+        """
+        SCAN所有用户的记录，每个用户的相关key作为一组处理:
+        1. 已经设置了有效期的记录跳过(由redis自动过期)
+        2. 所有key都超过idle-days未访问的记录(先归档再)删除，统计回收的键数量和内存(MEMORY USAGE)
+           删除时重新检查有效期，SCAN之后被写入的记录不删除
+        3. 其余记录补充设置有效期
+        """
+        deleted_users = deleted_keys = reclaimed_bytes = expired_users = 0
+        cursor = 0
+        delete_script = redis_conn.register_script(DELETE_IF_PERSISTENT_SCRIPT)
+
+        while True:
+            cursor, keys = redis_conn.scan(cursor, match=match, count=self.options['batch_size'])
+
+            user_ids = set()
+            for key in keys:
+                match_obj = key_re.match(key.decode())
+                if match_obj:
+                    user_ids.add(int(match_obj.group(1)))
+            user_ids = sorted(user_ids)
+
+            # 每批在一个管道中查询所有key的有效期、空闲时间和占用内存
+            # OBJECT IDLETIME和MEMORY USAGE不会更新key的访问时间
+            pl = redis_conn.pipeline(transaction=False)
+            for user_id in user_ids:
+                for key in get_keys(user_id):
+                    pl.exists(key)
+                    pl.ttl(key)
+                    pl.object('idletime', key)
+                    pl.execute_command('MEMORY USAGE', key)
+            res = iter(pl.execute(raise_on_error=False))
+
+            stale = {}
+            fresh = []
+            for user_id in user_ids:
+                existing = []
+                for key in get_keys(user_id):
+                    exists, ttl, idle, size = next(res), next(res), next(res), next(res)
+                    if exists is True or (isinstance(exists, int) and exists > 0):
+                        existing.append((key, ttl, idle, size))
+
+                # 已经设置了有效期，或者在SCAN之后已被删除(没有有效期时redis-py返回-1或None)
+                if not existing or any(isinstance(ttl, int) and ttl >= 0 for _, ttl, _, _ in existing):
+                    continue
+
+                # maxmemory-policy为LFU时无法获取空闲时间，只补充设置有效期
+                if all(isinstance(idle, int) and idle >= self.idle_seconds for _, _, idle, _ in existing):
+                    stale[user_id] = existing
+                else:
+                    fresh.append(user_id)
+
+            expired_users += len(fresh)
+
+            if self.options['dry_run']:
+                deleted = list(stale)
+            else:
+                archived_at = timezone.now()
+                if stale and archive is not None:
+                    archive(redis_conn, list(stale))
+
+                # 删除时在lua脚本中重新检查有效期，SCAN之后有写操作(设置了有效期)的记录不删除
+                pl = redis_conn.pipeline(transaction=False)
+                for user_id in stale:
+                    # 删除该用户两种存储格式的所有相关key
+                    delete_script(keys=get_keys(user_id), client=pl)
+                if expires:
+                    for user_id in fresh:
+                        for key in get_keys(user_id):
+                            pl.expire(key, expires)
+                res = pl.execute()[:len(stale)]
+
+                deleted = [user_id for user_id, count in zip(stale, res) if count >= 0]
+                skipped = [user_id for user_id, count in zip(stale, res) if count < 0]
+                if skipped and archive is not None:
+                    # 没有删除的记录不保留本次归档的数据
+                    CartArchive.objects.filter(user_id__in=skipped, create_time__gte=archived_at).delete()
+
+            deleted_users += len(deleted)
+            for user_id in deleted:
+                deleted_keys += len(stale[user_id])
+                reclaimed_bytes += sum(size for _, _, _, size in stale[user_id] if isinstance(size, int))
+
+            if cursor == 0:
+                break
+
+        self.stdout.write(self.style.SUCCESS(
+            '%s%s: 删除%s个用户的%s个键，回收%.2fMB内存，%s个用户补充设置有效期' % (
+                '[dry-run]' if self.options['dry_run'] else '', name, deleted_users, deleted_keys,
+                reclaimed_bytes / 1024 / 1024, expired_users)))
+
+    def archive_carts(self, redis_conn, user_ids):
+        """
+        将购物车记录归档到数据库，已不存在的用户和商品忽略
+        只读取记录，不转换存储格式: 删除被跳过(期间有写操作)时记录保持原来的格式和有效期
+        """
+        archives = []
+        for user_id, cart_dict in read_carts(redis_conn, user_ids).items():
+            for sku_id, count_selected in cart_dict.items():
+                archives.append(CartArchive(user_id=user_id, sku_id=sku_id, count=count_selected['count'],
+                                            selected=count_selected['selected']))
+
+        user_ids = set(User.objects.filter(id__in=user_ids).values_list('id', flat=True))
+        sku_ids = set(SKU.objects.filter(id__in=set(archive.sku_id for archive in archives)).values_list(
+            'id', flat=True))
+
+        with transaction.atomic():
+            CartArchive.objects.bulk_create(
+                [archive for archive in archives if archive.user_id in user_ids and archive.sku_id in sku_ids])
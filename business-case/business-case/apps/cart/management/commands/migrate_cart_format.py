@@ -0,0 +1,69 @@
+import re
+
+from django.core.management.base import BaseCommand
+from django_redis import get_redis_connection
+
+from cart.storage import PACKED_MIGRATE_SCRIPT, SPLIT_UNPACK_SCRIPT, CART_SUMMARY_KEY
+
+# 旧格式购物车hash的键名: cart_<user_id>
+CART_KEY_RE = re.compile(r'^cart_(\d+)$')
+# 单hash格式购物车的键名: cart_packed_<user_id>
+PACKED_CART_KEY_RE = re.compile(r'^cart_packed_(\d+)$')
+
+
+class Command(BaseCommand):
+    help = '将redis中旧格式(hash + set)的购物车记录分批转换为单hash格式，--unpack时反向转换(回退)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='每次SCAN的键数量')
+        parser.add_argument('--dry-run', action='store_true', help='只统计需要转换的购物车数量，不进行转换')
+        parser.add_argument('--unpack', action='store_true',
+                            help='将单hash格式的记录转换回旧格式，执行之前需要先将CART_STORAGE_FORMAT改回split')
+
+    def handle(self, *args, **options):
+        redis_conn = get_redis_connection('cart')
+
+        if options['unpack']:
+            script = redis_conn.register_script(SPLIT_UNPACK_SCRIPT)
+            match, key_re = 'cart_packed_*', PACKED_CART_KEY_RE
+
+            def get_keys(user_id):
+                return ['cart_%s' % user_id, 'cart_selected_%s' % user_id, 'cart_packed_%s' % user_id,
+                        CART_SUMMARY_KEY % user_id]
+        else:
+            script = redis_conn.register_script(PACKED_MIGRATE_SCRIPT)
+            match, key_re = 'cart_*', CART_KEY_RE
+
+            def get_keys(user_id):
+                return ['cart_packed_%s' % user_id, 'cart_%s' % user_id, 'cart_selected_%s' % user_id,
+                        CART_SUMMARY_KEY % user_id]
+
+        carts = 0
+        items = 0
+        cursor = 0
+
+        while True:
+            cursor, keys = redis_conn.scan(cursor, match=match, count=options['batch_size'])
+
+            user_ids = []
+            for key in keys:
+                match_obj = key_re.match(key.decode())
+                if match_obj:
+                    user_ids.append(match_obj.group(1))
+
+            if user_ids and not options['dry_run']:
+                # 每批在一个管道中完成转换
+                pl = redis_conn.pipeline()
+                for user_id in user_ids:
+                    script(keys=get_keys(user_id), client=pl)
+                items += sum(pl.execute())
+
+            carts += len(user_ids)
+
+            if cursor == 0:
+                break
+
+        if options['dry_run']:
+            self.stdout.write('需要转换的购物车: %s' % carts)
+        else:
+            self.stdout.write(self.style.SUCCESS('转换完成: %s个购物车，%s条记录' % (carts, items)))
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('users', '0003_auto_20181031_1515'),
+        ('goods', '0003_sku_list_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CartArchive',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('create_time', models.DateTimeField(auto_now_add=True, verbose_name='创建时间')),
+                ('update_time', models.DateTimeField(auto_now=True, verbose_name='更新时间')),
+                ('count', models.IntegerField(default=1, verbose_name='数量')),
+                ('selected', models.BooleanField(default=True, verbose_name='是否勾选')),
+                ('sku', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='goods.SKU', verbose_name='商品')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL, verbose_name='用户')),
+            ],
+            options={
+                'db_table': 'tb_cart_archive',
+                'verbose_name_plural': '归档购物车记录',
+                'verbose_name': '归档购物车记录',
+            },
+        ),
+    ]
@@ -1,3 +1,22 @@
 from django.db import models
+from meiduo_mall.utils.models import BaseModel
+from users.models import User
+from goods.models import SKU
 
 # Create your models here.
+
+
+class CartArchive(BaseModel):
+    """
+    归档的购物车记录模型类
+    长期未访问的redis购物车在清理时可以归档到数据库，用于再营销
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, verbose_name="用户")
+    sku = models.ForeignKey(SKU, on_delete=models.CASCADE, verbose_name="商品")
+    count = models.IntegerField(default=1, verbose_name="数量")
+    selected = models.BooleanField(default=True, verbose_name="是否勾选")
+
+    class Meta:
+        db_table = "tb_cart_archive"
+        verbose_name = '归档购物车记录'
+        verbose_name_plural = verbose_name
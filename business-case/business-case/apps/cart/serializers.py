@@ -1,6 +1,9 @@
 from rest_framework import serializers
 
 from goods.models import SKU
+from cart import constants
+from cart.utils import apply_cart_ops
+from goods.utils import get_sku_stock, get_sku_stocks
 
 
 class CartSerializer(serializers.Serializer):
@@ -12,16 +15,19 @@ class CartSerializer(serializers.Serializer):
     def validate(self, attrs):
         """sku_id对应的商品是否存在，商品库存是否足够"""
         # sku_id对应的商品是否存在
+        # 库存和上架状态优先从redis镜像中获取，镜像中没有时才查询数据库
         sku_id = attrs['sku_id']
+        sku_stock = get_sku_stock(sku_id)
 
-        try:
-            sku = SKU.objects.get(id=sku_id)
-        except SKU.DoesNotExist:
+        if sku_stock is None:
             raise serializers.ValidationError('商品不存在')
 
+        if not sku_stock['is_launched']:
+            raise serializers.ValidationError('商品已下架')
+
         # 商品库存是否足够
         count = attrs['count']
-        if count > sku.stock:
+        if count > sku_stock['stock']:
             raise serializers.ValidationError('商品库存不足')
 
         return attrs
@@ -43,9 +49,7 @@ class CartDelSerializer(serializers.Serializer):
 
     def validate_sku_id(self, value):
         # sku_id对应商品是否存在
-        try:
-            sku = SKU.objects.get(id=value)
-        except SKU.DoesNotExist:
+        if get_sku_stock(value) is None:
             raise serializers.ValidationError('商品不存在')
 
         return value
@@ -53,4 +57,67 @@ class CartDelSerializer(serializers.Serializer):
 
 class CartSelectAllSerializer(serializers.Serializer):
     """购物车全选的序列化器类"""
-    selected = serializers.BooleanField(label='勾选状态')
\ No newline at end of file
+    selected = serializers.BooleanField(label='勾选状态')
+
+
+class CartBatchOpSerializer(serializers.Serializer):
+    """购物车批量修改中单个操作的序列化器类"""
+    OP_CHOICES = (
+        ('add', '添加'),
+        ('set', '修改'),
+        ('remove', '删除'),
+        ('select', '勾选')
+    )
+
+    op = serializers.ChoiceField(label='操作类型', choices=OP_CHOICES)
+    sku_id = serializers.IntegerField(label='商品SKU编号', min_value=1)
+    count = serializers.IntegerField(label='商品数量', min_value=1, required=False)
+    selected = serializers.BooleanField(label='勾选状态', default=True)
+
+    def validate(self, attrs):
+        """添加和修改操作必须传递商品数量"""
+        if attrs['op'] in ('add', 'set') and 'count' not in attrs:
+            raise serializers.ValidationError('缺少商品数量')
+
+        return attrs
+
+
+class CartBatchSerializer(serializers.Serializer):
+    """购物车批量修改的序列化器类"""
+    ops = CartBatchOpSerializer(label='操作列表', many=True)
+
+    def validate_ops(self, value):
+        """
+        所有操作中的商品一次性校验:
+        商品是否存在，添加和修改的商品是否上架、执行所有操作之后的数量是否超过库存
+        执行之后的数量按context['cart_dict'](当前的购物车记录)依次执行所有操作得到，同一商品的多个添加操作累加计算
+        库存和上架状态优先从redis镜像中获取，镜像中没有的商品通过一次id__in查询获取
+        """
+        if not value:
+            raise serializers.ValidationError('操作列表不能为空')
+
+        if len(value) > constants.CART_BATCH_MAX_OPS:
+            raise serializers.ValidationError('操作数量不能超过%s' % constants.CART_BATCH_MAX_OPS)
+
+        sku_stocks = get_sku_stocks(set(op['sku_id'] for op in value))
+
+        cart_dict = self.context.get('cart_dict', {})
+        result = apply_cart_ops({sku_id: dict(item) for sku_id, item in cart_dict.items()}, value)
+
+        for op in value:
+            sku_stock = sku_stocks.get(op['sku_id'])
+
+            if sku_stock is None:
+                raise serializers.ValidationError('商品不存在')
+
+            if op['op'] not in ('add', 'set'):
+                continue
+
+            if not sku_stock['is_launched']:
+                raise serializers.ValidationError('商品已下架')
+
+            count = result[op['sku_id']]['count'] if op['sku_id'] in result else 0
+            if count > sku_stock['stock']:
+                raise serializers.ValidationError('商品库存不足')
+
+        return value
@@ -0,0 +1,669 @@
+from decimal import Decimal
+
+from django.conf import settings
+from django_redis import get_redis_connection
+
+from goods.models import SKU
+from goods.utils import get_sku_summary_map, get_sku_price_version
+
+# 购物车汇总数据: cart_summary_<user_id>
+# hash {
+#     'version': '<计算时的sku价格版本号>',
+#     'total_count': '<商品总数量>',
+#     'selected_count': '<勾选商品的总数量>',
+#     'selected_amount': '<勾选商品的总金额(分)>',
+#     'price_<sku_id>': '<计算时商品的单价(分)>',
+#     ...
+# }
+CART_SUMMARY_KEY = 'cart_summary_%s'
+
+# 合并标记: cart_merged_<user_id>_<cookie数据的摘要>
+CART_MERGED_KEY = 'cart_merged_%s_%s'
+# 合并标记的有效期: s
+CART_MERGED_EXPIRES = 24 * 60 * 60
+
+# 购物车中商品数量和勾选状态的读写函数，两种存储格式各自实现:
+# state(sku_id): 返回 count, selected(1/0)，购物车中没有该商品时count为0
+# write(sku_id, count, selected): count为0时删除该商品
+# sku_ids(): 返回购物车中所有的商品id
+# KEYS[1]: cart_<user_id> KEYS[2]: cart_selected_<user_id> KEYS[3]: cart_summary_<user_id>
+SPLIT_PRELUDE = """
+local SUMMARY = KEYS[3]
+local CART_KEYS = 3
+local function state(sku_id)
+    local count = tonumber(redis.call('hget', KEYS[1], sku_id) or 0)
+    return count, redis.call('sismember', KEYS[2], sku_id)
+end
+local function write(sku_id, count, selected)
+    if count > 0 then
+        redis.call('hset', KEYS[1], sku_id, count)
+    else
+        redis.call('hdel', KEYS[1], sku_id)
+    end
+    if count > 0 and selected == 1 then
+        redis.call('sadd', KEYS[2], sku_id)
+    else
+        redis.call('srem', KEYS[2], sku_id)
+    end
+end
+local function sku_ids()
+    return redis.call('hkeys', KEYS[1])
+end
+"""
+
+# 单hash格式购物车: 将旧格式(hash + set)的购物车记录合并到单hash中，并删除旧格式的记录
+# 两种格式中都有的商品取较大的数量，勾选状态以旧格式为准(旧格式中存在的记录是在上次转换之后写入的)
+# 转换之后删除汇总数据，查询时按合并之后的记录重新计算
+# KEYS[1]: cart_packed_<user_id> KEYS[2]: cart_<user_id> KEYS[3]: cart_selected_<user_id>
+# KEYS[4]: cart_summary_<user_id>
+MIGRATE_FUNCTION = """
+local function migrate()
+    if redis.call('exists', KEYS[2]) == 0 then
+        return 0
+    end
+    local items = redis.call('hgetall', KEYS[2])
+    for i = 1, #items, 2 do
+        local count = tonumber(items[i + 1])
+        local packed_count = math.floor(tonumber(redis.call('hget', KEYS[1], items[i]) or 0) / 2)
+        if packed_count > count then
+            count = packed_count
+        end
+        local selected = redis.call('sismember', KEYS[3], items[i])
+        redis.call('hset', KEYS[1], items[i], count * 2 + selected)
+    end
+    local ttl = redis.call('pttl', KEYS[2])
+    if ttl > 0 then
+        redis.call('pexpire', KEYS[1], ttl)
+    end
+    redis.call('del', KEYS[2], KEYS[3], KEYS[4])
+    return #items / 2
+end
+"""
+
+PACKED_PRELUDE = MIGRATE_FUNCTION + """
+local SUMMARY = KEYS[4]
+local CART_KEYS = 4
+local function state(sku_id)
+    local value = tonumber(redis.call('hget', KEYS[1], sku_id) or 0)
+    return math.floor(value / 2), value % 2
+end
+local function write(sku_id, count, selected)
+    if count > 0 then
+        redis.call('hset', KEYS[1], sku_id, count * 2 + selected)
+    else
+        redis.call('hdel', KEYS[1], sku_id)
+    end
+end
+local function sku_ids()
+    return redis.call('hkeys', KEYS[1])
+end
+migrate()
+"""
+
+# 增量更新购物车汇总数据，没有汇总数据时不做处理(查询时重新计算)
+# price: 商品的最新单价(分)，为nil时使用汇总数据中记录的单价
+# 汇总数据的价格版本号与读取单价之前的版本号不同时，单价可能是旧的，删除汇总数据，查询时重新计算
+SUMMARY_FUNCTION = """
+local function update_summary(sku_id, count, selected, new_count, new_selected, price)
+    if redis.call('exists', SUMMARY) == 0 then
+        return
+    end
+    if PRICE_VERSION ~= '' and redis.call('hget', SUMMARY, 'version') ~= PRICE_VERSION then
+        redis.call('del', SUMMARY)
+        return
+    end
+    local field = 'price_' .. sku_id
+    local old_price = tonumber(redis.call('hget', SUMMARY, field) or 0)
+    price = tonumber(price) or old_price
+    redis.call('hincrby', SUMMARY, 'total_count', new_count - count)
+    redis.call('hincrby', SUMMARY, 'selected_count', new_count * new_selected - count * selected)
+    redis.call('hincrby', SUMMARY, 'selected_amount', new_count * new_selected * price - count * selected * old_price)
+    if new_count > 0 then
+        redis.call('hset', SUMMARY, field, price)
+    else
+        redis.call('hdel', SUMMARY, field)
+    end
+end
+"""
+
+# 添加商品，如果购物车中已有该商品则累加数量，selected为0时保持原来的勾选状态
+# ARGV[1]: sku_id ARGV[2]: count ARGV[3]: 1(勾选) 0(未勾选) ARGV[4]: 单价(分)
+ADD_BODY = """
+local count, selected = state(ARGV[1])
+local new_count = count + tonumber(ARGV[2])
+local new_selected = selected
+if ARGV[3] == '1' then
+    new_selected = 1
+end
+write(ARGV[1], new_count, new_selected)
+update_summary(ARGV[1], count, selected, new_count, new_selected, ARGV[4])
+return new_count
+"""
+
+# 设置商品的数量和勾选状态
+# ARGV: sku_id, count, selected, 单价(分), ...
+SET_BODY = """
+for i = 1, #ARGV, 4 do
+    local count, selected = state(ARGV[i])
+    local new_count = tonumber(ARGV[i + 1])
+    local new_selected = tonumber(ARGV[i + 2])
+    write(ARGV[i], new_count, new_selected)
+    update_summary(ARGV[i], count, selected, new_count, new_selected, ARGV[i + 3])
+end
+return #ARGV / 4
+"""
+
+# 删除商品
+# ARGV: sku_id, sku_id, ...
+REMOVE_BODY = """
+for i = 1, #ARGV do
+    local count, selected = state(ARGV[i])
+    write(ARGV[i], 0, 0)
+    if count > 0 then
+        update_summary(ARGV[i], count, selected, 0, 0)
+    end
+end
+return #ARGV
+"""
+
+# 全选和全不选
+# ARGV[1]: 1(全选) 0(全不选)
+SELECT_ALL_BODY = """
+local new_selected = tonumber(ARGV[1])
+local ids = sku_ids()
+for _, sku_id in ipairs(ids) do
+    local count, selected = state(sku_id)
+    write(sku_id, count, new_selected)
+    update_summary(sku_id, count, selected, count, new_selected)
+end
+return #ids
+"""
+
+# 按顺序执行多个操作，并返回执行之后的购物车记录
+# ARGV: op(add/set/remove/select), sku_id, count, selected, 单价(分), ...
+# 返回: [sku_id, count, selected, sku_id, count, selected, ...]
+BATCH_BODY = """
+for i = 1, #ARGV, 5 do
+    local op, sku_id = ARGV[i], ARGV[i + 1]
+    local count, selected = state(sku_id)
+    local new_count, new_selected = count, selected
+    if op == 'add' then
+        new_count = count + tonumber(ARGV[i + 2])
+        if ARGV[i + 3] == '1' then
+            new_selected = 1
+        end
+    elseif op == 'set' then
+        new_count = tonumber(ARGV[i + 2])
+        new_selected = tonumber(ARGV[i + 3])
+    elseif op == 'remove' then
+        new_count, new_selected = 0, 0
+    elseif op == 'select' then
+        new_selected = tonumber(ARGV[i + 3])
+    end
+    if count > 0 or new_count > 0 then
+        write(sku_id, new_count, new_selected)
+        update_summary(sku_id, count, selected, new_count, new_selected, ARGV[i + 4])
+    end
+end
+local res = {}
+for _, sku_id in ipairs(sku_ids()) do
+    local count, selected = state(sku_id)
+    res[#res + 1] = sku_id
+    res[#res + 1] = count
+    res[#res + 1] = selected
+end
+return res
+"""
+
+# 合并cookie购物车记录，同一份cookie数据只合并一次
+# KEYS[#KEYS]: 合并标记
+# ARGV[1]: overwrite(覆盖) sum(累加) ARGV[2]: 合并标记有效期(0表示不检查合并标记)
+# ARGV[3...]: sku_id, count, selected, 数量上限(-1表示不限), 单价(分), ...
+MERGE_BODY = """
+if tonumber(ARGV[2]) > 0 and not redis.call('set', KEYS[#KEYS], 1, 'NX', 'EX', ARGV[2]) then
+    return -1
+end
+for i = 3, #ARGV, 5 do
+    local count, selected = state(ARGV[i])
+    local new_count = tonumber(ARGV[i + 1])
+    if ARGV[1] == 'sum' then
+        new_count = new_count + count
+    end
+    local cap = tonumber(ARGV[i + 3])
+    if cap >= 0 and new_count > cap then
+        new_count = cap
+    end
+    local new_selected = tonumber(ARGV[i + 2])
+    write(ARGV[i], new_count, new_selected)
+    update_summary(ARGV[i], count, selected, new_count, new_selected, ARGV[i + 4])
+end
+return (#ARGV - 2) / 5
+"""
+
+# 重新计算购物车汇总数据
+# ARGV[1]: sku价格版本号 ARGV[2...]: sku_id, 单价(分), ...
+# 返回: [total_count, selected_count, selected_amount]，购物车中有未提供单价的商品时(计算期间被加入)返回nil
+REBUILD_SUMMARY_BODY = """
+local prices = {}
+for i = 2, #ARGV, 2 do
+    prices[ARGV[i]] = tonumber(ARGV[i + 1])
+end
+local total_count, selected_count, selected_amount = 0, 0, 0
+local fields = {}
+for _, sku_id in ipairs(sku_ids()) do
+    local price = prices[sku_id]
+    if not price then
+        return false
+    end
+    local count, selected = state(sku_id)
+    total_count = total_count + count
+    selected_count = selected_count + count * selected
+    selected_amount = selected_amount + count * selected * price
+    fields[#fields + 1] = 'price_' .. sku_id
+    fields[#fields + 1] = price
+end
+redis.call('del', SUMMARY)
+redis.call('hmset', SUMMARY, 'version', ARGV[1], 'total_count', total_count, 'selected_count', selected_count,
+    'selected_amount', selected_amount, unpack(fields))
+return {total_count, selected_count, selected_amount}
+"""
+
+# 获取购物车中被勾选的商品id和对应数量count
+# KEYS[1]: cart_<user_id> KEYS[2]: cart_selected_<user_id>
+# 返回: [sku_id, count, sku_id, count, ...]
+GET_SELECTED_SCRIPT = """
+local res = {}
+local sku_ids = redis.call('smembers', KEYS[2])
+for _, sku_id in ipairs(sku_ids) do
+    local count = redis.call('hget', KEYS[1], sku_id)
+    if count then
+        res[#res + 1] = sku_id
+        res[#res + 1] = count
+    end
+end
+return res
+"""
+
+PACKED_MIGRATE_SCRIPT = MIGRATE_FUNCTION + """
+return migrate()
+"""
+
+# 回退到旧格式: 将单hash格式的购物车记录合并到旧格式(hash + set)中，并删除单hash格式的记录
+# 需要先将CART_STORAGE_FORMAT改回split，否则单hash格式的操作会再次转换
+# 两种格式中都有的商品取较大的数量，勾选状态以旧格式为准，转换之后删除汇总数据
+# KEYS[1]: cart_<user_id> KEYS[2]: cart_selected_<user_id> KEYS[3]: cart_packed_<user_id>
+# KEYS[4]: cart_summary_<user_id>
+SPLIT_UNPACK_SCRIPT = """
+if redis.call('exists', KEYS[3]) == 0 then
+    return 0
+end
+local items = redis.call('hgetall', KEYS[3])
+for i = 1, #items, 2 do
+    local value = tonumber(items[i + 1])
+    local count = tonumber(redis.call('hget', KEYS[1], items[i]) or 0)
+    if count == 0 and value % 2 == 1 then
+        redis.call('sadd', KEYS[2], items[i])
+    end
+    if math.floor(value / 2) > count then
+        redis.call('hset', KEYS[1], items[i], math.floor(value / 2))
+    end
+end
+local ttl = redis.call('pttl', KEYS[3])
+if ttl > 0 then
+    redis.call('pexpire', KEYS[1], ttl)
+    redis.call('pexpire', KEYS[2], ttl)
+end
+redis.call('del', KEYS[3], KEYS[4])
+return #items / 2
+"""
+
+# 返回: [sku_id, value, sku_id, value, ...]
+PACKED_GET_SCRIPT = MIGRATE_FUNCTION + """
+migrate()
+return redis.call('hgetall', KEYS[1])
+"""
+
+
+# 写操作执行之后重新设置购物车相关key的有效期(滑动过期)
+# ARGV[1]: 有效期(s)，0表示不过期 ARGV[2]: 读取单价之前的sku价格版本号，空字符串表示没有传递单价
+# 取出之后其余参数依次前移
+EXPIRES_PRELUDE = """
+local EXPIRES = tonumber(table.remove(ARGV, 1))
+local PRICE_VERSION = table.remove(ARGV, 1)
+"""
+
+EXPIRES_WRAPPER = """
+local function run()
+%s
+end
+local res = run()
+if EXPIRES > 0 then
+    for i = 1, CART_KEYS do
+        redis.call('expire', KEYS[i], EXPIRES)
+    end
+end
+return res
+"""
+
+
+def build_scripts(prelude):
+    """将存储格式的读写函数与各操作组合为完整的lua脚本"""
+    prelude = EXPIRES_PRELUDE + prelude + SUMMARY_FUNCTION
+    bodies = {
+        'add': ADD_BODY,
+        'set': SET_BODY,
+        'remove': REMOVE_BODY,
+        'select_all': SELECT_ALL_BODY,
+        'merge': MERGE_BODY,
+        'batch': BATCH_BODY,
+        'rebuild_summary': REBUILD_SUMMARY_BODY,
+    }
+    return {name: prelude + EXPIRES_WRAPPER % body for name, body in bodies.items()}
+
+
+def get_sku_prices(sku_ids):
+    """
+    获取商品的单价(分)，价格从sku摘要缓存中获取，已不存在的商品单价为0:
+    {
+        '<sku_id>': '<price>',
+        ...
+    }
+    """
+    summaries = get_sku_summary_map(sku_ids)
+
+    prices = {}
+    for sku_id in sku_ids:
+        sku_id = int(sku_id)
+        summary = summaries.get(sku_id)
+        prices[sku_id] = int(Decimal(summary['price']) * 100) if summary is not None else 0
+
+    return prices
+
+
+def get_sku_db_prices(sku_ids):
+    """
+    从数据库获取商品的单价(分)，已不存在的商品单价为0
+    写入购物车汇总数据的单价使用数据库中的价格: 价格版本号变化之后sku摘要缓存可能还没有失效
+    """
+    prices = dict.fromkeys((int(sku_id) for sku_id in sku_ids), 0)
+    for sku_id, price in SKU.objects.filter(id__in=list(prices)).values_list('id', 'price'):
+        prices[sku_id] = int(price * 100)
+
+    return prices
+
+
+class BaseRedisCart(object):
+    """
+    登录用户redis购物车记录的写操作和汇总数据，子类提供存储格式对应的key和lua脚本
+    每个写操作都是一个lua脚本，在修改购物车的同时增量更新汇总数据
+    """
+    # 存储格式对应的lua脚本
+    scripts = {}
+
+    def __init__(self, user_id, redis_conn=None):
+        self.redis_conn = redis_conn or get_redis_connection('cart')
+        self.user_id = user_id
+        self.summary_key = CART_SUMMARY_KEY % user_id
+        self.keys = []
+
+    def _run(self, script, args=None, keys=None):
+        return self.redis_conn.register_script(script)(keys=keys or self.keys, args=args or [])
+
+    def _write(self, name, args, keys=None, price_version=''):
+        """
+        执行写操作脚本，并刷新购物车的有效期CART_EXPIRES
+        price_version: 读取args中单价之前的sku价格版本号
+        """
+        return self._run(self.scripts[name], [settings.CART_EXPIRES or 0, price_version] + list(args), keys)
+
+    def get_cart(self):
+        raise NotImplementedError
+
+    def add(self, sku_id, count, selected):
+        """添加商品，如果购物车中已有该商品则累加数量"""
+        version = get_sku_price_version()
+        price = get_sku_db_prices([sku_id])[int(sku_id)]
+        self._write('add', [sku_id, count, 1 if selected else 0, price], price_version=version)
+
+    def update(self, sku_id, count, selected):
+        """修改商品的数量和勾选状态"""
+        version = get_sku_price_version()
+        price = get_sku_db_prices([sku_id])[int(sku_id)]
+        self._write('set', [sku_id, count, 1 if selected else 0, price], price_version=version)
+
+    def remove(self, *sku_ids):
+        """删除购物车中的商品"""
+        if not sku_ids:
+            return
+
+        self._write('remove', list(sku_ids))
+
+    def select_all(self, selected):
+        """全选或全不选"""
+        self._write('select_all', [1 if selected else 0])
+
+    def batch(self, ops):
+        """
+        在一个lua脚本中按顺序执行多个操作，返回执行之后的购物车记录:
+        ops: [{'op': '<add/set/remove/select>', 'sku_id':, 'count':, 'selected':}, ...]
+        :return
+        {
+            '<sku_id>': {
+                'count': '<count>',
+                'selected': '<selected>'
+            },
+            ...
+        }
+        """
+        version = get_sku_price_version()
+        prices = get_sku_db_prices(set(op['sku_id'] for op in ops))
+
+        args = []
+        for op in ops:
+            args.extend([op['op'], op['sku_id'], op.get('count', 0), 1 if op.get('selected') else 0,
+                         prices[int(op['sku_id'])]])
+
+        res = self._write('batch', args, price_version=version)
+
+        cart_dict = {}
+        for i in range(0, len(res), 3):
+            cart_dict[int(res[i])] = {
+                'count': int(res[i + 1]),
+                'selected': int(res[i + 2]) == 1
+            }
+
+        return cart_dict
+
+    def merge(self, cart_dict, policy='overwrite', caps=None, token=None):
+        """
+        合并cookie购物车记录:
+        cart_dict: {
+            '<sku_id>': {
+                'count': '<count>',
+                'selected': '<selected>'
+            },
+            ...
+        }
+        policy: overwrite(cookie中的数量覆盖redis中的数量) sum(数量累加)
+        caps: {'<sku_id>': '<数量上限>', ...}，合并之后的数量不超过上限
+        token: cookie数据的摘要，相同token的数据只合并一次，重试时不会重复累加
+        返回合并的商品数量，已经合并过时返回-1
+        """
+        if not cart_dict:
+            return 0
+
+        version = get_sku_price_version()
+        prices = get_sku_db_prices(cart_dict.keys())
+
+        args = [policy, CART_MERGED_EXPIRES if token else 0]
+        for sku_id, count_selected in cart_dict.items():
+            cap = caps.get(sku_id, -1) if caps is not None else -1
+            args.extend([sku_id, count_selected['count'], 1 if count_selected['selected'] else 0, cap,
+                         prices[int(sku_id)]])
+
+        return self._write('merge', args, self.keys + [CART_MERGED_KEY % (self.user_id, token)], version)
+
+    def get_summary(self):
+        """
+        获取购物车汇总数据，不需要查询数据库:
+        {
+            'total_count': '<商品总数量>',
+            'selected_count': '<勾选商品的总数量>',
+            'selected_amount': '<勾选商品的总金额>'
+        }
+        汇总数据在每次修改购物车时增量更新，没有汇总数据或sku价格版本号变化时重新计算
+        """
+        version = get_sku_price_version()
+        summary = self.redis_conn.hmget(self.summary_key, 'version', 'total_count', 'selected_count',
+                                        'selected_amount')
+
+        if summary[0] is not None and int(summary[0]) == version:
+            total_count, selected_count, selected_amount = (int(value) for value in summary[1:])
+        else:
+            total_count, selected_count, selected_amount = self.rebuild_summary(version)
+
+        return {
+            'total_count': total_count,
+            'selected_count': selected_count,
+            'selected_amount': (Decimal(selected_amount) / 100).quantize(Decimal('0.01'))
+        }
+
+    def rebuild_summary(self, version):
+        """
+        按当前价格重新计算汇总数据，返回(total_count, selected_count, selected_amount)
+        单价一次查询从数据库获取
+        """
+        cart_dict = self.get_cart()
+        prices = get_sku_db_prices(cart_dict)
+
+        args = [version]
+        for sku_id, price in prices.items():
+            args.extend([sku_id, price])
+
+        res = self._write('rebuild_summary', args)
+        if res is not None:
+            return res
+
+        # 计算期间购物车中加入了新的商品，直接使用已读取的购物车数据计算，不保存
+        total_count = selected_count = selected_amount = 0
+        for sku_id, count_selected in cart_dict.items():
+            count = count_selected['count']
+            total_count += count
+            if count_selected['selected']:
+                selected_count += count
+                selected_amount += count * prices[sku_id]
+
+        return total_count, selected_count, selected_amount
+
+
+class RedisCart(BaseRedisCart):
+    """
+    登录用户的redis购物车记录:
+    cart_<user_id>: hash {'<sku_id>': '<count>', ...}
+    cart_selected_<user_id>: set {'<sku_id>', ...}
+    每个购物车操作只需要与redis进行一次交互
+    """
+    scripts = build_scripts(SPLIT_PRELUDE)
+
+    def __init__(self, user_id, redis_conn=None):
+        super().__init__(user_id, redis_conn)
+        self.cart_key = 'cart_%s' % user_id
+        self.cart_selected_key = 'cart_selected_%s' % user_id
+        self.keys = [self.cart_key, self.cart_selected_key, self.summary_key]
+
+    def get_cart(self):
+        """
+        获取购物车中所有商品的数量和勾选状态:
+        {
+            '<sku_id>': {
+                'count': '<count>',
+                'selected': '<selected>'
+            },
+            ...
+        }
+        """
+        pl = self.redis_conn.pipeline()
+        pl.hgetall(self.cart_key)
+        pl.smembers(self.cart_selected_key)
+        cart_redis, cart_selected_redis = pl.execute()
+
+        cart_dict = {}
+        for sku_id, count in cart_redis.items():
+            cart_dict[int(sku_id)] = {
+                'count': int(count),
+                'selected': sku_id in cart_selected_redis
+            }
+
+        return cart_dict
+
+    def get_selected(self):
+        """
+        获取购物车中被勾选的商品id和对应数量count:
+        {
+            '<sku_id>': '<count>',
+            ...
+        }
+        """
+        res = self._run(GET_SELECTED_SCRIPT)
+
+        return {int(res[i]): int(res[i + 1]) for i in range(0, len(res), 2)}
+
+
+class PackedRedisCart(BaseRedisCart):
+    """
+    登录用户的单hash格式redis购物车记录:
+    cart_packed_<user_id>: hash {'<sku_id>': '<count> * 2 + <selected>', ...}
+    每个操作都是一个lua脚本，执行时会先将该用户旧格式的购物车记录转换过来，所以两种格式的记录在切换期间都可以读取
+    """
+    scripts = build_scripts(PACKED_PRELUDE)
+
+    def __init__(self, user_id, redis_conn=None):
+        super().__init__(user_id, redis_conn)
+        self.keys = ['cart_packed_%s' % user_id, 'cart_%s' % user_id, 'cart_selected_%s' % user_id,
+                     self.summary_key]
+
+    @staticmethod
+    def pack(count, selected):
+        """将数量和勾选状态编码为hash的值"""
+        return int(count) * 2 + (1 if selected else 0)
+
+    def get_cart(self):
+        """
+        获取购物车中所有商品的数量和勾选状态:
+        {
+            '<sku_id>': {
+                'count': '<count>',
+                'selected': '<selected>'
+            },
+            ...
+        }
+        """
+        res = self._run(PACKED_GET_SCRIPT)
+
+        cart_dict = {}
+        for i in range(0, len(res), 2):
+            value = int(res[i + 1])
+            cart_dict[int(res[i])] = {
+                'count': value // 2,
+                'selected': value % 2 == 1
+            }
+
+        return cart_dict
+
+    def get_selected(self):
+        """
+        获取购物车中被勾选的商品id和对应数量count:
+        {
+            '<sku_id>': '<count>',
+            ...
+        }
+        """
+        return {sku_id: item['count'] for sku_id, item in self.get_cart().items() if item['selected']}
+
+
+def get_redis_cart(user_id, redis_conn=None):
+    """根据CART_STORAGE_FORMAT配置返回登录用户的redis购物车对象"""
+    if settings.CART_STORAGE_FORMAT == 'packed':
+        return PackedRedisCart(user_id, redis_conn)
+
+    return RedisCart(user_id, redis_conn)
@@ -1,8 +1,292 @@
+from django.conf import settings
+from django.core.management import call_command
 from django.test import TestCase
+from io import StringIO
 import pickle
 import base64
+from decimal import Decimal
+
+from cart.codec import encode_cookie_cart, decode_cookie_cart
+from cart.management.commands.gc_redis_carts import Command, read_carts
+from cart.models import CartArchive
+from cart.serializers import CartBatchSerializer
+from cart.storage import RedisCart, PackedRedisCart
+from cart.utils import apply_cart_ops
+from goods.models import SKU
+from goods.tests import create_goods_with_skus, RedisTestCase
+from goods.utils import get_sku_price_version, incr_sku_price_version, get_sku_summaries
+from users.models import User
 # Create your tests here.
 
+
+class CookieCartCodecTest(TestCase):
+    def setUp(self):
+        self.cart_dict = {sku_id: {'count': sku_id % 7 + 1, 'selected': sku_id % 2 == 0} for sku_id in range(1, 200, 3)}
+
+    def test_round_trip(self):
+        """编码之后可以还原，且比pickle格式更小"""
+        cookie_cart = encode_cookie_cart(self.cart_dict)
+        self.assertEqual(decode_cookie_cart(cookie_cart), self.cart_dict)
+        self.assertLess(len(cookie_cart), len(base64.b64encode(pickle.dumps(self.cart_dict))))
+
+        self.assertEqual(decode_cookie_cart(encode_cookie_cart({})), {})
+
+        # 内容相同的购物车每次写入的cookie不同，登录时作为新的数据合并
+        self.assertNotEqual(encode_cookie_cart(self.cart_dict), cookie_cart)
+
+    def test_tampered(self):
+        """被篡改的数据视为空购物车"""
+        cookie_cart = encode_cookie_cart({1: {'count': 2, 'selected': True}})
+        tampered = cookie_cart[:-1] + ('A' if cookie_cart[-1] != 'A' else 'B')
+        self.assertEqual(decode_cookie_cart(tampered), {})
+        self.assertEqual(decode_cookie_cart('c1.!!!'), {})
+
+    def test_legacy_pickle(self):
+        """兼容旧的pickle+base64格式，但不允许加载任何类和函数"""
+        legacy = base64.b64encode(pickle.dumps(self.cart_dict)).decode()
+        self.assertEqual(decode_cookie_cart(legacy), self.cart_dict)
+
+        evil = base64.b64encode(pickle.dumps(print)).decode()
+        self.assertEqual(decode_cookie_cart(evil), {})
+
+    def test_legacy_invalid_items(self):
+        """旧格式中sku_id或count不是正整数的记录被忽略，解析结果可以重新编码"""
+        cart_dict = {
+            1: {'count': -3, 'selected': True},
+            -2: {'count': 1, 'selected': True},
+            0: {'count': 1, 'selected': False},
+            3: {'count': 0, 'selected': True},
+            4: {'count': '2', 'selected': True},
+            5: {'count': 2, 'selected': False},
+        }
+        legacy = base64.b64encode(pickle.dumps(cart_dict)).decode()
+        res = decode_cookie_cart(legacy)
+
+        self.assertEqual(res, {5: {'count': 2, 'selected': False}})
+        self.assertEqual(decode_cookie_cart(encode_cookie_cart(res)), res)
+
+
+class RedisCartMergeTest(RedisTestCase):
+    def test_merge(self):
+        """累加合并不超过数量上限，同一个token只合并一次"""
+        for user_id, cart_class in enumerate((RedisCart, PackedRedisCart), 1):
+            redis_cart = cart_class(user_id)
+            redis_cart.update(1, 3, False)
+            redis_cart.update(2, 1, True)
+
+            cart_dict = {
+                1: {'count': 2, 'selected': True},
+                2: {'count': 5, 'selected': False},
+                3: {'count': 1, 'selected': True},
+            }
+            token = 'token'
+            self.assertEqual(redis_cart.merge(cart_dict, 'sum', {1: 10, 2: 4}, token), 3)
+            self.assertEqual(redis_cart.merge(cart_dict, 'sum', {1: 10, 2: 4}, token), -1)
+
+            self.assertEqual(redis_cart.get_cart(), {
+                1: {'count': 5, 'selected': True},
+                2: {'count': 4, 'selected': False},
+                3: {'count': 1, 'selected': True},
+            })
+
+            redis_cart.merge({1: {'count': 2, 'selected': False}}, 'overwrite')
+            self.assertEqual(redis_cart.get_cart()[1], {'count': 2, 'selected': False})
+
+
+class RedisCartSummaryTest(RedisTestCase):
+    def test_incremental_summary(self):
+        """每次修改购物车之后增量更新的汇总数据与重新计算的结果一致"""
+        goods = create_goods_with_skus(1, 3)
+        sku1, sku2, sku3 = goods.sku_set.order_by('id')
+        SKU.objects.filter(id=sku2.id).update(price=Decimal('99.9'))
+
+        for user_id, cart_class in enumerate((RedisCart, PackedRedisCart), 1):
+            redis_cart = cart_class(user_id)
+
+            redis_cart.add(sku1.id, 2, True)
+            # 第一次查询时计算汇总数据，之后的修改增量更新
+            self.assertEqual(redis_cart.get_summary()['selected_amount'], Decimal('2000.00'))
+
+            redis_cart.add(sku2.id, 3, True)
+            redis_cart.update(sku1.id, 1, False)
+            redis_cart.merge({sku3.id: {'count': 1, 'selected': True}}, 'sum')
+            redis_cart.remove(sku3.id)
+            redis_cart.select_all(True)
+
+            summary = redis_cart.get_summary()
+            self.assertEqual(summary, {
+                'total_count': 4,
+                'selected_count': 4,
+                'selected_amount': Decimal('1299.70'),
+            })
+            self.assertEqual(list(redis_cart.rebuild_summary(get_sku_price_version())), [4, 4, 129970])
+
+    def test_rebuild_after_price_changed(self):
+        """价格版本号变化之后按数据库中的价格重新计算，不使用未失效的sku摘要缓存"""
+        goods = create_goods_with_skus(1, 1)
+        sku = goods.sku_set.get()
+
+        for user_id, cart_class in enumerate((RedisCart, PackedRedisCart), 1):
+            redis_cart = cart_class(user_id)
+            redis_cart.add(sku.id, 2, True)
+            self.assertEqual(redis_cart.get_summary()['selected_amount'], Decimal('2000.00'))
+
+        SKU.objects.filter(id=sku.id).update(price=Decimal('800'))
+        incr_sku_price_version()
+
+        for user_id, cart_class in enumerate((RedisCart, PackedRedisCart), 1):
+            self.assertEqual(cart_class(user_id).get_summary()['selected_amount'], Decimal('1600.00'))
+
+    def test_write_after_price_changed(self):
+        """修改购物车时按数据库中的价格更新汇总数据；单价在价格变化之前读取时删除汇总数据，查询时重新计算"""
+        goods = create_goods_with_skus(1, 1)
+        sku = goods.sku_set.get()
+
+        for user_id, cart_class in enumerate((RedisCart, PackedRedisCart), 1):
+            redis_cart = cart_class(user_id)
+            redis_cart.add(sku.id, 1, True)
+            self.assertEqual(redis_cart.get_summary()['selected_amount'], Decimal('1000.00'))
+
+            # sku摘要缓存中还是旧的价格
+            get_sku_summaries([sku.id])
+            SKU.objects.filter(id=sku.id).update(price=Decimal('800'))
+            incr_sku_price_version()
+            self.assertEqual(redis_cart.get_summary()['selected_amount'], Decimal('800.00'))
+
+            redis_cart.add(sku.id, 1, True)
+            self.assertEqual(redis_cart.get_summary()['selected_amount'], Decimal('1600.00'))
+
+            redis_cart._write('set', [sku.id, 3, 1, 100000], price_version=get_sku_price_version() - 1)
+            self.assertFalse(redis_cart.redis_conn.exists(redis_cart.summary_key))
+            self.assertEqual(redis_cart.get_summary()['selected_amount'], Decimal('2400.00'))
+
+            SKU.objects.filter(id=sku.id).update(price=Decimal('1000'))
+            incr_sku_price_version()
+
+
+class CartBatchTest(RedisTestCase):
+    def test_batch_ops(self):
+        """redis购物车和cookie购物车批量执行操作的结果一致"""
+        goods = create_goods_with_skus(1, 3)
+        sku1, sku2, sku3 = [sku.id for sku in goods.sku_set.order_by('id')]
+        ops = [
+            {'op': 'add', 'sku_id': sku1, 'count': 2, 'selected': False},
+            {'op': 'add', 'sku_id': sku1, 'count': 1, 'selected': True},
+            {'op': 'set', 'sku_id': sku2, 'count': 5, 'selected': True},
+            {'op': 'select', 'sku_id': sku2, 'selected': False},
+            {'op': 'select', 'sku_id': sku3, 'selected': True},
+            {'op': 'remove', 'sku_id': sku3},
+        ]
+        expected = {
+            sku1: {'count': 3, 'selected': True},
+            sku2: {'count': 5, 'selected': False},
+        }
+
+        self.assertEqual(apply_cart_ops({sku3: {'count': 1, 'selected': False}}, ops), expected)
+
+        for user_id, cart_class in enumerate((RedisCart, PackedRedisCart), 1):
+            redis_cart = cart_class(user_id)
+            redis_cart.update(sku3, 1, False)
+
+            self.assertEqual(redis_cart.batch(ops), expected)
+            self.assertEqual(redis_cart.get_summary()['total_count'], 8)
+
+    def test_validate_total_count(self):
+        """按执行所有操作之后的数量(包括购物车中已有的数量)校验库存"""
+        goods = create_goods_with_skus(1, 1)
+        sku_id = goods.sku_set.get().id
+        SKU.objects.filter(id=sku_id).update(stock=5)
+
+        ops = [{'op': 'add', 'sku_id': sku_id, 'count': 3}, {'op': 'add', 'sku_id': sku_id, 'count': 3}]
+        self.assertFalse(CartBatchSerializer(data={'ops': ops}).is_valid())
+
+        ops = [{'op': 'add', 'sku_id': sku_id, 'count': 2}]
+        cart_dict = {sku_id: {'count': 3, 'selected': True}}
+        self.assertTrue(CartBatchSerializer(data={'ops': ops}, context={'cart_dict': cart_dict}).is_valid())
+        cart_dict[sku_id]['count'] = 4
+        self.assertFalse(CartBatchSerializer(data={'ops': ops}, context={'cart_dict': cart_dict}).is_valid())
+        self.assertEqual(cart_dict[sku_id]['count'], 4)
+
+
+class PackedRedisCartMigrateTest(RedisTestCase):
+    def test_migrate_and_unpack(self):
+        """两种格式的记录互相转换时合并数量(取较大值)，并重新计算汇总数据"""
+        packed_cart = PackedRedisCart(1)
+        packed_cart.update(1, 5, False)
+        packed_cart.update(2, 1, True)
+        self.assertEqual(packed_cart.get_summary()['total_count'], 6)
+
+        # 回退之后写入旧格式的记录
+        split_cart = RedisCart(1)
+        split_cart.update(1, 2, True)
+        split_cart.update(2, 3, False)
+        split_cart.update(3, 1, True)
+
+        expected = {
+            1: {'count': 5, 'selected': True},
+            2: {'count': 3, 'selected': False},
+            3: {'count': 1, 'selected': True},
+        }
+        self.assertEqual(packed_cart.get_cart(), expected)
+        self.assertEqual(packed_cart.get_summary()['total_count'], 9)
+        self.assertFalse(split_cart.redis_conn.exists(split_cart.cart_key))
+
+        split_cart.update(2, 4, True)
+        call_command('migrate_cart_format', unpack=True, stdout=StringIO())
+        expected[2] = {'count': 4, 'selected': True}
+        self.assertEqual(split_cart.get_cart(), expected)
+        self.assertEqual(split_cart.get_summary()['total_count'], 10)
+        self.assertFalse(packed_cart.redis_conn.exists(packed_cart.keys[0]))
+
+
+class GcRedisCartsTest(RedisTestCase):
+    def test_collect(self):
+        """删除没有有效期的购物车(包括单独残留的key)，已设置有效期的记录不处理"""
+        redis_conn = RedisCart(1).redis_conn
+        redis_conn.hset('cart_1', 1, 2)
+        redis_conn.sadd('cart_selected_2', 1)
+        redis_conn.hset('cart_summary_3', 'total_count', 1)
+        redis_conn.hset('cart_4', 1, 2)
+        redis_conn.expire('cart_4', 60)
+
+        call_command('gc_redis_carts', idle_days=0, skip_histories=True, stdout=StringIO())
+
+        self.assertEqual(redis_conn.keys('cart_*'), [b'cart_4'])
+
+    def test_archive_without_migrate(self):
+        """归档时读取两种存储格式的记录，不转换存储格式"""
+        user = User.objects.create_user('archive_test', password='12345678', mobile='13000000000')
+        goods = create_goods_with_skus(1, 2)
+        sku1, sku2 = [sku.id for sku in goods.sku_set.order_by('id')]
+
+        redis_conn = RedisCart(user.id).redis_conn
+        redis_conn.hset('cart_%s' % user.id, sku1, 2)
+        redis_conn.sadd('cart_selected_%s' % user.id, sku1)
+        redis_conn.hset('cart_packed_%s' % user.id, sku1, PackedRedisCart.pack(3, False))
+        redis_conn.hset('cart_packed_%s' % user.id, sku2, PackedRedisCart.pack(1, True))
+
+        self.assertEqual(read_carts(redis_conn, [user.id]), {user.id: {
+            sku1: {'count': 3, 'selected': True},
+            sku2: {'count': 1, 'selected': True},
+        }})
+
+        Command().archive_carts(redis_conn, [user.id])
+        self.assertEqual(CartArchive.objects.filter(user=user).count(), 2)
+        self.assertEqual(redis_conn.hlen('cart_%s' % user.id), 1)
+        self.assertEqual(redis_conn.ttl('cart_packed_%s' % user.id), -1)
+
+    def test_sliding_expires(self):
+        """每次写操作都重新设置购物车相关key的有效期"""
+        for user_id, cart_class in enumerate((RedisCart, PackedRedisCart), 1):
+            redis_cart = cart_class(user_id)
+            redis_cart.update(1, 2, True)
+            redis_cart.get_summary()
+
+            for key in redis_cart.keys:
+                if redis_cart.redis_conn.exists(key):
+                    ttl = redis_cart.redis_conn.ttl(key)
+                    self.assertTrue(settings.CART_EXPIRES - 10 < ttl <= settings.CART_EXPIRES)
+
 if __name__ == "__main__":
     cookie_cart = 'gAN9cQAoSwF9cQEoWAgAAABzZWxlY3RlZHECiFgFAAAAY291bnRxA0sCdUsDfXEEKGgCiWgDSwF1dS4='
 
@@ -1,11 +1,43 @@
-import base64
-import pickle
+import hashlib
 
-from django_redis import get_redis_connection
+from django.conf import settings
+
+from cart.codec import decode_cookie_cart
+from cart.storage import get_redis_cart
+from goods.utils import get_sku_stocks
+
+
+def apply_cart_ops(cart_dict, ops):
+    """
+    按顺序对cookie购物车记录执行多个操作，与redis购物车的batch()结果一致:
+    ops: [{'op': '<add/set/remove/select>', 'sku_id':, 'count':, 'selected':}, ...]
+    """
+    for op in ops:
+        sku_id = op['sku_id']
+
+        if op['op'] == 'add':
+            if sku_id in cart_dict:
+                cart_dict[sku_id]['count'] += op['count']
+                cart_dict[sku_id]['selected'] = cart_dict[sku_id]['selected'] or op['selected']
+            else:
+                cart_dict[sku_id] = {'count': op['count'], 'selected': op['selected']}
+        elif op['op'] == 'set':
+            cart_dict[sku_id] = {'count': op['count'], 'selected': op['selected']}
+        elif op['op'] == 'remove':
+            cart_dict.pop(sku_id, None)
+        elif op['op'] == 'select' and sku_id in cart_dict:
+            cart_dict[sku_id]['selected'] = op['selected']
+
+    return cart_dict
 
 
 def merge_cookie_cart_to_redis(request, user, response):
-    """合并cookie购物车记录到redis数据库"""
+    """
+    合并cookie购物车记录到redis数据库:
+    合并在一个lua脚本中完成，按CART_MERGE_POLICY覆盖或累加数量，合并之后的数量不超过商品库存
+    同一份cookie数据只合并一次，登录请求超时重试时不会重复累加
+    每次写入的cookie数据都带有随机nonce，之后重新加入相同的商品时cookie数据不同，仍然会合并
+    """
     # 获取cookie中的购物车记录
     cookie_cart = request.COOKIES.get('cart') # None
 
@@ -21,64 +53,21 @@ def merge_cookie_cart_to_redis(request, user, response):
     #     },
     #     ...
     # }
-    cart_dict = pickle.loads(base64.b64decode(cookie_cart)) # {}
+    cart_dict = decode_cookie_cart(cookie_cart) # {}
 
-    if not cookie_cart:
+    if not cart_dict:
         # 字典为空，cookie购物车无数据
         return
 
-    # 组织数据
-    # 保存cookie购物车记录中所有商品的id和对应数量count，此数据在进行合并时需要添加到redis hash元素中
-    # {
-    #     '<sku_id>': '<count>',
-    #     ...
-    # }
-    cart = {}
-
-    # 保存cookie购物车记录中被勾选的商品的id，此数据在进行合并时需要添加的redis set元素中
-    redis_selected_add = []
-
-    # 保存cookie购物车记录中未被勾选的商品的id，此数据在进行合并时需要从redis set元素移除
-    redis_selected_remove = []
-
-    for sku_id, count_selected in cart_dict.items():
-        cart[sku_id] = count_selected['count']
-
-        if count_selected['selected']:
-            # 勾选
-            redis_selected_add.append(sku_id)
-        else:
-            # 未勾选
-            redis_selected_remove.append(sku_id)
+    # 商品库存作为合并之后的数量上限，已删除的商品不再合并
+    # 库存为0的商品仍然保留1件，结算时再提示库存不足
+    stocks = get_sku_stocks(cart_dict.keys())
+    cart_dict = {sku_id: count_selected for sku_id, count_selected in cart_dict.items() if sku_id in stocks}
+    caps = {sku_id: max(stocks[sku_id]['stock'], 1) for sku_id in cart_dict}
 
     # 进行合并
-    redis_conn = get_redis_connection('cart')
-
-    # 将`cart`字典中的key和value作为属性和值添加到redis hash元素中
-    cart_key = 'cart_%s' % user.id
-
-    # hmset(key, dict): 将字典中的key和value作为属性和值添加到redis hash元素中，如果属性已存在，会对值进行覆盖
-    redis_conn.hmset(cart_key, cart)
-
-    cart_selected_key = 'cart_selected_%s' % user.id
-    # 将`redis_selected_add`中所有商品的id添加到redis set元素中
-    if redis_selected_add:
-        redis_conn.sadd(cart_selected_key, *redis_selected_add)
-
-    # 将`redis_selected_remove`中所有商品的id从redis set元素移除
-    if redis_selected_remove:
-        redis_conn.srem(cart_selected_key, *redis_selected_remove)
+    token = hashlib.md5(cookie_cart.encode()).hexdigest()
+    get_redis_cart(user.id).merge(cart_dict, settings.CART_MERGE_POLICY, caps, token)
 
     # 清除cookie中购物车
     response.delete_cookie('cart')
-
-
-
-
-
-
-
-
-
-
-
@@ -1,19 +1,127 @@
-import base64
-import pickle
+from decimal import Decimal
 
 from django.shortcuts import render
-from django_redis import get_redis_connection
 from rest_framework import status
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
 from cart import constants
-from cart.serializers import CartSerializer, CartSKUSerializer, CartDelSerializer, CartSelectAllSerializer
-from goods.models import SKU
+from cart.codec import encode_cookie_cart, decode_cookie_cart
+from cart.storage import get_redis_cart, get_sku_prices
+from cart.serializers import CartSerializer, CartSKUSerializer, CartDelSerializer, CartSelectAllSerializer, \
+    CartBatchSerializer
+from cart.utils import apply_cart_ops
+from goods.utils import get_sku_summaries, get_sku_summary_map
 
 # Create your views here.
 
 
+# PATCH /cart/batch/
+class CartBatchView(APIView):
+    def perform_authentication(self, request):
+        """让当前视图跳过DRF框架的认证过程"""
+        pass
+
+    def patch(self, request):
+        """
+        购物车记录批量修改:
+        1. 获取当前的购物车记录，获取操作列表并进行校验(所有商品一次性校验是否存在，执行所有操作之后的数量是否超过库存)
+        2. 一次获取操作和购物车中所有商品的摘要数据，用于计算单价和返回应答
+        3. 按顺序执行所有操作
+            3.1 如果用户已登录，在一个lua脚本中修改redis中的购物车记录，并返回修改之后的购物车记录
+            3.2 如果用户未登录，修改cookie中的购物车记录
+        4. 返回修改之后的购物车记录
+        """
+        try:
+            user = request.user
+        except Exception as e:
+            user = None
+
+        # 1. 获取当前的购物车记录，获取操作列表并进行校验
+        if user is not None and user.is_authenticated:
+            redis_cart = get_redis_cart(user.id)
+            cart_dict = redis_cart.get_cart()
+        else:
+            redis_cart = None
+            cookie_cart = request.COOKIES.get('cart')
+            cart_dict = decode_cookie_cart(cookie_cart) if cookie_cart else {}
+
+        serializer = CartBatchSerializer(data=request.data, context={'cart_dict': cart_dict})
+        serializer.is_valid(raise_exception=True)
+
+        # 获取校验之后的操作列表
+        # [{'op': '<add/set/remove/select>', 'sku_id':, 'count':, 'selected':}, ...]
+        ops = serializer.validated_data['ops']
+
+        # 2. 一次获取所有商品的摘要数据
+        summaries = get_sku_summary_map(set(cart_dict) | set(op['sku_id'] for op in ops))
+
+        # 3. 按顺序执行所有操作
+        if redis_cart is not None:
+            # 3.1 如果用户已登录，在一个lua脚本中修改redis中的购物车记录(与redis只交互一次)
+            cart_dict = redis_cart.batch(ops)
+            cookie_cart = None
+        else:
+            # 3.2 如果用户未登录，修改cookie中的购物车记录
+            cart_dict = apply_cart_ops(cart_dict, ops)
+            cookie_cart = encode_cookie_cart(cart_dict)
+
+        # 4. 返回修改之后的购物车记录
+        skus = [dict(summaries[sku_id]) for sku_id in cart_dict if sku_id in summaries]
+
+        for sku in skus:
+            sku['count'] = cart_dict[sku['id']]['count']
+            sku['selected'] = cart_dict[sku['id']]['selected']
+
+        response = Response(CartSKUSerializer(skus, many=True).data)
+        if cookie_cart is not None:
+            response.set_cookie('cart', cookie_cart, max_age=constants.CART_COOKIE_EXPIRES)
+        return response
+
+
+# GET /cart/summary/
+class CartSummaryView(APIView):
+    def perform_authentication(self, request):
+        """让当前视图跳过DRF框架的认证过程"""
+        pass
+
+    def get(self, request):
+        """
+        获取购物车汇总数据(商品总数量、勾选商品的总数量和总金额):
+        1. 如果用户已登录，从redis中获取增量维护的汇总数据
+        2. 如果用户未登录，根据cookie中的购物车记录和sku缓存中的价格计算
+        3. 返回应答
+        """
+        try:
+            user = request.user
+        except Exception as e:
+            user = None
+
+        if user is not None and user.is_authenticated:
+            # 1. 如果用户已登录，从redis中获取增量维护的汇总数据
+            return Response(get_redis_cart(user.id).get_summary())
+
+        # 2. 如果用户未登录，根据cookie中的购物车记录和sku缓存中的价格计算
+        cookie_cart = request.COOKIES.get('cart')
+        cart_dict = decode_cookie_cart(cookie_cart) if cookie_cart else {}
+
+        prices = get_sku_prices(cart_dict.keys())
+
+        total_count = selected_count = selected_amount = 0
+        for sku_id, count_selected in cart_dict.items():
+            total_count += count_selected['count']
+            if count_selected['selected']:
+                selected_count += count_selected['count']
+                selected_amount += count_selected['count'] * prices[int(sku_id)]
+
+        # 3. 返回应答
+        return Response({
+            'total_count': total_count,
+            'selected_count': selected_count,
+            'selected_amount': (Decimal(selected_amount) / 100).quantize(Decimal('0.01'))
+        })
+
+
 # PUT /cart/selection/
 class CartSelectAllView(APIView):
     def perform_authentication(self, request):
@@ -44,22 +152,8 @@ class CartSelectAllView(APIView):
         # 2. 设置用户购物车记录的勾选状态(全选和全不选)
         if user is not None and user.is_authenticated:
             # 2.1 如果用户已登录，操作redis中的购物车记录
-            redis_conn = get_redis_connection('cart')
-
-            # 从redis hash元素中获取用户购物车添加的所有商品的id
-            cart_key = 'cart_%s' % user.id
-
-            # hkeys(key): 获取hash元素中所有是属性
-            # [b'<sku_id>', b'<sku_id>', ...]
-            sku_ids = redis_conn.hkeys(cart_key)
-
-            cart_selected_key = 'cart_selected_%s' % user.id
-            if selected:
-                # 全选
-                redis_conn.sadd(cart_selected_key, *sku_ids)
-            else:
-                # 全不选
-                redis_conn.srem(cart_selected_key, *sku_ids)
+            # 全选和全不选(在redis服务端原子完成)
+            get_redis_cart(user.id).select_all(selected)
 
             # 返回应答
             return Response({'message': 'OK'})
@@ -77,7 +171,7 @@ class CartSelectAllView(APIView):
                 #     },
                 #     ...
                 # }
-                cart_dict = pickle.loads(base64.b64decode(cookie_cart))
+                cart_dict = decode_cookie_cart(cookie_cart)
             else:
                 cart_dict = {}
 
@@ -87,7 +181,7 @@ class CartSelectAllView(APIView):
 
             # 3. 返回应答，操作成功
             response = Response({'message': 'OK'})
-            cart_data = base64.b64encode(pickle.dumps(cart_dict)).decode()
+            cart_data = encode_cookie_cart(cart_dict)
             response.set_cookie('cart', cart_data, max_age=constants.CART_COOKIE_EXPIRES)
             return response
 
@@ -123,22 +217,7 @@ class CartView(APIView):
         # 2. 删除购物车记录
         if user is not None and user.is_authenticated:
             # 2.1 如果用户已登录，删除redis中对应的购物车记录
-            redis_conn = get_redis_connection('cart')
-            pl = redis_conn.pipeline()
-
-            # 在redis hash元素中删除对应商品的sku_id和数量count
-            cart_key = 'cart_%s' % user.id
-
-            # hdel(key, *fields): 删除hash中指定的属性field和其对应值，有则删除，无则忽略
-            pl.hdel(cart_key, sku_id)
-
-            # 在redis set元素中删除商品的勾选状态
-            cart_selected_key = 'cart_selected_%s' % user.id
-
-            # srem(key, *members): 从set集合中移除元素，有则移除，无则忽略
-            pl.srem(cart_selected_key, sku_id)
-
-            pl.execute()
+            get_redis_cart(user.id).remove(sku_id)
 
             # 返回应答
             return Response(status=status.HTTP_204_NO_CONTENT)
@@ -160,7 +239,7 @@ class CartView(APIView):
             #     },
             #     ...
             # }
-            cart_dict = pickle.loads(base64.b64decode(cookie_cart)) # {}
+            cart_dict = decode_cookie_cart(cookie_cart) # {}
 
             if not cart_dict:
                 # 字典为空，购物车无数据
@@ -170,7 +249,7 @@ class CartView(APIView):
             if sku_id in cart_dict:
                 del cart_dict[sku_id]
                 # 处理cookie购物车数据
-                cart_data = base64.b64encode(pickle.dumps(cart_dict)).decode()
+                cart_data = encode_cookie_cart(cart_dict)
                 response.set_cookie('cart', cart_data, max_age=constants.CART_COOKIE_EXPIRES)
 
             # 3. 返回应答，购物车删除添加成功
@@ -203,27 +282,7 @@ class CartView(APIView):
         # 2. 修改用户的购物车记录
         if user is not None and user.is_authenticated:
             # 2.1 如果用户已登录，在redis中修改用户的购物车记录
-            redis_conn = get_redis_connection('cart')
-            pl = redis_conn.pipeline()
-
-            # 在redis hash修改用户购物车中对应商品数量count
-            cart_key = 'cart_%s' % user.id
-
-            # hset(key, field, value): 设置hash中指定属性field的值为value
-            pl.hset(cart_key, sku_id, count)
-
-            # 在redis set修改用户购物车中勾选状态
-            cart_selected_key = 'cart_selected_%s' % user.id
-            if selected:
-                # 勾选
-                # sadd(key, *members): 向set集合中添加元素，元素是唯一的
-                pl.sadd(cart_selected_key, sku_id)
-            else:
-                # 取消勾选
-                # srem(key, *members): 从set集合中移除元素，有则移除，无则忽略
-                pl.srem(cart_selected_key, sku_id)
-
-            pl.execute()
+            get_redis_cart(user.id).update(sku_id, count, selected)
 
             # 返回响应
             return Response(serializer.data)
@@ -245,7 +304,7 @@ class CartView(APIView):
             #     },
             #     ...
             # }
-            cart_dict = pickle.loads(base64.b64decode(cookie_cart)) # {}
+            cart_dict = decode_cookie_cart(cookie_cart) # {}
 
             if not cart_dict:
                 # 字典为空，购物车无数据
@@ -258,7 +317,7 @@ class CartView(APIView):
             }
 
             # 3. 返回应答，购物车记录修改成功
-            cart_data = base64.b64encode(pickle.dumps(cart_dict)).decode()
+            cart_data = encode_cookie_cart(cart_dict)
             response.set_cookie('cart', cart_data, max_age=constants.CART_COOKIE_EXPIRES)
             return response
 
@@ -279,25 +338,6 @@ class CartView(APIView):
         # 1. 获取用户购物车记录
         if user is not None and user.is_authenticated:
             # 1.1 如果用户已登录，从redis中获取用户的购物车记录
-            redis_conn = get_redis_connection('cart')
-
-            # 从redis hash中获取登录用户购物车添加的商品的sku_id和对应数量count
-            cart_key = 'cart_%s' % user.id
-            # hgetall(key): 获取hash中所有的属性和值
-            # {
-            #     b'<sku_id>': b'<count>',
-            #     b'<sku_id>': b'<count>',
-            #     ...
-            # }
-            cart_redis = redis_conn.hgetall(cart_key)
-
-            # 从redis set中获取登录用户购物车记录中被勾选的商品的sku_id
-            cart_selected_key = 'cart_selected_%s' % user.id
-            # smembers(key): 获取set中所有元素
-            # (b'<sku_id>', b'<sku_id>', ...)
-            cart_selected_redis = redis_conn.smembers(cart_selected_key)
-
-            # 组织数据
             # {
             #     '<sku_id>': {
             #         'count': '<count>',
@@ -305,13 +345,7 @@ class CartView(APIView):
             #     },
             #     ...
             # }
-            cart_dict = {}
-
-            for sku_id, count in cart_redis.items():
-                cart_dict[int(sku_id)] = {
-                    'count': int(count),
-                    'selected': sku_id in cart_selected_redis
-                }
+            cart_dict = get_redis_cart(user.id).get_cart()
         else:
             # 1.2 如果用户未登录，从cookie中获取用户的购物车记录
             # 获取cookie购物车原始数据
@@ -326,19 +360,18 @@ class CartView(APIView):
                 #     },
                 #     ...
                 # }
-                cart_dict = pickle.loads(base64.b64decode(cookie_cart))
+                cart_dict = decode_cookie_cart(cookie_cart)
             else:
                 cart_dict = {}
 
         # 2. 根据用户购物车中商品的sku_id获取对应商品的数据
-        sku_ids = cart_dict.keys()
-        skus = SKU.objects.filter(id__in=sku_ids)
+        skus = get_sku_summaries(cart_dict.keys())
 
         for sku in skus:
-            # 给sku对象增加属性count和selected
+            # 给sku增加count和selected
             # 分别保存当前商品在购物车中添加数量和勾选状态
-            sku.count = cart_dict[sku.id]['count']
-            sku.selected = cart_dict[sku.id]['selected']
+            sku['count'] = cart_dict[sku['id']]['count']
+            sku['selected'] = cart_dict[sku['id']]['selected']
 
         # 3. 将商品的数据序列化并返回
         serializer = CartSKUSerializer(skus, many=True)
@@ -372,24 +405,8 @@ class CartView(APIView):
         # 2. 保存用户的购物车记录数据
         if user is not None and user.is_authenticated:
             # 2.1 如果用户已登录，在redis中保存用户的购物车记录
-            redis_conn = get_redis_connection('cart')
-            pl = redis_conn.pipeline()
-
-            # 在redis hash元素中存储用户添加的商品sku_id和对应数量count
-            cart_key = 'cart_%s' % user.id
-
             # 如果用户的购物车记录中已经添加过该商品，商品的对应数量需要进行累加，否则直接添加新元素
-            # hincrby(key, field, count): 给hash中指定属性field的值累加count，如果field不存在，新建属性和值
-            pl.hincrby(cart_key, sku_id, count)
-
-            # 在redis set元素中存储用户添加购物车记录时勾选商品sku_id
-            cart_selected_key = 'cart_selected_%s' % user.id
-            if selected:
-                # 勾选
-                # sadd(key, *members): 向set集合中添加元素，元素是唯一的
-                pl.sadd(cart_selected_key, sku_id)
-
-            pl.execute()
+            get_redis_cart(user.id).add(sku_id, count, selected)
 
             # 返回应答
             return Response(serializer.data, status=status.HTTP_201_CREATED)
@@ -407,7 +424,7 @@ class CartView(APIView):
                 #     },
                 #     ...
                 # }
-                cart_dict = pickle.loads(base64.b64decode(cookie_cart))
+                cart_dict = decode_cookie_cart(cookie_cart)
             else:
                 cart_dict = {}
 
@@ -424,6 +441,6 @@ class CartView(APIView):
             # 3. 返回应答，购物车记录添加成功
             response = Response(serializer.data, status=status.HTTP_201_CREATED)
             # 设置cookie购物车数据
-            cart_data = base64.b64encode(pickle.dumps(cart_dict)).decode()
+            cart_data = encode_cookie_cart(cart_dict)
             response.set_cookie('cart', cart_data, max_age=constants.CART_COOKIE_EXPIRES)
             return response
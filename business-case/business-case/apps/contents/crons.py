@@ -1,56 +1,72 @@
-import os
 import time
-from collections import OrderedDict
 
 from django.conf import settings
+from django_redis import get_redis_connection
 
-from contents.models import ContentCategory
-from goods.models import GoodsChannel
+from contents.models import ContentCategory, Content
+from goods.utils import get_categories
+from meiduo_mall.utils.static_html import write_static_html
 
+# 首页数据版本号，广告或商品频道数据变化时递增
+INDEX_HTML_VERSION_KEY = 'index_html_version'
+# 最近一次生成首页时的数据版本号
+INDEX_HTML_RENDERED_VERSION_KEY = 'index_html_rendered_version'
+# 已安排生成首页任务的标记
+INDEX_HTML_SCHEDULED_KEY = 'index_html_scheduled'
+
+
+def mark_index_html_dirty():
+    """首页数据发生变化: 递增数据版本号，并在合并窗口结束时重新生成首页"""
+    redis_conn = get_redis_connection('default')
+    window = settings.GENERATE_STATIC_HTML_COALESCE_WINDOW
+
+    pl = redis_conn.pipeline()
+    pl.incr(INDEX_HTML_VERSION_KEY)
+    pl.set(INDEX_HTML_SCHEDULED_KEY, 1, ex=window, nx=True)
+    scheduled = pl.execute()[1]
+
+    if scheduled:
+        from celery_tasks.html.tasks import generate_static_index_html as generate_static_index_html_task
+        generate_static_index_html_task.apply_async(countdown=window)
+
+
+def generate_static_index_html(force=False):
+    """
+    生成静态index.html页面:
+    只有首页数据版本号发生变化时才重新生成，force=True时强制生成
+    """
+    redis_conn = get_redis_connection('default')
+    version, rendered_version = redis_conn.mget(INDEX_HTML_VERSION_KEY, INDEX_HTML_RENDERED_VERSION_KEY)
+
+    if version is None:
+        # 首次运行，初始化数据版本号
+        redis_conn.setnx(INDEX_HTML_VERSION_KEY, 0)
+        version = b'0'
+
+    if not force and version == rendered_version:
+        # 数据未变化，无需重新生成
+        return
 
-def generate_static_index_html():
-    """生成静态index.html页面"""
     # 从数据库中查询出首页所需的`商品分类`数据和`广告`数据
     print('%s: generate_static_index_html' % time.ctime())
     # 商品频道及分类菜单
-    # 使用有序字典保存类别的顺序
-    # categories = {
-    #     1: { # 组1
-    #         'channels': [{'id':, 'name':, 'url':},{}, {}...],
-    #         'sub_cats': [{'id':, 'name':, 'sub_cats':[{},{}]}, {}, {}, ..]
-    #     },
-    #     2: { # 组2
-    #
-    #     }
-    # }
-    categories = OrderedDict()
-    channels = GoodsChannel.objects.order_by('group_id', 'sequence')
-    for channel in channels:
-        group_id = channel.group_id  # 当前组
-
-        if group_id not in categories:
-            categories[group_id] = {'channels': [], 'sub_cats': []}
-
-        cat1 = channel.category  # 当前频道的类别
-
-        # 追加当前频道
-        categories[group_id]['channels'].append({
-            'id': cat1.id,
-            'name': cat1.name,
-            'url': channel.url
-        })
-        # 构建当前类别的子类别
-        for cat2 in cat1.goodscategory_set.all():
-            cat2.sub_cats = []
-            for cat3 in cat2.goodscategory_set.all():
-                cat2.sub_cats.append(cat3)
-            categories[group_id]['sub_cats'].append(cat2)
+    categories = get_categories()
 
     # 广告内容
+    # {
+    #     '<类别键名>': [content, content, ...],
+    #     ...
+    # }
     contents = {}
     content_categories = ContentCategory.objects.all()
+    category_keys = {}
     for cat in content_categories:
-        contents[cat.key] = cat.content_set.filter(status=True).order_by('sequence')
+        category_keys[cat.id] = cat.key
+        contents[cat.key] = []
+
+    # 一次查询出所有展示的广告内容
+    for content in Content.objects.filter(status=True).order_by('category_id', 'sequence'):
+        contents[category_keys[content.category_id]].append(content)
 
     # 使用`index.html`模板文件，给模板文件传递数据，进行模板渲染，获取渲染之后html页面
     context = {
@@ -66,10 +82,8 @@ def generate_static_index_html():
     # 模板渲染: 给模板文件传数据，进行模板渲染，获取渲染之后的html页面内容
     res_html = temp.render(context)
 
-    # 将渲染之后的html页面保存成一个静态页面
-    save_path = os.path.join(settings.GENERATED_STATIC_HTML_FILES_DIR, 'index.html')
-
-    with open(save_path, 'w', encoding='utf-8') as f:
-        f.write(res_html)
-
+    # 将渲染之后的html页面保存成一个静态页面(内容未变化时不重写)
+    write_static_html('index.html', res_html)
 
+    # 记录本次生成所对应的数据版本号
+    redis_conn.set(INDEX_HTML_RENDERED_VERSION_KEY, version)
@@ -0,0 +1,20 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from contents.crons import mark_index_html_dirty
+from contents.models import ContentCategory, Content
+from goods.models import GoodsChannel, GoodsCategory
+from meiduo_mall.utils.db import on_commit_once
+
+
+@receiver(post_save, sender=Content)
+@receiver(post_delete, sender=Content)
+@receiver(post_save, sender=ContentCategory)
+@receiver(post_delete, sender=ContentCategory)
+@receiver(post_save, sender=GoodsChannel)
+@receiver(post_delete, sender=GoodsChannel)
+@receiver(post_save, sender=GoodsCategory)
+@receiver(post_delete, sender=GoodsCategory)
+def index_data_changed(sender, **kwargs):
+    """首页所使用的数据发生变化，在事务提交时标记首页需要重新生成(同一个事务中只标记一次)"""
+    on_commit_once(mark_index_html_dirty)
@@ -10,35 +10,35 @@ class SKUAdmin(admin.ModelAdmin):
         # 数据保存
         obj.save()
 
-        # 附加操作: 发出重新生成指定商品的详情页面的任务消息
-        from celery_tasks.html.tasks import generate_static_sku_detail_html
-        generate_static_sku_detail_html.delay(obj.id)
+        # 附加操作: 发出重新生成该商品(SPU)下所有SKU详情页面的任务消息
+        from celery_tasks.html.tasks import request_static_goods_detail_html
+        request_static_goods_detail_html(obj.goods_id)
 
 
 class SKUSpecificationAdmin(admin.ModelAdmin):
     def save_model(self, request, obj, form, change):
         obj.save()
 
-        # 附加操作: 发出重新生成指定商品的详情页面的任务消息
-        from celery_tasks.html.tasks import generate_static_sku_detail_html
-        generate_static_sku_detail_html.delay(obj.sku.id)
+        # 附加操作: 发出重新生成该商品(SPU)下所有SKU详情页面的任务消息
+        from celery_tasks.html.tasks import request_static_goods_detail_html
+        request_static_goods_detail_html(obj.sku.goods_id)
 
     def delete_model(self, request, obj):
-        sku_id = obj.sku.id
+        goods_id = obj.sku.goods_id
         obj.delete()
 
-        # 附加操作: 发出重新生成指定商品的详情页面的任务消息
-        from celery_tasks.html.tasks import generate_static_sku_detail_html
-        generate_static_sku_detail_html.delay(sku_id)
+        # 附加操作: 发出重新生成该商品(SPU)下所有SKU详情页面的任务消息
+        from celery_tasks.html.tasks import request_static_goods_detail_html
+        request_static_goods_detail_html(goods_id)
 
 
 class SKUImageAdmin(admin.ModelAdmin):
     def save_model(self, request, obj, form, change):
         obj.save()
 
-        # 附加操作: 发出重新生成指定商品的详情页面的任务消息
-        from celery_tasks.html.tasks import generate_static_sku_detail_html
-        generate_static_sku_detail_html.delay(obj.sku.id)
+        # 附加操作: 发出重新生成该商品(SPU)下所有SKU详情页面的任务消息
+        from celery_tasks.html.tasks import request_static_goods_detail_html
+        request_static_goods_detail_html(obj.sku.goods_id)
 
         # 设置SKU默认图片
         sku = obj.sku
@@ -47,12 +47,12 @@ class SKUImageAdmin(admin.ModelAdmin):
             sku.save()
 
     def delete_model(self, request, obj):
-        sku_id = obj.sku.id
+        goods_id = obj.sku.goods_id
         obj.delete()
 
-        # 附加操作: 发出重新生成指定商品的详情页面的任务消息
-        from celery_tasks.html.tasks import generate_static_sku_detail_html
-        generate_static_sku_detail_html.delay(sku_id)
+        # 附加操作: 发出重新生成该商品(SPU)下所有SKU详情页面的任务消息
+        from celery_tasks.html.tasks import request_static_goods_detail_html
+        request_static_goods_detail_html(goods_id)
 
 
 admin.site.register(models.GoodsCategory)
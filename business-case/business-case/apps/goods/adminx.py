@@ -39,19 +39,19 @@ class SKUSpecificationAdmin(object):
         obj = self.new_obj
         obj.save()
 
-        # 附加操作: 发出重新生成指定商品的详情页面的任务消息
-        from celery_tasks.html.tasks import generate_static_sku_detail_html
-        generate_static_sku_detail_html.delay(obj.sku.id)
+        # 附加操作: 发出重新生成该商品(SPU)下所有SKU详情页面的任务消息
+        from celery_tasks.html.tasks import request_static_goods_detail_html
+        request_static_goods_detail_html(obj.sku.goods_id)
 
     def delete_model(self):
         # 获取删除数据对象
         obj = self.obj
-        sku_id = obj.sku.id
+        goods_id = obj.sku.goods_id
         obj.delete()
 
-        # 附加操作: 发出重新生成指定商品的详情页面的任务消息
-        from celery_tasks.html.tasks import generate_static_sku_detail_html
-        generate_static_sku_detail_html.delay(sku_id)
+        # 附加操作: 发出重新生成该商品(SPU)下所有SKU详情页面的任务消息
+        from celery_tasks.html.tasks import request_static_goods_detail_html
+        request_static_goods_detail_html(goods_id)
 
 
 xadmin.site.register(SKU, SKUAdmin)
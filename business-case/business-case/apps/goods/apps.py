@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class GoodsConfig(AppConfig):
     name = 'goods'
+
+    def ready(self):
+        # 注册商品数据变化的信号处理函数
+        from goods import signals
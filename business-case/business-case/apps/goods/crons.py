@@ -0,0 +1,16 @@
+import time
+
+from goods.stock import reconcile_sku_stocks
+from goods.utils import reconcile_category_sku_counts
+
+
+def reconcile_sku_stock_mirror():
+    """定时对账: 写回预扣的库存，并按数据库修正redis中的库存镜像"""
+    flushed, fixed = reconcile_sku_stocks()
+    print('%s: reconcile_sku_stock_mirror flushed: %s fixed: %s' % (time.ctime(), flushed, fixed))
+
+
+def reconcile_category_sku_count():
+    """定时对账: 按数据库重新统计每个分类下已上架sku的数量"""
+    fixed = reconcile_category_sku_counts()
+    print('%s: reconcile_category_sku_count fixed: %s' % (time.ctime(), fixed))
@@ -0,0 +1,215 @@
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from datetime import datetime, time as dt_time
+from multiprocessing import Pool
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.db.models import Q
+from django.template import loader
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from goods.models import SKU, Goods
+from goods.utils import get_categories, SpecMatrix
+
+logger = logging.getLogger('django')
+
+# 进度记录文件第一行记录的筛选条件，筛选条件不同的进度记录不能继续使用
+CHECKPOINT_HEADER = '# filters: '
+
+# 每个工作进程中只查询一次的数据
+_worker_categories = None
+_worker_temp = None
+
+
+def init_worker():
+    """工作进程初始化: 商品分类菜单和模板每个进程只获取一次"""
+    global _worker_categories, _worker_temp
+    _worker_categories = get_categories()
+    _worker_temp = loader.get_template('detail.html')
+
+
+def render_goods_skus(job):
+    """
+    生成指定商品下指定sku的静态详情页面，单个商品或sku生成失败不影响其他商品:
+    job: (goods_id, [sku_id, ...])
+    :return ([已生成的sku_id, ...], [(生成失败的sku_id, 错误信息), ...])
+    """
+    from celery_tasks.html.tasks import save_static_sku_detail_html
+
+    goods_id, sku_ids = job
+
+    try:
+        goods = Goods.objects.select_related('category1', 'category2', 'category3').get(id=goods_id)
+        goods.channel = goods.category1.goodschannel_set.all()[0]
+
+        spec_matrix = SpecMatrix(goods)
+
+        skus = list(SKU.objects.filter(id__in=sku_ids).prefetch_related('skuimage_set'))
+    except Exception as e:
+        return [], [(sku_id, '%s: %s' % (type(e).__name__, e)) for sku_id in sku_ids]
+
+    done = []
+    failed = []
+    for sku in skus:
+        try:
+            sku.images = sku.skuimage_set.all()
+            save_static_sku_detail_html(sku, goods, _worker_categories, spec_matrix, _worker_temp)
+        except Exception as e:
+            failed.append((sku.id, '%s: %s' % (type(e).__name__, e)))
+        else:
+            done.append(sku.id)
+
+    # 查询期间已被删除的sku不需要生成
+    existing_ids = {sku.id for sku in skus}
+    done.extend(sku_id for sku_id in sku_ids if sku_id not in existing_ids)
+
+    return done, failed
+
+
+class Command(BaseCommand):
+    help = '并行生成商品的静态详情页面，支持断点续传'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=os.cpu_count(), help='工作进程数量')
+        parser.add_argument('--category', type=int, nargs='+', help='只生成指定分类(任意级别)下的商品')
+        parser.add_argument('--goods', type=int, nargs='+', help='只生成指定商品(SPU)下的sku')
+        parser.add_argument('--since', help='只生成该时间之后更新过的sku，格式: YYYY-MM-DD[ HH:MM:SS]')
+        parser.add_argument('--checkpoint', default='static_detail_html.checkpoint',
+                            help='进度记录文件，记录本次的筛选条件，筛选条件不同时不能继续使用')
+        parser.add_argument('--reset', action='store_true', help='忽略已有的进度记录，重新生成')
+
+    def handle(self, *args, **options):
+        checkpoint = options['checkpoint']
+
+        if options['reset'] and os.path.exists(checkpoint):
+            os.remove(checkpoint)
+
+        # 已经生成过的sku
+        filters = self.get_filters(options)
+        done_sku_ids = self.load_checkpoint(checkpoint, filters)
+        if done_sku_ids:
+            self.stdout.write('从进度记录中恢复，跳过%s个已生成的sku' % len(done_sku_ids))
+
+        # 按商品(SPU)对待生成的sku进行分组，同一商品的规格矩阵只需加载一次
+        # {
+        #     '<goods_id>': [sku_id, sku_id, ...],
+        #     ...
+        # }
+        jobs = OrderedDict()
+        for sku_id, goods_id in self.get_queryset(options).order_by('goods_id', 'id').values_list('id', 'goods_id'):
+            if sku_id not in done_sku_ids:
+                jobs.setdefault(goods_id, []).append(sku_id)
+
+        total = sum(len(sku_ids) for sku_ids in jobs.values())
+        self.stdout.write('待生成: %s个商品，%s个sku' % (len(jobs), total))
+
+        if not total:
+            self.remove_checkpoint(checkpoint)
+            return
+
+        # 子进程会继承父进程的数据库连接，fork之前先关闭
+        connections.close_all()
+
+        finished = failed = 0
+        start = time.time()
+
+        new_checkpoint = not os.path.exists(checkpoint) or not os.path.getsize(checkpoint)
+        with open(checkpoint, 'a') as f, Pool(options['processes'], initializer=init_worker) as pool:
+            if new_checkpoint:
+                f.write(CHECKPOINT_HEADER + filters + '\n')
+                f.flush()
+
+            for done_ids, failed_items in pool.imap_unordered(render_goods_skus, jobs.items()):
+                # 记录进度，生成失败的sku不记录，重新运行时再次生成
+                if done_ids:
+                    f.write('\n'.join(str(sku_id) for sku_id in done_ids) + '\n')
+                    f.flush()
+
+                for sku_id, message in failed_items:
+                    logger.error('生成sku详情页面[失败][ sku_id: %s, message: %s ]' % (sku_id, message))
+                    self.stderr.write('sku %s 生成失败: %s' % (sku_id, message))
+
+                finished += len(done_ids)
+                failed += len(failed_items)
+                elapsed = time.time() - start
+                self.stdout.write('%s/%s %.1f pages/sec' % (finished + failed, total,
+                                                              finished / elapsed if elapsed else 0))
+
+        elapsed = time.time() - start
+        if failed:
+            # 保留进度记录，重新运行时只生成失败的sku
+            self.stdout.write(self.style.ERROR(
+                '生成结束: %s个页面，%s个失败，耗时%.1fs，%.1f pages/sec，重新运行以重试失败的sku' % (
+                    finished, failed, elapsed, finished / elapsed if elapsed else 0)))
+            return
+
+        self.remove_checkpoint(checkpoint)
+        self.stdout.write(self.style.SUCCESS(
+            '生成完成: %s个页面，耗时%.1fs，%.1f pages/sec' % (finished, elapsed, finished / elapsed if elapsed else 0)))
+
+    def get_filters(self, options):
+        """本次运行的筛选条件，记录在进度记录文件中"""
+        return json.dumps({
+            'category': sorted(options['category']) if options['category'] else None,
+            'goods': sorted(options['goods']) if options['goods'] else None,
+            'since': self.parse_since(options['since']).isoformat() if options['since'] else None,
+        }, sort_keys=True)
+
+    def get_queryset(self, options):
+        """返回需要生成详情页面的sku查询集"""
+        skus = SKU.objects.all()
+
+        if options['category']:
+            category_ids = options['category']
+            skus = skus.filter(Q(goods__category1_id__in=category_ids) |
+                               Q(goods__category2_id__in=category_ids) |
+                               Q(goods__category3_id__in=category_ids))
+
+        if options['goods']:
+            skus = skus.filter(goods_id__in=options['goods'])
+
+        if options['since']:
+            skus = skus.filter(update_time__gte=self.parse_since(options['since']))
+
+        return skus
+
+    def parse_since(self, value):
+        """解析--since参数"""
+        since = parse_datetime(value)
+
+        if since is None:
+            date = parse_date(value)
+            if date is None:
+                raise CommandError('无效的--since参数: %s' % value)
+            since = datetime.combine(date, dt_time.min)
+
+        if timezone.is_naive(since):
+            since = timezone.make_aware(since)
+
+        return since
+
+    def load_checkpoint(self, checkpoint, filters):
+        """读取进度记录文件中已生成的sku id，筛选条件与本次不同时报错"""
+        if not os.path.exists(checkpoint):
+            return set()
+
+        with open(checkpoint) as f:
+            header = f.readline()
+            # 写入第一行之前中断的空文件
+            if not header:
+                return set()
+            if header.rstrip('\n') != CHECKPOINT_HEADER + filters:
+                raise CommandError('进度记录文件%s的筛选条件与本次不同，使用--reset重新生成或指定其他的--checkpoint' % checkpoint)
+
+            # 进程崩溃时最后一行可能没有写完整，直接忽略
+            return {int(line) for line in f if line.endswith('\n') and line.strip().isdigit()}
+
+    def remove_checkpoint(self, checkpoint):
+        """全部生成完成之后删除进度记录文件"""
+        if os.path.exists(checkpoint):
+            os.remove(checkpoint)
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from celery_tasks.html.tasks import get_static_html_counters
+
+
+class Command(BaseCommand):
+    help = '查看重新生成静态详情页面的请求数量和实际生成次数，用于观察合并窗口的效果'
+
+    def handle(self, *args, **options):
+        counters = get_static_html_counters()
+        requests, renders = counters['requests'], counters['renders']
+
+        self.stdout.write('requests: %s' % requests)
+        self.stdout.write('renders: %s' % renders)
+        if requests:
+            self.stdout.write('renders/requests: %.2f' % (renders / requests))
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('goods', '0002_auto_20181102_1542'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='sku',
+            index=models.Index(fields=['category', 'is_launched', 'create_time', 'id'], name='sku_cat_launched_ctime_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='sku',
+            index=models.Index(fields=['category', 'is_launched', 'price', 'id'], name='sku_cat_launched_price_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='sku',
+            index=models.Index(fields=['category', 'is_launched', 'sales', 'id'], name='sku_cat_launched_sales_idx'),
+        ),
+    ]
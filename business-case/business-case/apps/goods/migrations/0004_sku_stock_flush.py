@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('goods', '0003_sku_list_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SKUStockFlush',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('create_time', models.DateTimeField(auto_now_add=True, verbose_name='创建时间')),
+                ('update_time', models.DateTimeField(auto_now=True, verbose_name='更新时间')),
+                ('flush_id', models.CharField(max_length=32, unique=True, verbose_name='写回批次id')),
+            ],
+            options={
+                'db_table': 'tb_sku_stock_flush',
+                'verbose_name_plural': '预扣库存写回记录',
+                'verbose_name': '预扣库存写回记录',
+            },
+        ),
+    ]
@@ -133,6 +133,12 @@ class SKU(BaseModel):
         db_table = 'tb_sku'
         verbose_name = '商品SKU'
         verbose_name_plural = verbose_name
+        indexes = [
+            # 分类商品列表按每种排序方式进行键集分页，排序字段之后以id保证顺序稳定
+            models.Index(fields=['category', 'is_launched', 'create_time', 'id'], name='sku_cat_launched_ctime_idx'),
+            models.Index(fields=['category', 'is_launched', 'price', 'id'], name='sku_cat_launched_price_idx'),
+            models.Index(fields=['category', 'is_launched', 'sales', 'id'], name='sku_cat_launched_sales_idx'),
+        ]
 
     def __str__(self):
         return '%s: %s' % (self.id, self.name)
@@ -168,4 +174,17 @@ class SKUSpecification(BaseModel):
         verbose_name_plural = verbose_name
 
     def __str__(self):
-        return '%s: %s - %s' % (self.sku, self.spec.name, self.option.value)
\ No newline at end of file
+        return '%s: %s - %s' % (self.sku, self.spec.name, self.option.value)
+
+
+class SKUStockFlush(BaseModel):
+    """
+    预扣库存写回记录
+    与库存更新在同一个事务中保存，写回中断时据此判断该批数量是否已经提交到数据库
+    """
+    flush_id = models.CharField(max_length=32, unique=True, verbose_name='写回批次id')
+
+    class Meta:
+        db_table = 'tb_sku_stock_flush'
+        verbose_name = '预扣库存写回记录'
+        verbose_name_plural = verbose_name
@@ -3,6 +3,7 @@ from drf_haystack.serializers import HaystackSerializer
 
 from goods.models import SKU
 from goods.search_indexes import SKUIndex
+from goods.utils import get_sku_summary_map
 
 
 class SKUSerializer(serializers.ModelSerializer):
@@ -12,11 +13,29 @@ class SKUSerializer(serializers.ModelSerializer):
         fields = ('id', 'name', 'price', 'comments', 'default_image_url')
 
 
+class SKUIndexListSerializer(serializers.ListSerializer):
+    """搜索结果列表序列化器类"""
+    def to_representation(self, data):
+        # 批量获取本页搜索结果中所有商品的摘要数据，避免逐个从数据库加载商品对象
+        results = list(data)
+        self.sku_summaries = get_sku_summary_map([result.pk for result in results])
+        return super().to_representation(results)
+
+
 class SKUIndexSerializer(HaystackSerializer):
     """搜索结果序列化器类"""
-    object = SKUSerializer(label='商品')
+    object = serializers.SerializerMethodField(label='商品')
 
     class Meta:
         # 指定对应索引类
         index_classes = [SKUIndex]
         fields = ('text', 'object')
+        list_serializer_class = SKUIndexListSerializer
+
+    def get_object(self, obj):
+        """从sku摘要缓存中获取搜索结果对应的商品数据"""
+        sku_summaries = getattr(self.parent, 'sku_summaries', None)
+        if sku_summaries is None:
+            sku_summaries = get_sku_summary_map([obj.pk])
+
+        return sku_summaries.get(int(obj.pk))
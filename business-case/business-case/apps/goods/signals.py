@@ -0,0 +1,86 @@
+from collections import Counter
+
+from django.db import transaction
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+
+from goods.models import GoodsCategory, GoodsChannel, SKU
+from goods.utils import invalidate_categories, invalidate_sku_summary, set_sku_stocks, delete_sku_stock, \
+    incr_category_sku_counts, incr_sku_price_version
+from meiduo_mall.utils.db import on_commit_once
+
+
+@receiver(post_save, sender=GoodsCategory)
+@receiver(post_delete, sender=GoodsCategory)
+@receiver(post_save, sender=GoodsChannel)
+@receiver(post_delete, sender=GoodsChannel)
+def categories_changed(sender, **kwargs):
+    """商品类别或频道数据发生变化，在事务提交时使缓存的商品分类菜单失效(同一个事务中只执行一次)"""
+    on_commit_once(invalidate_categories)
+
+
+@receiver(post_save, sender=SKU)
+@receiver(post_delete, sender=SKU)
+def sku_changed(sender, instance, **kwargs):
+    """
+    sku数据发生变化，在事务提交时使缓存的sku摘要数据失效
+    需要在递增价格版本号之前执行(先注册的回调先执行)，避免按新版本号重新计算汇总时读取到旧的摘要缓存
+    """
+    sku_id = instance.id
+    transaction.on_commit(lambda: invalidate_sku_summary(sku_id))
+
+
+@receiver(post_save, sender=SKU)
+def sku_saved(sender, instance, **kwargs):
+    """sku保存之后，在事务提交时同步库存和上架状态镜像"""
+    mapping = {instance.id: (instance.stock, instance.is_launched)}
+    transaction.on_commit(lambda: set_sku_stocks(mapping))
+
+
+@receiver(post_delete, sender=SKU)
+def sku_deleted(sender, instance, **kwargs):
+    """sku删除之后，在事务提交时删除库存和上架状态镜像"""
+    sku_id = instance.id
+    transaction.on_commit(lambda: delete_sku_stock(sku_id))
+
+
+@receiver(pre_save, sender=SKU)
+def sku_saving(sender, instance, **kwargs):
+    """sku保存之前记录数据库中原来所属的分类(仅当原来已上架时)和价格"""
+    instance._launched_category_id = None
+    instance._old_price = None
+
+    if instance.pk is not None:
+        old = SKU.objects.filter(pk=instance.pk).values_list('category_id', 'is_launched', 'price').first()
+        if old is not None:
+            if old[1]:
+                instance._launched_category_id = old[0]
+            instance._old_price = old[2]
+
+
+@receiver(post_save, sender=SKU)
+def sku_category_count_saved(sender, instance, **kwargs):
+    """sku保存之后，在事务提交时增减新旧分类下已上架sku的数量"""
+    deltas = Counter()
+    if getattr(instance, '_launched_category_id', None) is not None:
+        deltas[instance._launched_category_id] -= 1
+    if instance.is_launched:
+        deltas[instance.category_id] += 1
+
+    transaction.on_commit(lambda: incr_category_sku_counts(deltas))
+
+
+@receiver(post_delete, sender=SKU)
+def sku_category_count_deleted(sender, instance, **kwargs):
+    """sku删除之后，在事务提交时减少分类下已上架sku的数量"""
+    if instance.is_launched:
+        deltas = {instance.category_id: -1}
+        transaction.on_commit(lambda: incr_category_sku_counts(deltas))
+
+
+@receiver(post_save, sender=SKU)
+def sku_price_saved(sender, instance, **kwargs):
+    """sku价格发生变化，在事务提交时递增价格版本号，使按旧价格计算的购物车汇总数据失效"""
+    old_price = getattr(instance, '_old_price', None)
+    if old_price is not None and old_price != instance.price:
+        transaction.on_commit(incr_sku_price_version)
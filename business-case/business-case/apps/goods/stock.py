@@ -0,0 +1,386 @@
+import datetime
+import logging
+import time
+import uuid
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from django_redis import get_redis_connection
+
+from goods.models import SKU, SKUStockFlush
+from goods.utils import SKU_STOCK_KEY, SKU_STOCK_PENDING_KEY, SKU_STOCK_INFLIGHT_KEY, SKU_STOCK_RESERVED_KEY, \
+    set_sku_stocks
+from orders.models import OrderInfo
+
+logger = logging.getLogger('django')
+
+# 已安排写回数据库任务的标记
+SKU_STOCK_FLUSH_SCHEDULED_KEY = 'sku_stock_flush_scheduled'
+# 写回数据库的锁，同一时间只有一个写回在进行
+SKU_STOCK_FLUSH_LOCK_KEY = 'sku_stock_flush_lock'
+# 写回锁的有效期: s，需要大于一次写回的最长耗时
+SKU_STOCK_FLUSH_LOCK_EXPIRES = 5 * 60
+# 正在写回的批次id，与sku_stock_inflight中的数量对应
+SKU_STOCK_INFLIGHT_ID_KEY = 'sku_stock_inflight_id'
+# 写回记录的保留时间: 天
+SKU_STOCK_FLUSH_RECORD_DAYS = 7
+# 对账时等待写回锁的最长时间: s
+SKU_STOCK_RECONCILE_LOCK_WAIT = 30
+# 每个订单预扣的商品: hash {'<order_id>': '<sku_id>:<count>,<sku_id>:<count>,...'}
+SKU_STOCK_RESERVATIONS_KEY = 'sku_stock_reservations'
+# 每个订单预扣的时间: zset {'<order_id>': '<timestamp>', ...}，用于找出进程中断后没有确认或释放的预扣
+SKU_STOCK_RESERVATION_TIME_KEY = 'sku_stock_reservation_time'
+
+# 预扣结果
+RESERVE_OK = 1
+RESERVE_NOT_ENOUGH = 0
+RESERVE_NOT_LAUNCHED = -1
+RESERVE_NOT_EXIST = -2
+
+# 预扣库存: 先检查所有商品，全部满足时才一起扣减，任何一个商品不满足都不做修改
+# 扣减的数量按订单记录，订单提交之后确认，转移到待写回的hash中
+# KEYS[1]: sku_stock KEYS[2]: sku_stock_reserved KEYS[3]: sku_stock_reservations KEYS[4]: sku_stock_reservation_time
+# ARGV[1]: 订单id ARGV[2]: 当前时间 ARGV[3:]: sku_id, count, sku_id, count, ...
+# 返回: [结果, 不满足条件的sku_id]
+RESERVE_SCRIPT = """
+local stocks = {}
+for i = 3, #ARGV, 2 do
+    local value = redis.call('hget', KEYS[1], ARGV[i])
+    if not value then
+        return {-2, ARGV[i]}
+    end
+    local stock, is_launched = string.match(value, '^(-?%d+),(%d)$')
+    if is_launched ~= '1' then
+        return {-1, ARGV[i]}
+    end
+    stock = tonumber(stock)
+    if stock < tonumber(ARGV[i + 1]) then
+        return {0, ARGV[i]}
+    end
+    stocks[i] = stock
+end
+local items = {}
+for i = 3, #ARGV, 2 do
+    redis.call('hset', KEYS[1], ARGV[i], (stocks[i] - tonumber(ARGV[i + 1])) .. ',1')
+    redis.call('hincrby', KEYS[2], ARGV[i], ARGV[i + 1])
+    items[#items + 1] = ARGV[i] .. ':' .. ARGV[i + 1]
+end
+redis.call('hset', KEYS[3], ARGV[1], table.concat(items, ','))
+redis.call('zadd', KEYS[4], ARGV[2], ARGV[1])
+return {1}
+"""
+
+# 订单已提交，确认预扣的库存，数量转移到待写回的hash中
+# 预扣记录已被当作失效释放时，按ARGV中的商品重新扣减镜像中的库存
+# KEYS[1]: sku_stock KEYS[2]: sku_stock_reserved KEYS[3]: sku_stock_reservations KEYS[4]: sku_stock_reservation_time
+# KEYS[5]: sku_stock_pending
+# ARGV[1]: 订单id ARGV[2:]: sku_id, count, sku_id, count, ...
+# 返回: 1 确认了预扣记录 0 预扣记录已被释放
+CONFIRM_SCRIPT = """
+local items = redis.call('hget', KEYS[3], ARGV[1])
+if items then
+    for sku_id, count in string.gmatch(items, '(%d+):(%d+)') do
+        redis.call('hincrby', KEYS[2], sku_id, -tonumber(count))
+        redis.call('hincrby', KEYS[5], sku_id, count)
+    end
+    redis.call('hdel', KEYS[3], ARGV[1])
+    redis.call('zrem', KEYS[4], ARGV[1])
+    return 1
+end
+for i = 2, #ARGV, 2 do
+    local value = redis.call('hget', KEYS[1], ARGV[i])
+    if value then
+        local stock, is_launched = string.match(value, '^(-?%d+),(%d)$')
+        redis.call('hset', KEYS[1], ARGV[i], (tonumber(stock) - tonumber(ARGV[i + 1])) .. ',' .. is_launched)
+    end
+    redis.call('hincrby', KEYS[5], ARGV[i], ARGV[i + 1])
+end
+return 0
+"""
+
+# 释放订单预扣的库存(下单失败或订单没有提交时)
+# KEYS[1]: sku_stock KEYS[2]: sku_stock_reserved KEYS[3]: sku_stock_reservations KEYS[4]: sku_stock_reservation_time
+# ARGV[1]: 订单id
+# 返回: 1 释放了预扣记录 0 预扣记录不存在(已确认或已释放)
+RELEASE_SCRIPT = """
+local items = redis.call('hget', KEYS[3], ARGV[1])
+if not items then
+    return 0
+end
+for sku_id, count in string.gmatch(items, '(%d+):(%d+)') do
+    local value = redis.call('hget', KEYS[1], sku_id)
+    if value then
+        local stock, is_launched = string.match(value, '^(-?%d+),(%d)$')
+        redis.call('hset', KEYS[1], sku_id, (tonumber(stock) + tonumber(count)) .. ',' .. is_launched)
+    end
+    redis.call('hincrby', KEYS[2], sku_id, -tonumber(count))
+end
+redis.call('hdel', KEYS[3], ARGV[1])
+redis.call('zrem', KEYS[4], ARGV[1])
+return 1
+"""
+
+RESERVATION_KEYS = [SKU_STOCK_KEY, SKU_STOCK_RESERVED_KEY, SKU_STOCK_RESERVATIONS_KEY, SKU_STOCK_RESERVATION_TIME_KEY]
+
+# 取出所有待写回的数量，转移到正在写回的hash中，并记录批次id
+# KEYS[1]: sku_stock_pending KEYS[2]: sku_stock_inflight KEYS[3]: sku_stock_inflight_id
+# ARGV[1]: 批次id
+# 返回: [sku_id, count, sku_id, count, ...]
+TAKE_PENDING_SCRIPT = """
+local items = redis.call('hgetall', KEYS[1])
+for i = 1, #items, 2 do
+    redis.call('hincrby', KEYS[2], items[i], items[i + 1])
+end
+redis.call('del', KEYS[1])
+redis.call('set', KEYS[3], ARGV[1])
+return items
+"""
+
+# 写回没有提交到数据库，将正在写回的数量加回待写回的hash中
+# KEYS[1]: sku_stock_pending KEYS[2]: sku_stock_inflight KEYS[3]: sku_stock_inflight_id
+RESTORE_INFLIGHT_SCRIPT = """
+local items = redis.call('hgetall', KEYS[2])
+for i = 1, #items, 2 do
+    redis.call('hincrby', KEYS[1], items[i], items[i + 1])
+end
+redis.call('del', KEYS[2], KEYS[3])
+return #items / 2
+"""
+
+# 释放写回锁(只释放自己持有的锁)
+# KEYS[1]: sku_stock_flush_lock ARGV[1]: 加锁时的token
+RELEASE_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+def reserve_sku_stocks(order_id, cart_dict):
+    """
+    在redis库存镜像中一次性预扣订单中所有商品的库存:
+    cart_dict: {
+        '<sku_id>': '<count>',
+        ...
+    }
+    返回 (结果, 不满足条件的sku_id)，结果为RESERVE_OK时所有商品均已扣减
+    订单提交之后调用confirm_sku_stocks确认，下单失败时调用release_sku_stocks释放
+    进程在两者之前中断时，预扣记录超过SKU_STOCK_RESERVATION_EXPIRES之后由写回任务按订单是否存在确认或释放
+    """
+    if not cart_dict:
+        return RESERVE_OK, None
+
+    args = [order_id, time.time()]
+    for sku_id, count in cart_dict.items():
+        args.extend([sku_id, count])
+
+    redis_conn = get_redis_connection('default')
+    script = redis_conn.register_script(RESERVE_SCRIPT)
+    res = script(keys=RESERVATION_KEYS, args=args)
+
+    if res[0] == RESERVE_OK:
+        return RESERVE_OK, None
+
+    return res[0], int(res[1])
+
+
+def confirm_sku_stocks(order_id, cart_dict):
+    """订单已提交，确认reserve_sku_stocks预扣的库存并安排写回数据库"""
+    if not cart_dict:
+        return
+
+    args = [order_id]
+    for sku_id, count in cart_dict.items():
+        args.extend([sku_id, count])
+
+    redis_conn = get_redis_connection('default')
+    script = redis_conn.register_script(CONFIRM_SCRIPT)
+    if not script(keys=RESERVATION_KEYS + [SKU_STOCK_PENDING_KEY], args=args):
+        logger.warning('预扣库存[确认时已被释放][ order_id: %s ]' % order_id)
+
+    request_flush_sku_stocks()
+
+
+def release_sku_stocks(order_id):
+    """释放订单在reserve_sku_stocks中预扣的库存"""
+    redis_conn = get_redis_connection('default')
+    script = redis_conn.register_script(RELEASE_SCRIPT)
+    script(keys=RESERVATION_KEYS, args=[order_id])
+
+
+def request_flush_sku_stocks():
+    """安排将预扣的库存写回数据库，时间窗口内的多次请求只会触发一次写回"""
+    redis_conn = get_redis_connection('default')
+    delay = settings.SKU_STOCK_FLUSH_DELAY
+
+    if redis_conn.set(SKU_STOCK_FLUSH_SCHEDULED_KEY, 1, ex=delay, nx=True):
+        from celery_tasks.stock.tasks import flush_sku_stocks as flush_sku_stocks_task
+        flush_sku_stocks_task.apply_async(countdown=delay)
+
+
+def acquire_flush_lock(redis_conn, wait=0):
+    """获取写回锁，最多等待wait秒，返回释放锁时使用的token，没有获取到时返回None"""
+    token = uuid.uuid4().hex
+    deadline = time.time() + wait
+    while not redis_conn.set(SKU_STOCK_FLUSH_LOCK_KEY, token, ex=SKU_STOCK_FLUSH_LOCK_EXPIRES, nx=True):
+        if time.time() >= deadline:
+            return None
+        time.sleep(0.1)
+
+    return token
+
+
+def release_flush_lock(redis_conn, token):
+    """释放acquire_flush_lock获取的写回锁"""
+    redis_conn.register_script(RELEASE_LOCK_SCRIPT)(keys=[SKU_STOCK_FLUSH_LOCK_KEY], args=[token])
+
+
+def flush_sku_stocks():
+    """
+    将redis中预扣的库存和销量写回数据库，返回写回的sku数量:
+    1. 获取写回锁，其他写回正在进行时重新安排写回
+    2. 处理上次中断的写回: 批次已提交到数据库时直接清除，否则将数量加回待写回
+    3. 处理失效的预扣: 订单已提交时确认，否则释放
+    4. 取出待写回的数量，与批次记录在同一个事务中更新数据库
+    5. 事务失败时将数量加回待写回，提交之后清除正在写回的数量
+    """
+    redis_conn = get_redis_connection('default')
+
+    token = acquire_flush_lock(redis_conn)
+    if token is None:
+        request_flush_sku_stocks()
+        return 0
+
+    keys = [SKU_STOCK_PENDING_KEY, SKU_STOCK_INFLIGHT_KEY, SKU_STOCK_INFLIGHT_ID_KEY]
+
+    try:
+        resolve_inflight_sku_stocks(redis_conn)
+        resolve_expired_sku_reservations(redis_conn)
+
+        flush_id = uuid.uuid4().hex
+        script = redis_conn.register_script(TAKE_PENDING_SCRIPT)
+        res = script(keys=keys, args=[flush_id])
+
+        items = [(int(res[i]), int(res[i + 1])) for i in range(0, len(res), 2)]
+        items = [(sku_id, count) for sku_id, count in items if count]
+        if not items:
+            redis_conn.delete(SKU_STOCK_INFLIGHT_KEY, SKU_STOCK_INFLIGHT_ID_KEY)
+            return 0
+
+        try:
+            with transaction.atomic():
+                for sku_id, count in items:
+                    # update tb_sku set stock=stock-<count>, sales=sales+<count> where id=<sku_id>;
+                    SKU.objects.filter(id=sku_id).update(stock=F('stock') - count, sales=F('sales') + count)
+                SKUStockFlush.objects.create(flush_id=flush_id)
+        except Exception:
+            # 事务没有提交，数量加回待写回，由下次写回重试
+            redis_conn.register_script(RESTORE_INFLIGHT_SCRIPT)(keys=keys)
+            request_flush_sku_stocks()
+            raise
+
+        redis_conn.delete(SKU_STOCK_INFLIGHT_KEY, SKU_STOCK_INFLIGHT_ID_KEY)
+    finally:
+        release_flush_lock(redis_conn, token)
+
+    return len(items)
+
+
+def resolve_inflight_sku_stocks(redis_conn):
+    """
+    处理上次在数据库提交前后中断的写回(需要持有写回锁):
+    批次记录存在说明数量已经写入数据库，直接清除；否则将数量加回待写回
+    """
+    if not redis_conn.hlen(SKU_STOCK_INFLIGHT_KEY):
+        return
+
+    flush_id = redis_conn.get(SKU_STOCK_INFLIGHT_ID_KEY)
+    flush_id = flush_id.decode() if flush_id is not None else None
+
+    if flush_id is not None and SKUStockFlush.objects.filter(flush_id=flush_id).exists():
+        logger.warning('预扣库存写回[已提交][ flush_id: %s ]' % flush_id)
+        redis_conn.delete(SKU_STOCK_INFLIGHT_KEY, SKU_STOCK_INFLIGHT_ID_KEY)
+    else:
+        logger.warning('预扣库存写回[未提交][ flush_id: %s ]' % flush_id)
+        redis_conn.register_script(RESTORE_INFLIGHT_SCRIPT)(
+            keys=[SKU_STOCK_PENDING_KEY, SKU_STOCK_INFLIGHT_KEY, SKU_STOCK_INFLIGHT_ID_KEY])
+
+
+def resolve_expired_sku_reservations(redis_conn):
+    """
+    处理超过有效期仍未确认或释放的预扣(下单进程在订单提交前后中断)，返回处理的订单数量:
+    订单已保存到数据库时确认，数量转移到待写回；否则释放，库存加回镜像
+    """
+    deadline = time.time() - settings.SKU_STOCK_RESERVATION_EXPIRES
+    order_ids = [order_id.decode() for order_id in
+                 redis_conn.zrangebyscore(SKU_STOCK_RESERVATION_TIME_KEY, 0, deadline)]
+    if not order_ids:
+        return 0
+
+    existing_ids = set(OrderInfo.objects.filter(order_id__in=order_ids).values_list('order_id', flat=True))
+
+    confirm = redis_conn.register_script(CONFIRM_SCRIPT)
+    release = redis_conn.register_script(RELEASE_SCRIPT)
+    for order_id in order_ids:
+        if order_id in existing_ids:
+            logger.warning('预扣库存[失效][已下单][ order_id: %s ]' % order_id)
+            confirm(keys=RESERVATION_KEYS + [SKU_STOCK_PENDING_KEY], args=[order_id])
+        else:
+            logger.warning('预扣库存[失效][未下单][ order_id: %s ]' % order_id)
+            release(keys=RESERVATION_KEYS, args=[order_id])
+
+    return len(order_ids)
+
+
+def reconcile_sku_stocks(batch_size=1000):
+    """
+    对账: 先写回预扣的库存(同时处理中断的写回)，再按数据库中的库存重建redis镜像
+    镜像库存 = 数据库库存 - 尚未写回数据库的预扣数量
+    每批sku持有写回锁读取数据库并设置镜像，避免读取之后写回提交并清除正在写回的数量，镜像中多出这部分库存
+    返回 (写回的sku数量, 修正的sku数量)
+    """
+    flushed = flush_sku_stocks()
+
+    redis_conn = get_redis_connection('default')
+
+    fixed = 0
+    last_id = 0
+    while True:
+        token = acquire_flush_lock(redis_conn, SKU_STOCK_RECONCILE_LOCK_WAIT)
+        if token is None:
+            raise RuntimeError('对账时没有获取到库存写回锁')
+
+        try:
+            rows = list(SKU.objects.filter(id__gt=last_id).order_by('id').values_list(
+                'id', 'stock', 'is_launched')[:batch_size])
+            if not rows:
+                break
+            last_id = rows[-1][0]
+
+            sku_ids = [sku_id for sku_id, _, _ in rows]
+            before = redis_conn.hmget(SKU_STOCK_KEY, sku_ids)
+
+            after = set_sku_stocks({sku_id: (stock, is_launched) for sku_id, stock, is_launched in rows})
+        finally:
+            release_flush_lock(redis_conn, token)
+
+        for sku_id, value in zip(sku_ids, before):
+            item = after[sku_id]
+            if value is None or value.decode() != '%s,%s' % (item['stock'], 1 if item['is_launched'] else 0):
+                fixed += 1
+
+    # 数据库中已删除的sku
+    existing_ids = set(SKU.objects.values_list('id', flat=True))
+    stale_ids = [sku_id for sku_id in redis_conn.hkeys(SKU_STOCK_KEY) if int(sku_id) not in existing_ids]
+    if stale_ids:
+        redis_conn.hdel(SKU_STOCK_KEY, *stale_ids)
+        fixed += len(stale_ids)
+
+    # 清理过期的写回记录
+    SKUStockFlush.objects.filter(
+        create_time__lt=timezone.now() - datetime.timedelta(days=SKU_STOCK_FLUSH_RECORD_DAYS)).delete()
+
+    return flushed, fixed
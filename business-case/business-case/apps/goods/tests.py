@@ -1,3 +1,413 @@
+import os
+import shutil
+import tempfile
+from decimal import Decimal
+from io import StringIO
+from unittest import mock
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import DatabaseError, connection
+from django.db.models.query import QuerySet
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django_redis import get_redis_connection
+from rest_framework.test import APIClient
+
+from goods.models import GoodsCategory, GoodsChannel, Brand, Goods, GoodsSpecification, SpecificationOption, SKU, SKUSpecification
+from goods import stock
+from goods.utils import SpecMatrix, build_categories, get_categories, get_sku_summaries, get_sku_stocks, \
+    set_sku_stocks, incr_sku_stocks, delete_sku_stock, SKU_CATEGORY_COUNT_KEY, get_category_sku_count, \
+    incr_category_sku_counts, reconcile_category_sku_counts, clear_local_caches
 
 # Create your tests here.
+
+
+class RedisTestCase(TestCase):
+    """
+    读写redis的测试用例基类:
+    只能在测试配置(settings.test)下运行，每个测试开始前清空测试使用的redis数据库和进程内缓存，
+    不会读写开发环境redis中的数据
+    """
+    @classmethod
+    def setUpClass(cls):
+        if not getattr(settings, 'TEST_REDIS_DATABASES', None):
+            raise ImproperlyConfigured('读写redis的测试需要使用测试配置: python manage.py test')
+        super().setUpClass()
+
+    def setUp(self):
+        super().setUp()
+        for alias in settings.TEST_REDIS_DATABASES:
+            get_redis_connection(alias).flushdb()
+        clear_local_caches()
+
+
+def create_goods_with_skus(colors, sizes):
+    """创建一个包含`颜色x尺寸`个SKU的商品"""
+    cat1 = GoodsCategory.objects.create(name='手机数码')
+    cat2 = GoodsCategory.objects.create(name='手机通讯', parent=cat1)
+    cat3 = GoodsCategory.objects.create(name='手机', parent=cat2)
+    brand = Brand.objects.create(name='美多', logo='logo.png', first_letter='M')
+    goods = Goods.objects.create(name='美多手机', brand=brand, category1=cat1, category2=cat2, category3=cat3)
+
+    color_spec = GoodsSpecification.objects.create(goods=goods, name='颜色')
+    size_spec = GoodsSpecification.objects.create(goods=goods, name='内存')
+    color_options = [SpecificationOption.objects.create(spec=color_spec, value='颜色%s' % i) for i in range(colors)]
+    size_options = [SpecificationOption.objects.create(spec=size_spec, value='%sG' % (i + 1)) for i in range(sizes)]
+
+    for color in color_options:
+        for size in size_options:
+            sku = SKU.objects.create(name='%s %s' % (color.value, size.value), caption='', goods=goods, category=cat3,
+                                     price=Decimal('1000'), cost_price=Decimal('800'), market_price=Decimal('1200'))
+            SKUSpecification.objects.create(sku=sku, spec=color_spec, option=color)
+            SKUSpecification.objects.create(sku=sku, spec=size_spec, option=size)
+
+    return goods
+
+
+class SpecMatrixTest(RedisTestCase):
+    def test_query_count_is_constant(self):
+        """规格矩阵的查询次数与SKU数量无关"""
+        small = create_goods_with_skus(2, 2)
+        large = create_goods_with_skus(5, 10)
+
+        for goods in (small, large):
+            with self.assertNumQueries(3):
+                spec_matrix = SpecMatrix(goods)
+                for sku_id in spec_matrix.sku_keys:
+                    spec_matrix.get_sku_specs(sku_id)
+
+    def test_sku_specs(self):
+        """每个规格选项都指向对应规格组合的sku"""
+        goods = create_goods_with_skus(2, 3)
+        spec_matrix = SpecMatrix(goods)
+
+        for sku in goods.sku_set.all():
+            specs = spec_matrix.get_sku_specs(sku.id)
+            self.assertEqual(len(specs), 2)
+
+            sku_key = [spec.option_id for spec in sku.skuspecification_set.order_by('spec_id')]
+            for index, spec in enumerate(specs):
+                for option in spec['options']:
+                    key = sku_key[:]
+                    key[index] = option['id']
+                    expected = SKU.objects.filter(skuspecification__option_id=key[0]).filter(
+                        skuspecification__option_id=key[1]).get()
+                    self.assertEqual(option['sku_id'], expected.id)
+
+    def test_incomplete_sku_specs(self):
+        """规格信息不完整的sku返回None"""
+        goods = create_goods_with_skus(1, 2)
+        sku = goods.sku_set.first()
+        sku.skuspecification_set.order_by('spec_id').last().delete()
+
+        self.assertIsNone(SpecMatrix(goods).get_sku_specs(sku.id))
+
+
+class CategoriesTest(RedisTestCase):
+    def test_build_categories_query_count(self):
+        """商品分类菜单的查询次数与类别数量无关"""
+        for i in range(3):
+            cat1 = GoodsCategory.objects.create(name='一级%s' % i)
+            GoodsChannel.objects.create(group_id=i % 2, category=cat1, url='http://www.meiduo.site/%s' % i, sequence=i)
+            for j in range(3):
+                cat2 = GoodsCategory.objects.create(name='二级%s' % j, parent=cat1)
+                for k in range(3):
+                    GoodsCategory.objects.create(name='三级%s' % k, parent=cat2)
+
+        with self.assertNumQueries(2):
+            items = build_categories()
+
+        categories = dict(items)
+        self.assertEqual([channel['id'] for channel in categories[0]['channels']],
+                         list(GoodsChannel.objects.filter(group_id=0).order_by('sequence').values_list(
+                             'category_id', flat=True)))
+        self.assertEqual(len(categories[0]['sub_cats']), 6)
+        self.assertEqual(len(categories[0]['sub_cats'][0]['sub_cats']), 3)
+
+    def test_cached_copy(self):
+        """修改返回的分类菜单不会影响进程内缓存"""
+        cat1 = GoodsCategory.objects.create(name='一级')
+        GoodsChannel.objects.create(group_id=1, category=cat1, url='http://www.meiduo.site/', sequence=1)
+
+        categories = get_categories()
+        categories[1]['channels'].clear()
+        categories['extra'] = {}
+
+        categories = get_categories()
+        self.assertEqual(list(categories), [1])
+        self.assertEqual(len(categories[1]['channels']), 1)
+
+
+class SKUSummaryTest(RedisTestCase):
+    def test_order_and_missing(self):
+        """按传入顺序返回，不存在的sku直接忽略，缓存命中时不查询数据库"""
+        goods = create_goods_with_skus(1, 3)
+        sku_ids = list(goods.sku_set.order_by('-id').values_list('id', flat=True))
+        missing_id = sku_ids[0] + 1000
+
+        summaries = get_sku_summaries([sku_ids[0], missing_id, sku_ids[2]])
+        self.assertEqual([summary['id'] for summary in summaries], [sku_ids[0], sku_ids[2]])
+
+        with self.assertNumQueries(0):
+            get_sku_summaries([sku_ids[0], sku_ids[2]])
+
+
+@mock.patch('goods.stock.request_flush_sku_stocks')
+class StockReservationTest(RedisTestCase):
+    def setUp(self):
+        super().setUp()
+        goods = create_goods_with_skus(1, 2)
+        self.sku1, self.sku2 = goods.sku_set.order_by('id')
+        SKU.objects.filter(id=self.sku1.id).update(stock=5)
+        SKU.objects.filter(id=self.sku2.id).update(stock=1)
+        stock.reconcile_sku_stocks()
+
+    def test_reserve_all_or_nothing(self, request_flush):
+        """任何一个商品库存不足时，所有商品的库存都不扣减"""
+        res, sku_id = stock.reserve_sku_stocks('1', {self.sku1.id: 2, self.sku2.id: 2})
+        self.assertEqual((res, sku_id), (stock.RESERVE_NOT_ENOUGH, self.sku2.id))
+        self.assertEqual(get_sku_stocks([self.sku1.id])[self.sku1.id]['stock'], 5)
+
+        res, _ = stock.reserve_sku_stocks('2', {self.sku1.id: 2, self.sku2.id: 1})
+        self.assertEqual(res, stock.RESERVE_OK)
+        stocks = get_sku_stocks([self.sku1.id, self.sku2.id])
+        self.assertEqual((stocks[self.sku1.id]['stock'], stocks[self.sku2.id]['stock']), (3, 0))
+
+    def test_flush_and_reconcile(self, request_flush):
+        """确认的预扣数量写回数据库，对账不会把尚未写回的预扣数量加回镜像"""
+        stock.reserve_sku_stocks('1', {self.sku1.id: 2})
+        stock.confirm_sku_stocks('1', {self.sku1.id: 2})
+        stock.reconcile_sku_stocks()
+
+        sku = SKU.objects.get(id=self.sku1.id)
+        self.assertEqual((sku.stock, sku.sales), (3, 2))
+        self.assertEqual(get_sku_stocks([self.sku1.id])[self.sku1.id]['stock'], 3)
+
+        # 按数据库库存设置镜像时扣除尚未写回和尚未确认的预扣数量
+        stock.reserve_sku_stocks('2', {self.sku1.id: 1})
+        stock.confirm_sku_stocks('2', {self.sku1.id: 1})
+        stock.reserve_sku_stocks('3', {self.sku1.id: 1})
+        self.assertEqual(set_sku_stocks({self.sku1.id: (3, True)})[self.sku1.id]['stock'], 1)
+
+        # 下单失败时释放，释放之后不会重复释放
+        stock.release_sku_stocks('3')
+        stock.release_sku_stocks('3')
+        self.assertEqual(get_sku_stocks([self.sku1.id])[self.sku1.id]['stock'], 2)
+
+    def test_expired_reservation(self, request_flush):
+        """进程中断没有确认或释放的预扣，失效之后订单不存在时释放；释放之后订单提交时重新扣减"""
+        stock.reserve_sku_stocks('1', {self.sku1.id: 2})
+        stock.reserve_sku_stocks('2', {self.sku1.id: 1})
+
+        with self.settings(SKU_STOCK_RESERVATION_EXPIRES=-1):
+            self.assertEqual(stock.flush_sku_stocks(), 0)
+        self.assertEqual(get_sku_stocks([self.sku1.id])[self.sku1.id]['stock'], 5)
+        self.assertEqual(SKU.objects.get(id=self.sku1.id).stock, 5)
+
+        stock.confirm_sku_stocks('2', {self.sku1.id: 1})
+        self.assertEqual(get_sku_stocks([self.sku1.id])[self.sku1.id]['stock'], 4)
+        self.assertEqual(stock.flush_sku_stocks(), 1)
+        self.assertEqual(SKU.objects.get(id=self.sku1.id).stock, 4)
+
+    def test_interrupted_flush(self, request_flush):
+        """写回事务失败时数量加回待写回；提交之后中断的写回不会重复写入数据库"""
+        stock.reserve_sku_stocks('1', {self.sku1.id: 2})
+        stock.confirm_sku_stocks('1', {self.sku1.id: 2})
+
+        with mock.patch('goods.stock.SKUStockFlush.objects.create', side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                stock.flush_sku_stocks()
+        self.assertEqual(SKU.objects.get(id=self.sku1.id).stock, 5)
+
+        # 模拟提交之后、清除正在写回的数量之前中断
+        with mock.patch.object(get_redis_connection('default'), 'delete'):
+            self.assertEqual(stock.flush_sku_stocks(), 1)
+        self.assertEqual(stock.flush_sku_stocks(), 0)
+
+        self.assertEqual(SKU.objects.get(id=self.sku1.id).stock, 3)
+        self.assertEqual(set_sku_stocks({self.sku1.id: (3, True)})[self.sku1.id]['stock'], 3)
+
+    def test_incr_after_commit(self, request_flush):
+        """订单提交之后按扣减的数量修改镜像，回调的执行顺序不影响结果，镜像中没有的sku不写入"""
+        incr_sku_stocks({self.sku1.id: -1})
+        incr_sku_stocks({self.sku1.id: -3})
+        self.assertEqual(get_sku_stocks([self.sku1.id])[self.sku1.id], {'stock': 1, 'is_launched': True})
+
+        delete_sku_stock(self.sku2.id)
+        incr_sku_stocks({self.sku2.id: -1})
+        self.assertEqual(get_sku_stocks([self.sku2.id])[self.sku2.id]['stock'], 1)
+
+
+class SKUListCursorTest(RedisTestCase):
+    def test_cursor_pagination(self):
+        """键集分页按排序字段和id逐页返回全部商品，价格相同的商品不会重复或遗漏"""
+        goods = create_goods_with_skus(2, 4)
+        for index, sku in enumerate(goods.sku_set.order_by('id')):
+            SKU.objects.filter(id=sku.id).update(price=Decimal(1000 + index % 3 * 100))
+        expected = list(SKU.objects.order_by('-price', '-id').values_list('id', flat=True))
+
+        sku_ids = []
+        url = '/categories/%s/skus/?pagination=cursor&ordering=-price&page_size=3' % goods.category3_id
+        while url:
+            response = APIClient().get(url)
+            self.assertEqual(response.status_code, 200)
+            sku_ids.extend(sku['id'] for sku in response.data['results'])
+            url = response.data['next']
+
+        self.assertEqual(sku_ids, expected)
+
+
+class CategorySKUCountTest(RedisTestCase):
+    def test_cached_count(self):
+        """分类商品数量缓存之后，每页只需要一次查询"""
+        goods = create_goods_with_skus(2, 4)
+        SKU.objects.filter(id=goods.sku_set.first().id).update(is_launched=False)
+        url = '/categories/%s/skus/?page=2&page_size=3' % goods.category3_id
+
+        APIClient().get(url)
+        with self.assertNumQueries(1):
+            response = APIClient().get(url)
+
+        self.assertEqual(response.data['count'], 7)
+        self.assertEqual(len(response.data['results']), 3)
+
+    def test_changed_while_counting(self):
+        """从数据库统计期间分类数量发生变化时不缓存统计结果"""
+        goods = create_goods_with_skus(1, 3)
+        category_id = goods.category3_id
+        redis_conn = get_redis_connection('default')
+        count = QuerySet.count
+
+        def count_and_change(queryset):
+            res = count(queryset)
+            incr_category_sku_counts({category_id: 1})
+            return res
+
+        with mock.patch.object(QuerySet, 'count', count_and_change):
+            self.assertEqual(get_category_sku_count(category_id), 3)
+        self.assertIsNone(redis_conn.hget(SKU_CATEGORY_COUNT_KEY, category_id))
+
+        self.assertEqual(get_category_sku_count(category_id), 3)
+        self.assertEqual(int(redis_conn.hget(SKU_CATEGORY_COUNT_KEY, category_id)), 3)
+
+    def test_reconcile(self):
+        """对账按数据库修正缓存的分类商品数量"""
+        goods = create_goods_with_skus(1, 3)
+        get_redis_connection('default').hset(SKU_CATEGORY_COUNT_KEY, goods.category3_id, 100)
+
+        self.assertEqual(reconcile_category_sku_counts(), 1)
+        self.assertEqual(int(get_redis_connection('default').hget(SKU_CATEGORY_COUNT_KEY, goods.category3_id)), 3)
+
+        # 统计期间数量发生变化的分类删除缓存，不写入可能已过期的统计结果
+        redis_conn = get_redis_connection('default')
+        redis_conn.hset(SKU_CATEGORY_COUNT_KEY, goods.category3_id, 100)
+        hkeys = redis_conn.hkeys
+
+        def change_and_hkeys(key):
+            incr_category_sku_counts({goods.category3_id: 1})
+            return hkeys(key)
+
+        with mock.patch.object(redis_conn, 'hkeys', change_and_hkeys):
+            self.assertEqual(reconcile_category_sku_counts(), 0)
+        self.assertIsNone(redis_conn.hget(SKU_CATEGORY_COUNT_KEY, goods.category3_id))
+
+
+class StaticDetailHtmlTest(RedisTestCase):
+    def setUp(self):
+        super().setUp()
+        self.html_dir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.html_dir, 'goods'))
+        self.addCleanup(shutil.rmtree, self.html_dir)
+
+    def generate(self, colors, sizes):
+        """生成一个商品下所有SKU的详情页面，返回(商品, 执行的sql语句数量)"""
+        from celery_tasks.html.tasks import generate_static_goods_detail_html
+
+        goods = create_goods_with_skus(colors, sizes)
+        GoodsChannel.objects.create(group_id=0, category=goods.category1, url='http://www.meiduo.site', sequence=1)
+
+        # 分类菜单不使用之前生成时的缓存
+        get_redis_connection('default').flushdb()
+        clear_local_caches()
+
+        with self.settings(GENERATED_STATIC_HTML_FILES_DIR=self.html_dir):
+            with CaptureQueriesContext(connection) as queries:
+                generate_static_goods_detail_html(goods.id)
+
+        return goods, len(queries)
+
+    def test_goods_detail_html(self):
+        """商品下每个SKU的详情页面都会生成，共享的数据只查询一次，查询次数与SKU数量无关"""
+        _, small = self.generate(1, 1)
+        goods, large = self.generate(2, 3)
+
+        self.assertEqual(small, large)
+        for sku_id in goods.sku_set.values_list('id', flat=True):
+            self.assertTrue(os.path.exists(os.path.join(self.html_dir, 'goods', '%s.html' % sku_id)))
+
+    def test_regenerate_failed_goods(self):
+        """批量生成时单个商品失败只返回失败的sku，不影响其他商品"""
+        from goods.management.commands import regenerate_static_detail_html as command
+
+        goods = create_goods_with_skus(1, 2)
+        sku_ids = list(goods.sku_set.values_list('id', flat=True))
+
+        # 商品没有所属的频道
+        done, failed = command.render_goods_skus((goods.id, sku_ids))
+        self.assertEqual(done, [])
+        self.assertEqual(sorted(sku_id for sku_id, _ in failed), sorted(sku_ids))
+        self.assertTrue(all(message.startswith('IndexError') for _, message in failed))
+
+    def test_regenerate_checkpoint_filters(self):
+        """进度记录的筛选条件与本次不同时不继续使用"""
+        checkpoint = os.path.join(self.html_dir, 'checkpoint')
+        with open(checkpoint, 'w') as f:
+            f.write('# filters: {"category": null, "goods": [1], "since": null}\n1\n')
+
+        with self.assertRaises(CommandError):
+            call_command('regenerate_static_detail_html', goods=[2], checkpoint=checkpoint, stdout=StringIO())
+
+        call_command('regenerate_static_detail_html', goods=[1], checkpoint=checkpoint, stdout=StringIO())
+        self.assertFalse(os.path.exists(checkpoint))
+
+    @mock.patch('celery_tasks.html.tasks.flush_static_detail_html.apply_async')
+    @mock.patch('celery_tasks.html.tasks.generate_static_goods_detail_html')
+    def test_coalesce(self, generate, apply_async):
+        """合并窗口内对同一商品的多次请求只生成一次，只安排一次flush任务"""
+        from celery_tasks.html import tasks
+
+        for _ in range(3):
+            tasks.request_static_goods_detail_html(1)
+        tasks.request_static_goods_detail_html(2)
+        self.assertEqual(apply_async.call_count, 1)
+
+        tasks.flush_static_detail_html()
+        self.assertEqual(sorted(call[0][0] for call in generate.call_args_list), [1, 2])
+        self.assertEqual(tasks.get_static_html_counters(), {'requests': 4, 'renders': 2})
+
+    @mock.patch('celery_tasks.html.tasks.flush_static_detail_html.apply_async')
+    @mock.patch('celery_tasks.html.tasks.generate_static_goods_detail_html')
+    def test_flush_failed(self, generate, apply_async):
+        """已删除的商品不再重试，其余失败的商品重试MAX_ATTEMPTS次之后放弃，重试不计入请求数量"""
+        from celery_tasks.html import tasks
+
+        def fail(goods_id):
+            if goods_id == 1:
+                raise Goods.DoesNotExist
+            raise IndexError
+
+        generate.side_effect = fail
+        redis_conn = get_redis_connection('default')
+
+        tasks.request_static_goods_detail_html(1)
+        tasks.request_static_goods_detail_html(2)
+
+        for _ in range(tasks.MAX_ATTEMPTS):
+            tasks.flush_static_detail_html()
+        self.assertEqual(generate.call_count, 1 + tasks.MAX_ATTEMPTS)
+        self.assertFalse(redis_conn.exists(tasks.PENDING_GOODS_KEY))
+        self.assertFalse(redis_conn.exists(tasks.ATTEMPTS_KEY))
+        self.assertEqual(tasks.get_static_html_counters(), {'requests': 2, 'renders': 0})
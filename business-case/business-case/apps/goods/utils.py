@@ -1,12 +1,70 @@
+import copy
+import json
+import threading
+import time
 from collections import OrderedDict
 
-from goods.models import GoodsChannel
+from django.db.models import Count
+from django_redis import get_redis_connection
+
+from goods.models import GoodsCategory, GoodsChannel, SpecificationOption, SKU, SKUSpecification
+
+
+# 商品分类菜单数据版本号，商品类别或频道数据变化时递增
+CATEGORIES_VERSION_KEY = 'categories_version'
+# 商品分类菜单数据在redis中的缓存键: categories_<version>
+CATEGORIES_CACHE_KEY = 'categories_%s'
+# 商品分类菜单数据在redis中的缓存有效期: s
+CATEGORIES_CACHE_EXPIRES = 24 * 60 * 60
+
+# 进程内缓存的商品分类菜单: (version, categories)
+_local_categories = (None, None)
+
+
+def build_categories():
+    """
+    从数据库中一次性查询出所有商品类别和频道，在内存中构建商品分类菜单
+    :return [(group_id, {'channels': [], 'sub_cats': []}), ...]
+    """
+    # 所有商品类别: 1次查询
+    # {
+    #     '<parent_id>': [{'id':, 'name':}, ...],
+    #     ...
+    # }
+    names = {}
+    children = {}
+    for cat_id, name, parent_id in GoodsCategory.objects.order_by('id').values_list('id', 'name', 'parent_id'):
+        names[cat_id] = name
+        children.setdefault(parent_id, []).append({'id': cat_id, 'name': name})
+
+    # 所有商品频道: 1次查询
+    categories = OrderedDict()
+    channels = GoodsChannel.objects.order_by('group_id', 'sequence').values_list('group_id', 'category_id', 'url')
+    for group_id, cat1_id, url in channels:
+        if group_id not in categories:
+            categories[group_id] = {'channels': [], 'sub_cats': []}
+
+        # 追加当前频道
+        categories[group_id]['channels'].append({
+            'id': cat1_id,
+            'name': names.get(cat1_id),
+            'url': url
+        })
+        # 构建当前类别的子类别
+        for cat2 in children.get(cat1_id, []):
+            categories[group_id]['sub_cats'].append({
+                'id': cat2['id'],
+                'name': cat2['name'],
+                'sub_cats': children.get(cat2['id'], [])
+            })
+
+    return list(categories.items())
 
 
 def get_categories():
     """
     获取商城商品分类菜单
-    :return 菜单字典
+    :return 菜单字典，每次返回进程内缓存的副本，调用者修改返回值不会影响缓存
     """
     # 商品频道及分类菜单
     # 使用有序字典保存类别的顺序
@@ -19,26 +77,517 @@ def get_categories():
     #
     #     }
     # }
-    categories = OrderedDict()
-    channels = GoodsChannel.objects.order_by('group_id', 'sequence')
-    for channel in channels:
-        group_id = channel.group_id  # 当前组
+    global _local_categories
 
-        if group_id not in categories:
-            categories[group_id] = {'channels': [], 'sub_cats': []}
+    redis_conn = get_redis_connection('default')
+    version = redis_conn.get(CATEGORIES_VERSION_KEY)
+    version = int(version) if version is not None else 0
 
-        cat1 = channel.category  # 当前频道的类别
+    # 进程内缓存的版本与redis中一致，直接使用
+    local_version, categories = _local_categories
+    if local_version == version:
+        return copy.deepcopy(categories)
 
-        # 追加当前频道
-        categories[group_id]['channels'].append({
-            'id': cat1.id,
-            'name': cat1.name,
-            'url': channel.url
-        })
-        # 构建当前类别的子类别
-        for cat2 in cat1.goodscategory_set.all():
-            cat2.sub_cats = []
-            for cat3 in cat2.goodscategory_set.all():
-                cat2.sub_cats.append(cat3)
-            categories[group_id]['sub_cats'].append(cat2)
-    return categories
+    cache_key = CATEGORIES_CACHE_KEY % version
+    cached = redis_conn.get(cache_key)
+
+    if cached is not None:
+        items = json.loads(cached.decode())
+    else:
+        items = build_categories()
+        redis_conn.set(cache_key, json.dumps(items), ex=CATEGORIES_CACHE_EXPIRES)
+
+    categories = OrderedDict((group_id, group) for group_id, group in items)
+    _local_categories = (version, categories)
+
+    return copy.deepcopy(categories)
+
+
+def invalidate_categories():
+    """商品类别或频道数据发生变化，使缓存的商品分类菜单失效"""
+    redis_conn = get_redis_connection('default')
+    redis_conn.incr(CATEGORIES_VERSION_KEY)
+
+
+class LRUCache(object):
+    """进程内的LRU缓存，缓存项超过有效期之后失效"""
+    def __init__(self, max_size, expires):
+        self.max_size = max_size
+        self.expires = expires
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_many(self, keys):
+        """批量获取未过期的缓存项: {key: value, ...}"""
+        now = time.time()
+        res = {}
+        with self._lock:
+            for key in keys:
+                item = self._data.get(key)
+                if item is None:
+                    continue
+                value, expire_at = item
+                if expire_at < now:
+                    del self._data[key]
+                    continue
+                self._data.move_to_end(key)
+                res[key] = value
+        return res
+
+    def set_many(self, mapping):
+        """批量设置缓存项，超出容量时淘汰最久未使用的缓存项"""
+        expire_at = time.time() + self.expires
+        with self._lock:
+            for key, value in mapping.items():
+                self._data[key] = (value, expire_at)
+                self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+# sku摘要数据包含的字段
+SKU_SUMMARY_FIELDS = ('id', 'name', 'price', 'default_image_url', 'comments')
+# sku摘要数据在redis中的缓存键: sku_summary_<sku_id>
+SKU_SUMMARY_CACHE_KEY = 'sku_summary_%s'
+# sku摘要数据在redis中的缓存有效期: s
+SKU_SUMMARY_CACHE_EXPIRES = 60 * 60
+# 进程内sku摘要数据缓存的容量和有效期(其他进程修改sku时无法通知到本进程，所以有效期较短): s
+SKU_SUMMARY_LOCAL_MAX_SIZE = 2000
+SKU_SUMMARY_LOCAL_EXPIRES = 10
+
+_local_sku_summaries = LRUCache(SKU_SUMMARY_LOCAL_MAX_SIZE, SKU_SUMMARY_LOCAL_EXPIRES)
+
+
+def clear_local_caches():
+    """清空进程内的商品分类菜单和sku摘要缓存(测试用例之间使用)"""
+    global _local_categories
+    _local_categories = (None, None)
+    _local_sku_summaries.clear()
+
+
+def get_sku_summary_map(sku_ids):
+    """
+    批量获取sku的摘要数据，依次从进程内缓存、redis缓存和数据库中读取:
+    sku_ids: sku id列表
+    :return 已不存在的sku不会包含在结果中
+    {
+        '<sku_id>': {'id':, 'name':, 'price':, 'default_image_url':, 'comments':},
+        ...
+    }
+    """
+    sku_ids = [int(sku_id) for sku_id in sku_ids]
+    if not sku_ids:
+        return {}
+
+    # 先从进程内缓存中获取
+    summaries = _local_sku_summaries.get_many(sku_ids)
+
+    # 再从redis缓存中批量获取
+    missing_ids = [sku_id for sku_id in sku_ids if sku_id not in summaries]
+    if not missing_ids:
+        return summaries
+
+    redis_conn = get_redis_connection('default')
+    cached = redis_conn.mget([SKU_SUMMARY_CACHE_KEY % sku_id for sku_id in missing_ids])
+
+    fetched = {}
+    for sku_id, data in zip(missing_ids, cached):
+        if data is not None:
+            fetched[sku_id] = json.loads(data.decode())
+
+    # 缓存中没有的sku一次性从数据库查询，并写入redis缓存
+    missing_ids = [sku_id for sku_id in missing_ids if sku_id not in fetched]
+    if missing_ids:
+        pl = redis_conn.pipeline()
+        for summary in SKU.objects.filter(id__in=missing_ids).values(*SKU_SUMMARY_FIELDS):
+            summary['price'] = str(summary['price'])
+            fetched[summary['id']] = summary
+            pl.set(SKU_SUMMARY_CACHE_KEY % summary['id'], json.dumps(summary), ex=SKU_SUMMARY_CACHE_EXPIRES)
+        pl.execute()
+
+    _local_sku_summaries.set_many(fetched)
+    summaries.update(fetched)
+
+    return summaries
+
+
+def get_sku_summaries(sku_ids):
+    """
+    批量获取sku的摘要数据:
+    sku_ids: sku id列表
+    :return 按sku_ids顺序排列的摘要数据列表，已不存在的sku会被忽略
+    [
+        {'id':, 'name':, 'price':, 'default_image_url':, 'comments':},
+        ...
+    ]
+    """
+    sku_ids = [int(sku_id) for sku_id in sku_ids]
+    summaries = get_sku_summary_map(sku_ids)
+
+    return [dict(summaries[sku_id]) for sku_id in sku_ids if sku_id in summaries]
+
+
+def invalidate_sku_summary(sku_id):
+    """sku数据发生变化，使缓存的sku摘要数据失效"""
+    _local_sku_summaries.delete(sku_id)
+
+    redis_conn = get_redis_connection('default')
+    redis_conn.delete(SKU_SUMMARY_CACHE_KEY % sku_id)
+
+
+# sku价格版本号，任何sku的价格发生变化时递增，用于判断按旧价格计算的数据是否失效
+SKU_PRICE_VERSION_KEY = 'sku_price_version'
+
+
+def get_sku_price_version():
+    """获取sku价格版本号"""
+    redis_conn = get_redis_connection('default')
+    version = redis_conn.get(SKU_PRICE_VERSION_KEY)
+
+    return int(version) if version is not None else 0
+
+
+def incr_sku_price_version():
+    """sku价格发生变化，递增价格版本号"""
+    redis_conn = get_redis_connection('default')
+    redis_conn.incr(SKU_PRICE_VERSION_KEY)
+
+
+# sku库存和上架状态在redis中的镜像: hash {'<sku_id>': '<stock>,<is_launched>', ...}
+SKU_STOCK_KEY = 'sku_stock'
+# 已在redis中预扣、尚未写回数据库的商品数量: hash {'<sku_id>': '<count>', ...}
+SKU_STOCK_PENDING_KEY = 'sku_stock_pending'
+# 正在写回数据库的商品数量: hash {'<sku_id>': '<count>', ...}
+SKU_STOCK_INFLIGHT_KEY = 'sku_stock_inflight'
+# 已预扣、订单尚未提交的商品数量: hash {'<sku_id>': '<count>', ...}
+SKU_STOCK_RESERVED_KEY = 'sku_stock_reserved'
+
+# 根据数据库中的库存设置镜像，镜像库存 = 数据库库存 - 尚未写回数据库的预扣数量
+# KEYS[1]: sku_stock KEYS[2]: sku_stock_pending KEYS[3]: sku_stock_inflight KEYS[4]: sku_stock_reserved
+# ARGV: sku_id, stock, is_launched, sku_id, stock, is_launched, ...
+# 返回: [stock, stock, ...]
+SET_SKU_STOCKS_SCRIPT = """
+local res = {}
+for i = 1, #ARGV, 3 do
+    local reserved = 0
+    for j = 2, 4 do
+        reserved = reserved + tonumber(redis.call('hget', KEYS[j], ARGV[i]) or 0)
+    end
+    local stock = tonumber(ARGV[i + 1]) - reserved
+    redis.call('hset', KEYS[1], ARGV[i], stock .. ',' .. ARGV[i + 2])
+    res[#res + 1] = stock
+end
+return res
+"""
+
+# 按增量修改镜像中的库存，镜像中没有的sku不做处理(下次查询时从数据库加载)
+# KEYS[1]: sku_stock
+# ARGV: sku_id, delta, sku_id, delta, ...
+INCR_SKU_STOCKS_SCRIPT = """
+for i = 1, #ARGV, 2 do
+    local value = redis.call('hget', KEYS[1], ARGV[i])
+    if value then
+        local stock, is_launched = string.match(value, '^(-?%d+),(%d)$')
+        redis.call('hset', KEYS[1], ARGV[i], (tonumber(stock) + tonumber(ARGV[i + 1])) .. ',' .. is_launched)
+    end
+end
+return #ARGV / 2
+"""
+
+
+def get_sku_stocks(sku_ids):
+    """
+    批量获取sku的库存和上架状态，redis镜像中没有的sku从数据库查询并写入镜像:
+    sku_ids: sku id列表
+    :return 不存在的sku不会包含在结果中
+    {
+        '<sku_id>': {'stock':, 'is_launched':},
+        ...
+    }
+    """
+    sku_ids = [int(sku_id) for sku_id in sku_ids]
+    if not sku_ids:
+        return {}
+
+    redis_conn = get_redis_connection('default')
+    cached = redis_conn.hmget(SKU_STOCK_KEY, sku_ids)
+
+    stocks = {}
+    for sku_id, value in zip(sku_ids, cached):
+        if value is not None:
+            stock, is_launched = value.decode().split(',')
+            stocks[sku_id] = {'stock': int(stock), 'is_launched': is_launched == '1'}
+
+    missing_ids = [sku_id for sku_id in sku_ids if sku_id not in stocks]
+    if missing_ids:
+        mapping = {}
+        for sku_id, stock, is_launched in SKU.objects.filter(id__in=missing_ids).values_list(
+                'id', 'stock', 'is_launched'):
+            mapping[sku_id] = (stock, is_launched)
+
+        stocks.update(set_sku_stocks(mapping))
+
+    return stocks
+
+
+def get_sku_stock(sku_id):
+    """获取单个sku的库存和上架状态，sku不存在时返回None"""
+    return get_sku_stocks([sku_id]).get(int(sku_id))
+
+
+def set_sku_stocks(mapping):
+    """
+    根据数据库中的库存更新redis镜像中sku的库存和上架状态:
+    mapping: {'<sku_id>': ('<stock>', '<is_launched>'), ...}
+    :return {'<sku_id>': {'stock':, 'is_launched':}, ...}
+    """
+    if not mapping:
+        return {}
+
+    args = []
+    for sku_id, (stock, is_launched) in mapping.items():
+        args.extend([sku_id, stock, 1 if is_launched else 0])
+
+    redis_conn = get_redis_connection('default')
+    script = redis_conn.register_script(SET_SKU_STOCKS_SCRIPT)
+    res = script(keys=[SKU_STOCK_KEY, SKU_STOCK_PENDING_KEY, SKU_STOCK_INFLIGHT_KEY, SKU_STOCK_RESERVED_KEY], args=args)
+
+    return {
+        sku_id: {'stock': int(stock), 'is_launched': is_launched}
+        for (sku_id, (_, is_launched)), stock in zip(mapping.items(), res)
+    }
+
+
+def incr_sku_stocks(deltas):
+    """
+    按增量修改redis镜像中sku的库存(数据库中的库存已按相同的数量修改并提交):
+    deltas: {'<sku_id>': '<delta>', ...}
+    多个事务的提交顺序与执行回调的顺序不同时，增量修改的结果也不会被旧的库存覆盖
+    """
+    args = []
+    for sku_id, delta in deltas.items():
+        if delta:
+            args.extend([sku_id, delta])
+
+    if not args:
+        return
+
+    redis_conn = get_redis_connection('default')
+    script = redis_conn.register_script(INCR_SKU_STOCKS_SCRIPT)
+    script(keys=[SKU_STOCK_KEY], args=args)
+
+
+def delete_sku_stock(sku_id):
+    """从redis镜像中删除sku的库存和上架状态"""
+    redis_conn = get_redis_connection('default')
+    redis_conn.hdel(SKU_STOCK_KEY, sku_id)
+
+
+# 每个第三级分类下已上架sku的数量: hash {'<category_id>': '<count>', ...}
+SKU_CATEGORY_COUNT_KEY = 'sku_category_count'
+# 每个分类数量的修改次数: hash {'<category_id>': '<gen>', ...}，用于判断从数据库统计期间是否有数量变化
+SKU_CATEGORY_COUNT_GEN_KEY = 'sku_category_count_gen'
+
+# 只修改已缓存的分类数量，未缓存的分类在下次查询时从数据库统计；无论是否已缓存都递增修改次数
+# KEYS[1]: sku_category_count KEYS[2]: sku_category_count_gen
+# ARGV: category_id, delta, category_id, delta, ...
+INCR_CATEGORY_COUNT_SCRIPT = """
+for i = 1, #ARGV, 2 do
+    redis.call('hincrby', KEYS[2], ARGV[i], 1)
+    if redis.call('hexists', KEYS[1], ARGV[i]) == 1 then
+        redis.call('hincrby', KEYS[1], ARGV[i], ARGV[i + 1])
+    end
+end
+return #ARGV / 2
+"""
+
+# 缓存从数据库统计的分类数量，统计期间修改次数发生变化(统计结果可能已过期)时不缓存
+# KEYS[1]: sku_category_count KEYS[2]: sku_category_count_gen
+# ARGV[1]: category_id ARGV[2]: 统计之前的修改次数(没有时为空字符串) ARGV[3]: 统计的数量
+SET_CATEGORY_COUNT_SCRIPT = """
+if (redis.call('hget', KEYS[2], ARGV[1]) or '') ~= ARGV[2] then
+    return 0
+end
+return redis.call('hsetnx', KEYS[1], ARGV[1], ARGV[3])
+"""
+
+# 对账: 按数据库统计的数量修正缓存，统计期间修改次数发生变化的分类删除缓存，下次查询时重新统计
+# KEYS[1]: sku_category_count KEYS[2]: sku_category_count_gen
+# ARGV: category_id, 统计之前的修改次数(没有时为空字符串), 统计的数量, ...
+# 返回: 修正的分类数量
+RECONCILE_CATEGORY_COUNT_SCRIPT = """
+local fixed = 0
+for i = 1, #ARGV, 3 do
+    local count = redis.call('hget', KEYS[1], ARGV[i])
+    if (redis.call('hget', KEYS[2], ARGV[i]) or '') ~= ARGV[i + 1] then
+        redis.call('hdel', KEYS[1], ARGV[i])
+    elseif count ~= ARGV[i + 2] then
+        redis.call('hset', KEYS[1], ARGV[i], ARGV[i + 2])
+        if tonumber(count or 0) ~= tonumber(ARGV[i + 2]) then
+            fixed = fixed + 1
+        end
+    end
+end
+return fixed
+"""
+
+
+def get_category_sku_count(category_id):
+    """获取分类下已上架sku的数量，缓存中没有时从数据库统计"""
+    redis_conn = get_redis_connection('default')
+    pl = redis_conn.pipeline()
+    pl.hget(SKU_CATEGORY_COUNT_KEY, category_id)
+    pl.hget(SKU_CATEGORY_COUNT_GEN_KEY, category_id)
+    count, gen = pl.execute()
+    if count is not None:
+        return int(count)
+
+    # 先读取修改次数再统计，统计期间提交的增减会递增修改次数，此时不缓存统计结果
+    count = SKU.objects.filter(category_id=category_id, is_launched=True).count()
+    script = redis_conn.register_script(SET_CATEGORY_COUNT_SCRIPT)
+    script(keys=[SKU_CATEGORY_COUNT_KEY, SKU_CATEGORY_COUNT_GEN_KEY],
+           args=[category_id, gen.decode() if gen is not None else '', count])
+
+    return count
+
+
+def incr_category_sku_counts(deltas):
+    """
+    增减分类下已上架sku的数量:
+    deltas: {'<category_id>': '<delta>', ...}
+    """
+    args = []
+    for category_id, delta in deltas.items():
+        if delta:
+            args.extend([category_id, delta])
+
+    if not args:
+        return
+
+    redis_conn = get_redis_connection('default')
+    script = redis_conn.register_script(INCR_CATEGORY_COUNT_SCRIPT)
+    script(keys=[SKU_CATEGORY_COUNT_KEY, SKU_CATEGORY_COUNT_GEN_KEY], args=args)
+
+
+def reconcile_category_sku_counts():
+    """
+    对账: 按数据库重新统计所有分类下已上架sku的数量
+    与get_category_sku_count相同，先读取修改次数再统计，统计期间数量有变化的分类不写入统计结果
+    返回修正的分类数量
+    """
+    redis_conn = get_redis_connection('default')
+    gens = {int(category_id): gen.decode() for category_id, gen in
+            redis_conn.hgetall(SKU_CATEGORY_COUNT_GEN_KEY).items()}
+
+    counts = {}
+    for category_id, count in SKU.objects.filter(is_launched=True).values_list('category_id').annotate(
+            count=Count('id')).order_by():
+        counts[category_id] = count
+
+    # 缓存中有、数据库中已没有已上架sku的分类数量修正为0
+    for category_id in redis_conn.hkeys(SKU_CATEGORY_COUNT_KEY):
+        counts.setdefault(int(category_id), 0)
+
+    if not counts:
+        return 0
+
+    args = []
+    for category_id, count in counts.items():
+        args.extend([category_id, gens.get(category_id, ''), count])
+
+    script = redis_conn.register_script(RECONCILE_CATEGORY_COUNT_SCRIPT)
+    return script(keys=[SKU_CATEGORY_COUNT_KEY, SKU_CATEGORY_COUNT_GEN_KEY], args=args)
+
+
+class SpecMatrix(object):
+    """
+    商品规格矩阵:
+    一次性批量加载某个商品(SPU)下所有的规格、规格选项以及SKU具体规格，
+    在内存中构建`规格键-sku字典`，供生成各个SKU静态详情页面时使用
+    """
+    def __init__(self, goods):
+        self.goods = goods
+
+        # 当前商品的规格信息，按id排序
+        # select * from tb_goods_specification where goods_id=<goods_id> order by id;
+        self.specs = list(goods.goodsspecification_set.order_by('id'))
+
+        # 各规格对应的选项
+        # {
+        #     '<spec_id>': [option, option, ...],
+        #     ...
+        # }
+        self.spec_options = {spec.id: [] for spec in self.specs}
+        options = SpecificationOption.objects.filter(spec__goods=goods).order_by('spec_id', 'id')
+        for option in options:
+            self.spec_options.setdefault(option.spec_id, []).append(option)
+
+        # 各sku的规格键
+        # {
+        #     '<sku_id>': [规格1参数id, 规格2参数id, 规格3参数id, ...],
+        #     ...
+        # }
+        self.sku_keys = {}
+        sku_specs = SKUSpecification.objects.filter(sku__goods=goods).order_by('sku_id', 'spec_id').values_list(
+            'sku_id', 'option_id')
+        for sku_id, option_id in sku_specs:
+            self.sku_keys.setdefault(sku_id, []).append(option_id)
+
+        # 构建不同规格参数（选项）的sku字典
+        # spec_sku_map = {
+        #     (规格1参数id, 规格2参数id, 规格3参数id, ...): sku_id,
+        #     ...
+        # }
+        self.spec_sku_map = {}
+        for sku_id, key in self.sku_keys.items():
+            self.spec_sku_map[tuple(key)] = sku_id
+
+    def get_sku_specs(self, sku_id):
+        """
+        获取指定sku详情页面的规格信息:
+        specs = [
+           {
+               'name': '屏幕尺寸',
+               'options': [
+                   {'value': '13.3寸', 'sku_id': xxx},
+                   {'value': '15.4寸', 'sku_id': xxx},
+               ]
+           },
+           ...
+        ]
+        若当前sku的规格信息不完整，返回None
+        """
+        sku_key = self.sku_keys.get(sku_id, [])
+
+        if len(sku_key) < len(self.specs):
+            return None
+
+        specs = []
+        for index, spec in enumerate(self.specs):
+            # 复制当前sku的规格键
+            key = sku_key[:]
+            options = []
+            for option in self.spec_options[spec.id]:
+                # 在规格参数sku字典中查找符合当前规格的sku
+                key[index] = option.id
+                options.append({
+                    'id': option.id,
+                    'value': option.value,
+                    'sku_id': self.spec_sku_map.get(tuple(key))
+                })
+
+            specs.append({
+                'id': spec.id,
+                'name': spec.name,
+                'options': options
+            })
+
+        return specs
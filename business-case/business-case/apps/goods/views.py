@@ -7,6 +7,8 @@ from drf_haystack.viewsets import HaystackViewSet
 
 from goods.models import SKU
 from goods.serializers import SKUSerializer, SKUIndexSerializer
+from goods.utils import get_sku_summaries, get_category_sku_count
+from meiduo_mall.utils.pagination import CachedCountPagination, OrderingKeysetPagination
 
 
 # Create your views here.
@@ -26,6 +28,7 @@ class SKUSearchViewSet(HaystackViewSet):
 
 
 # GET /categories/(?P<category_id>\d+)/skus/?page=<页码>&page_size=<页容量>&ordering=<排序字段>
+# GET /categories/(?P<category_id>\d+)/skus/?pagination=cursor&cursor=<游标>&page_size=<页容量>&ordering=<排序字段>
 class SKUListView(ListAPIView):
     serializer_class = SKUSerializer
     # 指定当前视图所使用的查询集
@@ -40,6 +43,41 @@ class SKUListView(ListAPIView):
     # 指定排序字段
     ordering_fields = ('create_time', 'price', 'sales')
 
+    # 分类下已上架sku的数量从缓存中获取，页码分页时不再执行COUNT(*)
+    pagination_class = CachedCountPagination
+
+    def get_cached_count(self):
+        """返回分类下已上架sku的数量"""
+        return get_category_sku_count(self.kwargs['category_id'])
+
+    @property
+    def paginator(self):
+        """
+        pagination=cursor时使用键集分页，翻到深页时不需要OFFSET扫描和COUNT(*)
+        否则使用默认的页码分页
+        """
+        if not hasattr(self, '_paginator'):
+            if self.request.query_params.get('pagination') == 'cursor':
+                self._paginator = OrderingKeysetPagination()
+            else:
+                self._paginator = self.pagination_class()
+        return self._paginator
+
+    def list(self, request, *args, **kwargs):
+        """
+        获取分类SKU商品的列表数据:
+        数据库只负责过滤、排序和分页，商品数据从sku摘要缓存中获取
+        """
+        queryset = self.filter_queryset(self.get_queryset()).only('id', *self.ordering_fields)
+
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            skus = get_sku_summaries([sku.id for sku in page])
+            return self.get_paginated_response(skus)
+
+        skus = get_sku_summaries([sku.id for sku in queryset])
+        return Response(skus)
+
     # def get(self, request, category_id):
     #     """
     #     self.kwargs: 保存从url地址中提取的所有命名参数
@@ -0,0 +1,42 @@
+import threading
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from orders.utils import OrderIdGenerator
+
+
+class Command(BaseCommand):
+    help = '测试订单id生成器的速度，并检查多线程同时生成时id是否重复'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--number', type=int, default=1000000, help='每个线程生成的id数量')
+        parser.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4, 8], help='线程数量')
+
+    def handle(self, *args, **options):
+        number = options['number']
+
+        self.stdout.write('%8s %12s %10s %14s' % ('threads', 'ids', 'time(s)', 'ids/sec'))
+
+        for threads in options['threads']:
+            generator = OrderIdGenerator(worker_id=0)
+            results = [None] * threads
+
+            def run(index):
+                next_id = generator.next_id
+                results[index] = [next_id() for _ in range(number)]
+
+            workers = [threading.Thread(target=run, args=(i, )) for i in range(threads)]
+
+            start = time.time()
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            elapsed = time.time() - start
+
+            total = number * threads
+            if len(set(order_id for ids in results for order_id in ids)) != total:
+                raise CommandError('%s个线程生成的订单id有重复' % threads)
+
+            self.stdout.write('%8s %12s %10.2f %14.0f' % (threads, total, elapsed, total / elapsed if elapsed else 0))
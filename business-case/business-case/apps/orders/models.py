@@ -50,6 +50,10 @@ class OrderInfo(BaseModel):
         db_table = "tb_order_info"
         verbose_name = '订单基本信息'
         verbose_name_plural = verbose_name
+        indexes = [
+            # 用户订单列表按(create_time, order_id)键集分页，InnoDB二级索引中已包含主键order_id
+            models.Index(fields=['user', 'create_time'], name='order_info_user_ctime_idx'),
+        ]
 
 
 class OrderGoods(BaseModel):
@@ -1,13 +1,18 @@
-from datetime import datetime
 from decimal import Decimal
 
+from django.conf import settings
 from django.db import transaction
+from django.db.models import Case, F, Q, When
 
-from django_redis import get_redis_connection
 from rest_framework import serializers
 
+from cart.storage import get_redis_cart
 from goods.models import SKU
+from goods import stock
+from goods.utils import get_sku_stocks, incr_sku_stocks, get_sku_price_version
+from orders import snapshots
 from orders.models import OrderInfo, OrderGoods
+from orders.utils import generate_order_id
 
 
 class OrderSKUSerializer(serializers.ModelSerializer):
@@ -23,13 +28,41 @@ class OrderSettlementSerializer(serializers.Serializer):
     """订单结算序列化器类"""
     freight = serializers.DecimalField(label='订单运费', max_digits=10, decimal_places=2)
     skus = OrderSKUSerializer(label='结算商品', many=True)
+    snapshot = serializers.CharField(label='结算快照id')
+
+
+class OrderListSKUSerializer(serializers.ModelSerializer):
+    """用户订单列表中商品的序列化器类"""
+    class Meta:
+        model = SKU
+        fields = ('id', 'name', 'default_image_url')
+
+
+class OrderGoodsSerializer(serializers.ModelSerializer):
+    """用户订单列表中订单商品的序列化器类"""
+    sku = OrderListSKUSerializer(label='商品')
+
+    class Meta:
+        model = OrderGoods
+        fields = ('sku', 'count', 'price')
+
+
+class OrderListSerializer(serializers.ModelSerializer):
+    """用户订单列表序列化器类"""
+    skus = OrderGoodsSerializer(label='订单商品', many=True)
+
+    class Meta:
+        model = OrderInfo
+        fields = ('order_id', 'create_time', 'total_count', 'total_amount', 'freight', 'pay_method', 'status', 'skus')
 
 
 class OrderSerializer(serializers.ModelSerializer):
     """订单数据保存序列化器类"""
+    snapshot = serializers.CharField(label='结算快照id', write_only=True, required=False)
+
     class Meta:
         model = OrderInfo
-        fields = ('order_id', 'address', 'pay_method')
+        fields = ('order_id', 'address', 'pay_method', 'snapshot')
         read_only_fields = ('order_id', )
 
         extra_kwargs = {
@@ -44,21 +77,95 @@ class OrderSerializer(serializers.ModelSerializer):
             }
         }
 
+    def get_user(self):
+        """下单用户，异步下单时由celery任务通过context['user']传入"""
+        if 'user' in self.context:
+            return self.context['user']
+
+        return self.context['request'].user
+
+    def validate_snapshot(self, value):
+        """校验结算快照id的签名和所属用户，返回快照的key"""
+        key = snapshots.check_settlement_snapshot(value, self.get_user().id)
+        if key is None:
+            raise serializers.ValidationError('结算信息已过期，请重新结算')
+
+        return key
+
+    def get_snapshot_items(self, key):
+        """
+        从结算快照中获取下单商品的数量和单价，不再读取购物车和查询商品数据:
+        sku价格版本号与结算时一致时直接使用快照中的价格，否则一次查询核对商品的当前价格
+        库存在扣减时检查，不需要额外校验
+        """
+        snapshot = snapshots.take_settlement_snapshot(key)
+        if snapshot is None:
+            raise serializers.ValidationError('结算信息已过期，请重新结算')
+
+        if not snapshot['skus']:
+            raise serializers.ValidationError('没有需要结算的商品')
+
+        cart_dict = {sku_id: count for sku_id, (count, price) in snapshot['skus'].items()}
+        prices = {sku_id: Decimal(price) for sku_id, (count, price) in snapshot['skus'].items()}
+
+        if snapshot['version'] != get_sku_price_version():
+            current = dict(SKU.objects.filter(id__in=list(prices)).values_list('id', 'price'))
+            if current != prices:
+                raise serializers.ValidationError('商品价格已变化，请重新结算')
+
+        # 之后下单失败时放回快照
+        self.taken_snapshot = (key, snapshot)
+
+        return cart_dict, prices
+
+    def save(self, **kwargs):
+        """保存订单数据，使用结算快照下单失败(库存不足、保存失败等)时放回快照，可以重新下单"""
+        self.taken_snapshot = None
+
+        try:
+            return super().save(**kwargs)
+        except Exception:
+            if self.taken_snapshot is not None:
+                snapshots.restore_settlement_snapshot(*self.taken_snapshot)
+            raise
+
+    def get_cart_items(self, redis_cart, check_stock=True):
+        """
+        从redis购物车中获取勾选商品的数量，并一次查询获取商品的单价:
+        cart_dict: {'<sku_id>': '<count>', ...}
+        prices: {'<sku_id>': '<price>', ...}
+        """
+        cart_dict = redis_cart.get_selected()
+        if not cart_dict:
+            raise serializers.ValidationError('购物车中没有勾选的商品')
+        sku_ids = list(cart_dict.keys())
+
+        # 一次查询获取所有商品
+        # select * from tb_sku where id in (<sku_id>, ...);
+        skus = SKU.objects.in_bulk(sku_ids)
+        if len(skus) != len(sku_ids):
+            raise serializers.ValidationError('商品不存在')
+
+        # 判断商品的库存是否足够
+        if check_stock and any(count > skus[sku_id].stock for sku_id, count in cart_dict.items()):
+            raise serializers.ValidationError('商品库存不足')
+
+        return cart_dict, {sku_id: sku.price for sku_id, sku in skus.items()}
+
     def create(self, validated_data):
-        """保存订单数据-乐观锁"""
+        """保存订单数据-条件更新，语句数量与订单中的商品数量无关"""
+        if settings.ORDER_STOCK_RESERVATION:
+            return self.create_reserved(validated_data)
+
         # 获取address和pay_method
         address = validated_data['address']
         pay_method = validated_data['pay_method']
 
-        # 获取登录user
-        user = self.context['request'].user
+        # 获取下单user
+        user = self.get_user()
 
-        # 订单id: 年月日时分秒+用户id
-        order_id = datetime.now().strftime('%Y%m%d%H%M%S') + '%010d' % user.id
-
-        # 订单商品总数据和实付款
-        total_count = 0
-        total_amount = Decimal(0)
+        # 订单id: Snowflake格式，同一用户同一秒内多次下单也不会重复
+        order_id = generate_order_id()
 
         # 运费
         freight = Decimal(10)
@@ -71,33 +178,64 @@ class OrderSerializer(serializers.ModelSerializer):
 
         status = OrderInfo.ORDER_STATUS_ENUM['UNSEND'] if pay_method == OrderInfo.PAY_METHODS_ENUM['CASH'] else OrderInfo.ORDER_STATUS_ENUM['UNPAID']
 
-        # 2）订单中包含几个商品，需要向订单商品表中添加几条记录。
-        redis_conn = get_redis_connection('cart')
-
-        # 从redis set元素获取用户所要购买的商品id
-        cart_selected_key = 'cart_selected_%s' % user.id
-
-        # (b'<sku_id>', b'<sku_id>', ...)
-        sku_ids = redis_conn.smembers(cart_selected_key)
-
-        # 从redis hash元素中获取用户购物车商品的id和对应数量count
-        cart_key = 'cart_%s' % user.id
+        # 获取用户所要购买的商品id和对应数量count，以及商品单价
+        # 传递了结算快照时使用结算时保存的数据，否则从redis购物车中获取
         # {
-        #     b'<sku_id>': b'<count>',
+        #     '<sku_id>': '<count>',
         #     ...
         # }
-        cart_dict = redis_conn.hgetall(cart_key)
+        redis_cart = get_redis_cart(user.id)
+        if 'snapshot' in validated_data:
+            cart_dict, prices = self.get_snapshot_items(validated_data['snapshot'])
+        else:
+            cart_dict, prices = self.get_cart_items(redis_cart)
+        sku_ids = list(cart_dict.keys())
+
+        # 订单商品总数据和实付款
+        total_count = 0
+        total_amount = Decimal(0)
+
+        order_goods = []
+        for sku_id, count in cart_dict.items():
+            price = prices[sku_id]
+            order_goods.append(OrderGoods(order_id=order_id, sku_id=sku_id, count=count, price=price))
+
+            # 累加计算订单中商品的总数量和总金额
+            total_count += count
+            total_amount += price * count
+
+        # 实付款
+        total_amount += freight
 
         order = None
 
         with transaction.atomic():
-            # with语句块中的代码，凡是涉及到数据库操作的，在进行数据库操作时，都会放在同一个事务中
-
             # 设置事务的保存点
             sid = transaction.savepoint()
 
             try:
-                # 1）向订单基本信息表中添加一条记录。
+                # 一条语句扣减所有商品的库存，库存不足的商品不会被更新
+                # update tb_sku
+                # set stock=case id when <sku_id> then stock-<count> ... end,
+                #     sales=case id when <sku_id> then sales+<count> ... end
+                # where (id=<sku_id> and stock>=<count>) or ...;
+                # 返回结果为更新的行数
+                condition = Q()
+                stock_cases = []
+                sales_cases = []
+                for sku_id, count in cart_dict.items():
+                    condition |= Q(id=sku_id, stock__gte=count)
+                    stock_cases.append(When(id=sku_id, then=F('stock') - count))
+                    sales_cases.append(When(id=sku_id, then=F('sales') + count))
+
+                res = SKU.objects.filter(condition).update(stock=Case(*stock_cases), sales=Case(*sales_cases))
+
+                if res != len(sku_ids):
+                    # 有商品在查询之后被其他订单买走，回滚事务到sid保存点
+                    transaction.savepoint_rollback(sid)
+                    raise serializers.ValidationError('商品库存不足')
+
+                # 向订单基本信息表中添加一条记录，直接保存最终的总数量和总金额
                 order = OrderInfo.objects.create(
                     order_id=order_id,
                     user=user,
@@ -109,75 +247,13 @@ class OrderSerializer(serializers.ModelSerializer):
                     status=status
                 )
 
-                for sku_id in sku_ids:
-                    # 获取用户所要购买的该商品的数量
-                    count = cart_dict[sku_id]
-                    count = int(count)
-
-                    for i in range(3):
-                        # 根据sku_id获取对应商品数据
-                        # select * from tb_sku where id=<sku_id>;
-                        sku = SKU.objects.get(id=sku_id)
-
-                        # 判断商品的库存是否足够
-                        if count > sku.stock:
-                            # 回滚事务到sid保存点
-                            transaction.savepoint_rollback(sid)
-                            raise serializers.ValidationError('商品库存不足')
-
-                        # 记录商品原始库存
-                        origin_stock = sku.stock
-                        new_stock = origin_stock - count
-                        new_sales = sku.sales + count
-
-                        # 模拟订单并发问题
-                        # print('user: %s times: %s stock: %s' % (user.id, i, origin_stock))
-                        # import time
-                        # time.sleep(10)
-
-                        # 商品库存减少，销量增加
-                        # update tb_sku
-                        # set stock=<new_stock>, sales=<new_sales>
-                        # where id=<sku_id>;
-                        # sku.stock -= count
-                        # sku.sales += count
-                        # sku.save()
-
-                        # update tb_sku
-                        # set stock=<new_stock>, sales=<new_sales>
-                        # where id=<sku_id> and stock=<origin_stock>;
-                        # 返回结果为更新的行数
-                        res = SKU.objects.filter(id=sku_id, stock=origin_stock).update(stock=new_stock, sales=new_sales)
-
-                        if res == 0:
-                            if i == 2:
-                                # 回滚事务到sid保存点
-                                transaction.savepoint_rollback(sid)
-                                # 尝试更新了3次，直接报下单失败
-                                raise serializers.ValidationError('下单失败2')
-                            # 更新失败，重新尝试
-                            continue
-
-                        # 向订单商品表中添加一条记录
-                        OrderGoods.objects.create(
-                            order=order,
-                            sku=sku,
-                            count=count,
-                            price=sku.price
-                        )
-
-                        # 累加计算订单中商品的总数量和总金额
-                        total_count += count
-                        total_amount += sku.price*count
-
-                        # 更新成功，跳出循环
-                        break
+                # 向订单商品表中一次添加所有记录
+                OrderGoods.objects.bulk_create(order_goods)
 
-                # 实付款
-                total_amount += freight
-                order.total_count = total_count
-                order.total_amount = total_amount
-                order.save()
+                # 事务提交之后按扣减的数量同步redis中的商品库存镜像
+                # 不写入扣减之后的库存，多个订单的回调执行顺序与提交顺序不同时不会写入旧的库存
+                deltas = {sku_id: -count for sku_id, count in cart_dict.items()}
+                transaction.on_commit(lambda: incr_sku_stocks(deltas))
             except serializers.ValidationError:
                 # 继续向外抛出异常
                 raise
@@ -186,15 +262,94 @@ class OrderSerializer(serializers.ModelSerializer):
                 transaction.savepoint_rollback(sid)
                 raise serializers.ValidationError('下单失败1')
 
-        # 3）清除redis购物车对应的记录。
-        pl = redis_conn.pipeline()
+        # 订单已经保存，之后的失败不再放回结算快照
+        self.taken_snapshot = None
+
+        # 清除redis购物车对应的记录。
+        redis_cart.remove(*sku_ids)
+
+        return order
+
+    def create_reserved(self, validated_data):
+        """保存订单数据-redis预扣库存，库存和销量由celery任务异步写回数据库"""
+        # 获取address和pay_method
+        address = validated_data['address']
+        pay_method = validated_data['pay_method']
 
-        # 删除redis hash中购买的商品id对应属性和值
-        pl.hdel(cart_key, *sku_ids)
-        # 删除redis set中购买商品的勾选状态
-        pl.srem(cart_selected_key, *sku_ids)
+        # 获取下单user
+        user = self.get_user()
 
-        pl.execute()
+        # 订单id: Snowflake格式，同一用户同一秒内多次下单也不会重复
+        order_id = generate_order_id()
+
+        # 运费
+        freight = Decimal(10)
+
+        status = OrderInfo.ORDER_STATUS_ENUM['UNSEND'] if pay_method == OrderInfo.PAY_METHODS_ENUM['CASH'] else OrderInfo.ORDER_STATUS_ENUM['UNPAID']
+
+        # 获取用户所要购买的商品id和对应数量count，以及商品单价
+        # 传递了结算快照时使用结算时保存的数据，否则从redis购物车中获取
+        # {
+        #     '<sku_id>': '<count>',
+        #     ...
+        # }
+        redis_cart = get_redis_cart(user.id)
+        if 'snapshot' in validated_data:
+            cart_dict, prices = self.get_snapshot_items(validated_data['snapshot'])
+        else:
+            cart_dict, prices = self.get_cart_items(redis_cart, check_stock=False)
+        sku_ids = list(cart_dict.keys())
+
+        # 确保商品都已加载到redis库存镜像中
+        get_sku_stocks(sku_ids)
+
+        # 所有商品的库存在一个lua脚本中检查并扣减，不再锁定数据库中的商品记录
+        res, sku_id = stock.reserve_sku_stocks(order_id, cart_dict)
+        if res == stock.RESERVE_NOT_ENOUGH:
+            raise serializers.ValidationError('商品库存不足')
+        elif res == stock.RESERVE_NOT_LAUNCHED:
+            raise serializers.ValidationError('商品已下架')
+        elif res == stock.RESERVE_NOT_EXIST:
+            raise serializers.ValidationError('商品不存在')
+
+        # 订单商品总数据和实付款
+        total_count = 0
+        total_amount = Decimal(0)
+
+        order_goods = []
+        for sku_id, count in cart_dict.items():
+            price = prices[sku_id]
+            order_goods.append(OrderGoods(order_id=order_id, sku_id=sku_id, count=count, price=price))
+
+            total_count += count
+            total_amount += price * count
+
+        try:
+            with transaction.atomic():
+                order = OrderInfo.objects.create(
+                    order_id=order_id,
+                    user=user,
+                    address=address,
+                    total_count=total_count,
+                    total_amount=total_amount + freight,
+                    freight=freight,
+                    pay_method=pay_method,
+                    status=status
+                )
+                OrderGoods.objects.bulk_create(order_goods)
+
+                # 订单提交之后确认预扣的库存，由celery任务写回数据库
+                transaction.on_commit(lambda: stock.confirm_sku_stocks(order_id, cart_dict))
+        except Exception:
+            # 订单保存失败，释放预扣的库存
+            stock.release_sku_stocks(order_id)
+            raise serializers.ValidationError('下单失败1')
+
+        # 订单已经保存，之后的失败不再放回结算快照
+        self.taken_snapshot = None
+
+        # 清除redis购物车对应的记录。
+        redis_cart.remove(*sku_ids)
 
         return order
 
@@ -207,8 +362,8 @@ class OrderSerializer(serializers.ModelSerializer):
         # 获取登录user
         user = self.context['request'].user
 
-        # 订单id: 年月日时分秒+用户id
-        order_id = datetime.now().strftime('%Y%m%d%H%M%S') + '%010d' % user.id
+        # 订单id: Snowflake格式，同一用户同一秒内多次下单也不会重复
+        order_id = generate_order_id()
 
         # 订单商品总数据和实付款
         total_count = 0
@@ -226,21 +381,14 @@ class OrderSerializer(serializers.ModelSerializer):
         status = OrderInfo.ORDER_STATUS_ENUM['UNSEND'] if pay_method == OrderInfo.PAY_METHODS_ENUM['CASH'] else OrderInfo.ORDER_STATUS_ENUM['UNPAID']
 
         # 2）订单中包含几个商品，需要向订单商品表中添加几条记录。
-        redis_conn = get_redis_connection('cart')
-
-        # 从redis set元素获取用户所要购买的商品id
-        cart_selected_key = 'cart_selected_%s' % user.id
-
-        # (b'<sku_id>', b'<sku_id>', ...)
-        sku_ids = redis_conn.smembers(cart_selected_key)
-
-        # 从redis hash元素中获取用户购物车商品的id和对应数量count
-        cart_key = 'cart_%s' % user.id
+        # 从redis中获取用户所要购买的商品id和对应数量count
         # {
-        #     b'<sku_id>': b'<count>',
+        #     '<sku_id>': '<count>',
         #     ...
         # }
-        cart_dict = redis_conn.hgetall(cart_key)
+        redis_cart = get_redis_cart(user.id)
+        cart_dict = redis_cart.get_selected()
+        sku_ids = cart_dict.keys()
 
         order = None
 
@@ -266,7 +414,6 @@ class OrderSerializer(serializers.ModelSerializer):
                 for sku_id in sku_ids:
                     # 获取用户所要购买的该商品的数量
                     count = cart_dict[sku_id]
-                    count = int(count)
 
                     # 根据sku_id获取对应商品数据
                     # select * from tb_sku where id=<sku_id>;
@@ -318,32 +465,6 @@ class OrderSerializer(serializers.ModelSerializer):
                 raise serializers.ValidationError('下单失败1')
 
         # 3）清除redis购物车对应的记录。
-        pl = redis_conn.pipeline()
-
-        # 删除redis hash中购买的商品id对应属性和值
-        pl.hdel(cart_key, *sku_ids)
-        # 删除redis set中购买商品的勾选状态
-        pl.srem(cart_selected_key, *sku_ids)
-
-        pl.execute()
+        redis_cart.remove(*sku_ids)
 
         return order
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
@@ -0,0 +1,86 @@
+import json
+import uuid
+
+from django.conf import settings
+from django.core import signing
+from django_redis import get_redis_connection
+
+# 订单结算快照: string '{"version":, "skus": {"<sku_id>": [<count>, "<price>"], ...}}'
+SETTLEMENT_SNAPSHOT_KEY = 'settlement_snapshot_%s'
+
+# 快照id签名使用的salt
+SETTLEMENT_SNAPSHOT_SALT = 'orders.settlement_snapshot'
+
+
+def create_settlement_snapshot(user_id, cart_dict, prices, version):
+    """
+    保存订单结算快照，返回签名的快照id:
+    cart_dict: {'<sku_id>': '<count>', ...}
+    prices: {'<sku_id>': '<price>', ...}
+    version: 读取价格之前的sku价格版本号
+    """
+    key = uuid.uuid4().hex
+    data = {
+        'version': version,
+        'skus': {str(sku_id): [count, str(prices[sku_id])] for sku_id, count in cart_dict.items()}
+    }
+
+    redis_conn = get_redis_connection('default')
+    redis_conn.setex(SETTLEMENT_SNAPSHOT_KEY % key, settings.ORDER_SETTLEMENT_EXPIRES, json.dumps(data))
+
+    return signing.dumps({'user_id': user_id, 'key': key}, salt=SETTLEMENT_SNAPSHOT_SALT)
+
+
+def check_settlement_snapshot(snapshot_id, user_id):
+    """校验快照id的签名、有效期和所属用户，不需要访问redis，返回快照的key，校验失败时返回None"""
+    try:
+        data = signing.loads(snapshot_id, salt=SETTLEMENT_SNAPSHOT_SALT, max_age=settings.ORDER_SETTLEMENT_EXPIRES)
+    except signing.BadSignature:
+        return None
+
+    if data.get('user_id') != user_id:
+        return None
+
+    return data['key']
+
+
+def take_settlement_snapshot(key):
+    """
+    取出并删除订单结算快照，每个快照只能下单一次，快照不存在或已过期时返回None:
+    {
+        'version': '<sku价格版本号>',
+        'skus': {'<sku_id>': ('<count>', '<price>'), ...},
+        'ttl': '<剩余有效期(ms)>'
+    }
+    下单失败时通过restore_settlement_snapshot放回
+    """
+    redis_conn = get_redis_connection('default')
+    pl = redis_conn.pipeline()
+    pl.get(SETTLEMENT_SNAPSHOT_KEY % key)
+    pl.pttl(SETTLEMENT_SNAPSHOT_KEY % key)
+    pl.delete(SETTLEMENT_SNAPSHOT_KEY % key)
+    data, ttl, _ = pl.execute()
+
+    if data is None:
+        return None
+
+    data = json.loads(data.decode())
+    data['skus'] = {int(sku_id): (count, price) for sku_id, (count, price) in data['skus'].items()}
+    data['ttl'] = ttl
+
+    return data
+
+
+def restore_settlement_snapshot(key, snapshot):
+    """下单失败时放回取出的结算快照(保持原来的剩余有效期)，可以使用同一个快照重新下单"""
+    ttl = snapshot.get('ttl')
+    if not ttl or ttl <= 0:
+        return
+
+    data = {
+        'version': snapshot['version'],
+        'skus': {str(sku_id): [count, price] for sku_id, (count, price) in snapshot['skus'].items()}
+    }
+
+    redis_conn = get_redis_connection('default')
+    redis_conn.set(SETTLEMENT_SNAPSHOT_KEY % key, json.dumps(data), px=ttl, nx=True)
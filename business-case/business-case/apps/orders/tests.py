@@ -1,3 +1,288 @@
-from django.test import TestCase
+import threading
+from unittest import mock
+
+from django.conf import settings
+from django.db import connection
+from django.test import TestCase, RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django_redis import get_redis_connection
+from rest_framework import serializers
+from rest_framework.test import APIClient
+
+from areas.models import Area
+from cart.storage import get_redis_cart
+from goods.models import SKU
+from goods.tests import create_goods_with_skus, RedisTestCase
+from goods.utils import incr_sku_price_version
+from orders.models import OrderInfo, OrderGoods
+from orders import tickets
+from orders.serializers import OrderSerializer
+from orders import utils
+from orders.utils import OrderIdGenerator, WorkerIdLease, ORDER_ID_EPOCH, ORDER_ID_WORKER_LEASE_KEY, \
+    WORKER_ID_BITS, SEQUENCE_BITS, SEQUENCE_MASK, MAX_WORKER_ID, generate_order_id
+from users.models import User, Address
 
 # Create your tests here.
+
+
+class OrderCreateTest(RedisTestCase):
+    def setUp(self):
+        super().setUp()
+        self.area = Area.objects.create(name='北京市')
+
+    def create_order(self, username, skus, count=1):
+        """创建用户并将skus加入购物车下单，返回(订单，执行的sql语句数量)"""
+        user = User.objects.create_user(username, password='12345678', mobile='13000000000')
+        address = Address.objects.create(user=user, title='家', receiver='张三', province=self.area, city=self.area,
+                                         district=self.area, place='中关村', mobile='13000000000')
+
+        redis_cart = get_redis_cart(user.id)
+        for sku in skus:
+            redis_cart.add(sku.id, count, True)
+
+        request = RequestFactory().post('/orders/')
+        request.user = user
+        serializer = OrderSerializer(data={'address': address.id, 'pay_method': 1}, context={'request': request})
+        serializer.is_valid(raise_exception=True)
+
+        with CaptureQueriesContext(connection) as queries:
+            order = serializer.save()
+
+        return order, len(queries)
+
+    def test_query_count_is_constant(self):
+        """下单执行的sql语句数量与订单中的商品数量无关"""
+        goods = create_goods_with_skus(2, 5)
+        SKU.objects.update(stock=10)
+        skus = list(goods.sku_set.all())
+
+        _, small = self.create_order('order_small', skus[:1])
+        order, large = self.create_order('order_large', skus[1:])
+
+        self.assertEqual(small, large)
+        self.assertEqual(order.total_count, 9)
+        self.assertEqual(order.skus.count(), 9)
+        self.assertEqual(SKU.objects.get(id=skus[1].id).stock, 9)
+
+    def test_stock_not_enough(self):
+        """任何一个商品库存不足时不保存订单，也不扣减其他商品的库存"""
+        goods = create_goods_with_skus(1, 2)
+        SKU.objects.update(stock=2)
+        sku1, sku2 = goods.sku_set.order_by('id')
+        SKU.objects.filter(id=sku2.id).update(stock=1)
+
+        with self.assertRaises(serializers.ValidationError):
+            self.create_order('order_test', [sku1, sku2], count=2)
+
+        self.assertFalse(OrderInfo.objects.exists())
+        self.assertEqual(SKU.objects.get(id=sku1.id).stock, 2)
+
+    def test_empty_cart(self):
+        """购物车中没有勾选的商品时不保存订单"""
+        for reservation in (False, True):
+            with self.settings(ORDER_STOCK_RESERVATION=reservation):
+                with self.assertRaises(serializers.ValidationError):
+                    self.create_order('order_empty_%s' % reservation, [])
+
+        self.assertFalse(OrderInfo.objects.exists())
+
+
+class OrderTicketTest(RedisTestCase):
+    def test_process_order_ticket(self):
+        """异步下单处理结束之后，凭证中记录处理结果并移出排队"""
+        area = Area.objects.create(name='北京市')
+        user = User.objects.create_user('ticket_test', password='12345678', mobile='13000000000')
+        address = Address.objects.create(user=user, title='家', receiver='张三', province=area, city=area,
+                                         district=area, place='中关村', mobile='13000000000')
+
+        goods = create_goods_with_skus(1, 1)
+        SKU.objects.update(stock=10)
+        redis_cart = get_redis_cart(user.id)
+        redis_cart.add(goods.sku_set.get().id, 2, True)
+
+        ticket = tickets.create_order_ticket(user.id)
+        self.assertEqual(tickets.get_order_ticket(ticket)['status'], tickets.TICKET_QUEUED)
+
+        tickets.process_order_ticket(ticket, user.id, {'address': address.id, 'pay_method': 1})
+        data = tickets.get_order_ticket(ticket)
+        self.assertEqual(data['status'], tickets.TICKET_SUCCESS)
+        self.assertEqual(OrderInfo.objects.get(order_id=data['order_id']).total_count, 2)
+        self.assertGreater(get_redis_connection('default').ttl(tickets.ORDER_TICKET_KEY % ticket), 0)
+
+        # 收货地址不存在，下单失败
+        ticket = tickets.create_order_ticket(user.id)
+        tickets.process_order_ticket(ticket, user.id, {'address': address.id + 1000, 'pay_method': 1})
+        self.assertEqual(tickets.get_order_ticket(ticket)['status'], tickets.TICKET_FAILED)
+
+        # 凭证在排队期间过期，不再下单，也不会重新创建凭证
+        redis_conn = get_redis_connection('default')
+        ticket = tickets.create_order_ticket(user.id)
+        redis_conn.delete(tickets.ORDER_TICKET_KEY % ticket)
+        redis_cart.add(goods.sku_set.get().id, 1, True)
+        tickets.process_order_ticket(ticket, user.id, {'address': address.id, 'pay_method': 1})
+        self.assertEqual(OrderInfo.objects.count(), 1)
+        self.assertFalse(redis_conn.exists(tickets.ORDER_TICKET_KEY % ticket))
+        self.assertIsNone(redis_conn.zscore(tickets.ORDER_QUEUE_KEY, ticket))
+
+        # 没有user_id的凭证视为不存在
+        redis_conn.hmset(tickets.ORDER_TICKET_KEY % ticket, {'status': tickets.TICKET_SUCCESS})
+        self.assertIsNone(tickets.get_order_ticket(ticket))
+
+
+class OrderIdGeneratorTest(TestCase):
+    def test_unique_under_threads(self):
+        """多线程同时生成的id不重复，且每个线程取到的id单调递增"""
+        generator = OrderIdGenerator(worker_id=1)
+        results = []
+
+        def run():
+            results.append([generator.next_id() for _ in range(20000)])
+
+        workers = [threading.Thread(target=run) for _ in range(8)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        ids = [order_id for thread_ids in results for order_id in thread_ids]
+        self.assertEqual(len(set(ids)), len(ids))
+        for thread_ids in results:
+            self.assertEqual(thread_ids, sorted(thread_ids))
+
+    def test_sequence_and_clock(self):
+        """同一毫秒内的序号用完时借用下一毫秒，时钟回拨时id仍然单调递增"""
+        now = 1600000000000
+        times = iter([now] * (SEQUENCE_MASK + 2) + [now - 5, now + 2])
+        generator = OrderIdGenerator(worker_id=1, clock=lambda: next(times))
+
+        ids = [generator.next_id() for _ in range(SEQUENCE_MASK + 4)]
+        self.assertEqual(ids, sorted(set(ids)))
+
+        timestamps = [(order_id >> (WORKER_ID_BITS + SEQUENCE_BITS)) + ORDER_ID_EPOCH for order_id in ids]
+        self.assertEqual(timestamps, [now] * (SEQUENCE_MASK + 1) + [now + 1, now + 1, now + 2])
+        self.assertEqual(OrderIdGenerator(worker_id=2, clock=lambda: now).next_id() >> SEQUENCE_BITS & MAX_WORKER_ID, 2)
+
+
+class WorkerIdLeaseTest(RedisTestCase):
+    def test_lease(self):
+        """每个worker id同一时间只被一个进程持有，租约失效之后重新申请"""
+        redis_conn = get_redis_connection('default')
+        lease1 = WorkerIdLease(redis_conn, 60)
+        lease2 = WorkerIdLease(redis_conn, 60)
+        worker_id1, worker_id2 = lease1.ensure(), lease2.ensure()
+        self.assertNotEqual(worker_id1, worker_id2)
+
+        # 需要续期时续期自己持有的租约
+        lease1.renewed_at = 0
+        self.assertEqual(lease1.ensure(), worker_id1)
+        self.assertGreater(redis_conn.ttl(ORDER_ID_WORKER_LEASE_KEY % worker_id1), 0)
+
+        # 租约过期之后被其他进程申请
+        redis_conn.set(ORDER_ID_WORKER_LEASE_KEY % worker_id1, 'other')
+        lease1.renewed_at = 0
+        self.assertNotIn(lease1.ensure(), (worker_id1, worker_id2))
+
+    def test_generate_without_renew(self):
+        """只在需要续期时访问redis"""
+        utils._pid = None
+        self.addCleanup(setattr, utils, '_pid', None)
+        generate_order_id()
+
+        with mock.patch.object(utils._lease, 'ensure', wraps=utils._lease.ensure) as ensure:
+            order_ids = [generate_order_id() for _ in range(100)]
+            ensure.assert_not_called()
+
+            utils._lease.renewed_at -= settings.ORDER_ID_WORKER_LEASE_EXPIRES / 2
+            order_ids.append(generate_order_id())
+            ensure.assert_called_once_with()
+
+        self.assertEqual(len(set(order_ids)), len(order_ids))
+
+
+class OrderListTest(RedisTestCase):
+    def test_keyset_pagination(self):
+        """按创建时间倒序逐页获取全部订单，每页的查询次数相同"""
+        area = Area.objects.create(name='北京市')
+        user = User.objects.create_user('list_test', password='12345678', mobile='13000000000')
+        address = Address.objects.create(user=user, title='家', receiver='张三', province=area, city=area,
+                                         district=area, place='中关村', mobile='13000000000')
+        goods = create_goods_with_skus(1, 2)
+
+        for i in range(5):
+            order = OrderInfo.objects.create(order_id='%020d' % i, user=user, address=address, total_count=2,
+                                             total_amount=2010, freight=10)
+            for sku in goods.sku_set.all():
+                OrderGoods.objects.create(order=order, sku=sku, count=1, price=sku.price)
+        # 创建时间相同的订单按order_id倒序
+        OrderInfo.objects.filter(order_id__in=['%020d' % 1, '%020d' % 2]).update(
+            create_time=OrderInfo.objects.get(order_id='%020d' % 3).create_time)
+        expected = list(OrderInfo.objects.order_by('-create_time', '-order_id').values_list('order_id', flat=True))
+
+        client = APIClient()
+        client.force_authenticate(user)
+
+        order_ids = []
+        url = '/orders/?page_size=2'
+        while url:
+            with CaptureQueriesContext(connection) as queries:
+                response = client.get(url)
+            self.assertEqual(response.status_code, 200)
+            # 订单、订单商品、商品各一次查询
+            self.assertEqual(len(queries), 3)
+
+            for order in response.data['results']:
+                order_ids.append(order['order_id'])
+                self.assertEqual(len(order['skus']), 2)
+            url = response.data['next']
+
+        self.assertEqual(order_ids, expected)
+
+
+class OrderSnapshotTest(RedisTestCase):
+    def test_order_from_snapshot(self):
+        """按结算快照下单，结算之后修改购物车不影响下单的商品，快照只能成功下单一次，价格变化时拒绝下单"""
+        area = Area.objects.create(name='北京市')
+        user = User.objects.create_user('snapshot_test', password='12345678', mobile='13000000000')
+        address = Address.objects.create(user=user, title='家', receiver='张三', province=area, city=area,
+                                         district=area, place='中关村', mobile='13000000000')
+        goods = create_goods_with_skus(1, 1)
+        SKU.objects.update(stock=10)
+        sku = goods.sku_set.get()
+
+        client = APIClient()
+        client.force_authenticate(user)
+        redis_cart = get_redis_cart(user.id)
+
+        redis_cart.update(sku.id, 2, True)
+        snapshot = client.get('/orders/settlement/').data['snapshot']
+        redis_cart.update(sku.id, 5, True)
+
+        # 库存不足下单失败时放回快照，可以使用同一个快照重新下单
+        data = {'address': address.id, 'pay_method': 1, 'snapshot': snapshot}
+        SKU.objects.update(stock=1)
+        response = client.post('/orders/', data, format='json')
+        self.assertEqual(response.status_code, 400)
+
+        SKU.objects.update(stock=10)
+        response = client.post('/orders/', data, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(OrderInfo.objects.get(order_id=response.data['order_id']).total_count, 2)
+        self.assertEqual(SKU.objects.get(id=sku.id).stock, 8)
+
+        response = client.post('/orders/', data, format='json')
+        self.assertEqual(response.status_code, 400)
+
+        # 结算之后商品价格发生变化
+        redis_cart.update(sku.id, 1, True)
+        snapshot = client.get('/orders/settlement/').data['snapshot']
+        SKU.objects.filter(id=sku.id).update(price=sku.price + 1)
+        incr_sku_price_version()
+
+        data['snapshot'] = snapshot
+        response = client.post('/orders/', data, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(SKU.objects.get(id=sku.id).stock, 8)
+
+        # 没有勾选的商品时不能结算
+        redis_cart.remove(sku.id)
+        self.assertEqual(client.get('/orders/settlement/').status_code, 400)
@@ -0,0 +1,139 @@
+import logging
+import time
+import uuid
+
+from django.conf import settings
+from django_redis import get_redis_connection
+from rest_framework import serializers
+
+logger = logging.getLogger('django')
+
+# 排队中的下单请求: zset {'<ticket>': '<入队时间>', ...}
+ORDER_QUEUE_KEY = 'order_queue'
+# 下单请求的处理状态: hash {'user_id':, 'status':, 'order_id':, 'message':}
+ORDER_TICKET_KEY = 'order_ticket_%s'
+
+# 下单请求状态
+TICKET_QUEUED = 'queued'
+TICKET_PROCESSING = 'processing'
+TICKET_SUCCESS = 'success'
+TICKET_FAILED = 'failed'
+
+# 下单请求入队: 排队数量达到上限时拒绝，超过有效期仍未处理完的请求不再计入排队数量
+# KEYS[1]: order_queue KEYS[2]: order_ticket_<ticket>
+# ARGV[1]: 当前时间 ARGV[2]: 有效期 ARGV[3]: 排队数量上限 ARGV[4]: ticket ARGV[5]: user_id
+ENQUEUE_SCRIPT = """
+redis.call('zremrangebyscore', KEYS[1], '-inf', tonumber(ARGV[1]) - tonumber(ARGV[2]))
+if redis.call('zcard', KEYS[1]) >= tonumber(ARGV[3]) then
+    return 0
+end
+redis.call('zadd', KEYS[1], ARGV[1], ARGV[4])
+redis.call('hmset', KEYS[2], 'user_id', ARGV[5], 'status', 'queued')
+redis.call('expire', KEYS[2], ARGV[2])
+return 1
+"""
+
+# 更新下单请求的处理状态: 凭证已过期时不再创建，直接移出排队
+# KEYS[1]: order_ticket_<ticket> KEYS[2]: order_queue
+# ARGV[1]: 有效期 ARGV[2]: ticket ARGV[3]: 是否移出排队(1/0) ARGV[4:]: field, value, field, value, ...
+# 返回: 1 已更新 0 凭证不存在
+UPDATE_SCRIPT = """
+if redis.call('exists', KEYS[1]) == 0 then
+    redis.call('zrem', KEYS[2], ARGV[2])
+    return 0
+end
+redis.call('hmset', KEYS[1], unpack(ARGV, 4))
+redis.call('expire', KEYS[1], ARGV[1])
+if ARGV[3] == '1' then
+    redis.call('zrem', KEYS[2], ARGV[2])
+end
+return 1
+"""
+
+
+def create_order_ticket(user_id):
+    """
+    为下单请求创建排队凭证
+    排队的请求数量已达到ORDER_QUEUE_MAX_PENDING时返回None
+    """
+    ticket = uuid.uuid4().hex
+
+    redis_conn = get_redis_connection('default')
+    script = redis_conn.register_script(ENQUEUE_SCRIPT)
+    res = script(keys=[ORDER_QUEUE_KEY, ORDER_TICKET_KEY % ticket],
+                 args=[time.time(), settings.ORDER_TICKET_EXPIRES, settings.ORDER_QUEUE_MAX_PENDING, ticket, user_id])
+
+    return ticket if res else None
+
+
+def get_order_ticket(ticket):
+    """
+    获取下单请求的处理状态，凭证不存在或已过期时返回None:
+    {
+        'user_id':,
+        'status':,
+        'order_id':,
+        'message':
+    }
+    """
+    redis_conn = get_redis_connection('default')
+    data = redis_conn.hgetall(ORDER_TICKET_KEY % ticket)
+    data = {key.decode(): value.decode() for key, value in data.items()}
+    if 'user_id' not in data:
+        return None
+
+    data['user_id'] = int(data['user_id'])
+
+    return data
+
+
+def update_order_ticket(ticket, status, **kwargs):
+    """
+    更新下单请求的处理状态，并重新设置有效期，处理结束时移出排队
+    凭证已过期时不做修改并返回False
+    """
+    redis_conn = get_redis_connection('default')
+
+    kwargs['status'] = status
+    args = [settings.ORDER_TICKET_EXPIRES, ticket, 1 if status in (TICKET_SUCCESS, TICKET_FAILED) else 0]
+    for field, value in kwargs.items():
+        args.extend([field, value])
+
+    script = redis_conn.register_script(UPDATE_SCRIPT)
+    return bool(script(keys=[ORDER_TICKET_KEY % ticket, ORDER_QUEUE_KEY], args=args))
+
+
+def get_error_message(detail):
+    """从ValidationError的detail中取出第一条错误信息"""
+    if isinstance(detail, dict):
+        detail = list(detail.values())[0]
+    if isinstance(detail, list):
+        detail = detail[0]
+    return str(detail)
+
+
+def process_order_ticket(ticket, user_id, data):
+    """
+    由celery任务执行的下单处理:
+    data: {'address': '<address_id>', 'pay_method': '<pay_method>'}
+    """
+    from orders.serializers import OrderSerializer
+    from users.models import User
+
+    # 凭证在排队期间已过期，用户已不再等待结果，不再下单
+    if not update_order_ticket(ticket, TICKET_PROCESSING):
+        logger.warning('异步下单[凭证已过期][ ticket: %s, user_id: %s ]' % (ticket, user_id))
+        return
+
+    try:
+        user = User.objects.get(id=user_id)
+        serializer = OrderSerializer(data=data, context={'user': user})
+        serializer.is_valid(raise_exception=True)
+        order = serializer.save()
+    except serializers.ValidationError as e:
+        update_order_ticket(ticket, TICKET_FAILED, message=get_error_message(e.detail))
+    except Exception as e:
+        logger.error('异步下单[异常][ ticket: %s, user_id: %s, message: %s ]' % (ticket, user_id, e))
+        update_order_ticket(ticket, TICKET_FAILED, message='下单失败')
+    else:
+        update_order_ticket(ticket, TICKET_SUCCESS, order_id=order.order_id)
@@ -4,4 +4,5 @@ from orders import views
 urlpatterns = [
     url(r'^orders/settlement/$', views.OrderSettlementView.as_view()),
     url(r'^orders/$', views.OrderView.as_view()),
+    url(r'^orders/tickets/(?P<ticket>[0-9a-f]+)/$', views.OrderTicketView.as_view()),
 ]
\ No newline at end of file
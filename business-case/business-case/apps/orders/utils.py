@@ -0,0 +1,160 @@
+import os
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django_redis import get_redis_connection
+
+# 订单id(64位整数，Snowflake格式):
+# 41位毫秒时间戳(相对于ORDER_ID_EPOCH) + 10位worker id + 12位序号
+ORDER_ID_EPOCH = 1514736000000  # 2018-01-01 00:00:00 +08:00
+WORKER_ID_BITS = 10
+SEQUENCE_BITS = 12
+MAX_WORKER_ID = (1 << WORKER_ID_BITS) - 1
+SEQUENCE_MASK = (1 << SEQUENCE_BITS) - 1
+
+# 分配worker id时轮询的redis计数器
+ORDER_ID_WORKER_KEY = 'order_id_worker'
+# worker id的租约: order_id_worker_<worker_id> = '<持有进程的token>'，到期未续期时由其他进程重新申请
+ORDER_ID_WORKER_LEASE_KEY = 'order_id_worker_%s'
+
+# 续期worker id的租约(只续期自己持有的租约)
+# KEYS[1]: order_id_worker_<worker_id> ARGV[1]: 申请租约时的token ARGV[2]: 有效期
+RENEW_LEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('expire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+
+def current_millis():
+    """当前的毫秒时间戳"""
+    return int(time.time() * 1000)
+
+
+class OrderIdGenerator(object):
+    """
+    进程内的订单id生成器，不需要访问数据库和redis:
+    时间部分使用生成时的毫秒时间戳，同一毫秒内的id按序号递增，序号用完时借用下一毫秒
+    系统时钟回拨时继续使用上次的时间戳，同一进程内生成的id单调递增
+    锁内只有内存中的序号计算，不读取时钟，也不等待
+    """
+    def __init__(self, worker_id, clock=current_millis):
+        if not 0 <= worker_id <= MAX_WORKER_ID:
+            raise ValueError('worker_id must be between 0 and %s' % MAX_WORKER_ID)
+
+        self.worker_id = worker_id
+        self.clock = clock
+        self.last_timestamp = -1
+        self.sequence = 0
+        self._lock = threading.Lock()
+
+    def next_id(self):
+        """生成下一个订单id"""
+        now = self.clock()
+
+        with self._lock:
+            if now > self.last_timestamp:
+                self.last_timestamp = now
+                self.sequence = 0
+            else:
+                self.sequence = (self.sequence + 1) & SEQUENCE_MASK
+                if self.sequence == 0:
+                    # 当前毫秒的序号已用完，借用下一毫秒，之后的时钟追上之前继续递增序号
+                    self.last_timestamp += 1
+            timestamp, sequence = self.last_timestamp, self.sequence
+
+        return ((timestamp - ORDER_ID_EPOCH) << (WORKER_ID_BITS + SEQUENCE_BITS)) | \
+            (self.worker_id << SEQUENCE_BITS) | sequence
+
+
+class WorkerIdLease(object):
+    """
+    通过redis为进程申请worker id的租约，同一时间每个worker id只被一个进程持有:
+    距离上次续期超过有效期的1/3时续期，租约已失效(进程长时间没有生成id)时重新申请
+    """
+    def __init__(self, redis_conn, expires):
+        self.redis_conn = redis_conn
+        self.expires = expires
+        self.token = uuid.uuid4().hex
+        self.worker_id = None
+        self.renewed_at = 0
+
+    def acquire(self):
+        """依次尝试计数器分配的worker id，返回申请到的worker id"""
+        for _ in range(MAX_WORKER_ID + 1):
+            worker_id = (self.redis_conn.incr(ORDER_ID_WORKER_KEY) - 1) & MAX_WORKER_ID
+            now = time.time()
+            if self.redis_conn.set(ORDER_ID_WORKER_LEASE_KEY % worker_id, self.token, ex=self.expires, nx=True):
+                self.worker_id = worker_id
+                self.renewed_at = now
+                return worker_id
+
+        raise RuntimeError('没有可用的订单id worker id')
+
+    def needs_renew(self):
+        """距离上次续期是否已超过有效期的1/3"""
+        return time.time() - self.renewed_at >= self.expires / 3
+
+    def is_safe(self):
+        """租约的剩余有效期是否还有1/3以上，续期期间其他线程可以继续使用当前的worker id"""
+        return time.time() - self.renewed_at < self.expires * 2 / 3
+
+    def ensure(self):
+        """返回当前进程持有的worker id，需要时续期或重新申请"""
+        if self.worker_id is None:
+            return self.acquire()
+
+        now = time.time()
+        if self.needs_renew():
+            script = self.redis_conn.register_script(RENEW_LEASE_SCRIPT)
+            if not script(keys=[ORDER_ID_WORKER_LEASE_KEY % self.worker_id], args=[self.token, self.expires]):
+                return self.acquire()
+            self.renewed_at = now
+
+        return self.worker_id
+
+
+# 每个进程一个租约和生成器，uwsgi/celery fork出的子进程需要重新申请worker id
+# _lock只在初始化和续期租约时使用，生成id时不需要获取
+_lock = threading.Lock()
+_lease = None
+_generator = None
+_pid = None
+
+
+def _ensure_generator():
+    """初始化或续期租约，返回当前worker id对应的生成器(需要持有_lock)"""
+    global _lease, _generator, _pid
+
+    pid = os.getpid()
+    if _pid != pid:
+        _lease = WorkerIdLease(get_redis_connection('default'), settings.ORDER_ID_WORKER_LEASE_EXPIRES)
+        _generator = None
+        _pid = pid
+
+    worker_id = _lease.ensure()
+    if _generator is None or _generator.worker_id != worker_id:
+        _generator = OrderIdGenerator(worker_id)
+
+    return _generator
+
+
+def generate_order_id():
+    """
+    生成订单id，以数字字符串的形式保存在OrderInfo.order_id中
+    只在需要续期租约时访问redis: 其他线程正在续期且租约剩余有效期足够时，继续使用当前的生成器，不等待续期
+    """
+    generator = _generator
+    if _pid != os.getpid() or generator is None or not _lease.is_safe():
+        with _lock:
+            generator = _ensure_generator()
+    elif _lease.needs_renew() and _lock.acquire(blocking=False):
+        try:
+            generator = _ensure_generator()
+        finally:
+            _lock.release()
+
+    return str(generator.next_id())
@@ -1,6 +1,7 @@
 from decimal import Decimal
+from django.conf import settings
+from django.db.models import Prefetch
 from django.shortcuts import render
-from django_redis import get_redis_connection
 from rest_framework import status
 from rest_framework.generics import GenericAPIView
 
@@ -8,16 +9,52 @@ from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_framework.permissions import IsAuthenticated
 
+from cart.storage import get_redis_cart
 from goods.models import SKU
-from orders.serializers import OrderSKUSerializer, OrderSettlementSerializer, OrderSerializer
+from meiduo_mall.utils.pagination import KeysetPagination
+from goods.utils import get_sku_summaries, get_sku_price_version
+from orders import snapshots, tickets
+from orders.models import OrderInfo, OrderGoods
+from orders.serializers import OrderSKUSerializer, OrderSettlementSerializer, OrderSerializer, OrderListSerializer
 
 
 # Create your views here.
 
+class OrderListPagination(KeysetPagination):
+    """用户订单列表分页类: 按(create_time, order_id)倒序的键集分页"""
+    ordering = ('-create_time', '-order_id')
+
+
+# GET /orders/
 # POST /orders/
 class OrderView(GenericAPIView):
     permission_classes = [IsAuthenticated]
-    serializer_class = OrderSerializer
+    pagination_class = OrderListPagination
+
+    def get_serializer_class(self):
+        if self.request.method == 'GET':
+            return OrderListSerializer
+        return OrderSerializer
+
+    def get_queryset(self):
+        """登录用户的订单，订单商品和商品数据各用一次查询批量加载，只查询需要的字段"""
+        return OrderInfo.objects.filter(user=self.request.user).prefetch_related(
+            Prefetch('skus', queryset=OrderGoods.objects.only('id', 'order_id', 'sku_id', 'count', 'price')),
+            Prefetch('skus__sku', queryset=SKU.objects.only('id', 'name', 'default_image_url'))
+        )
+
+    def get(self, request):
+        """
+        获取登录用户的订单列表:
+        1. 按创建时间倒序查询登录用户一页的订单数据
+        2. 将订单数据序列化并返回
+        """
+        # 1. 按创建时间倒序查询登录用户一页的订单数据
+        page = self.paginate_queryset(self.get_queryset())
+
+        # 2. 将订单数据序列化并返回
+        serializer = self.get_serializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
 
     def post(self, request):
         """
@@ -30,12 +67,66 @@ class OrderView(GenericAPIView):
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
 
+        if settings.ORDER_ASYNC_PLACEMENT:
+            # 异步下单: 下单请求入队，由celery worker按固定并发数处理
+            return self.enqueue(serializer)
+
         # 2. 保存订单数据(create)
         serializer.save()
 
         # 3. 返回应答，订单保存成功
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
+    def enqueue(self, serializer):
+        """
+        下单请求入队:
+        1. 创建排队凭证，排队人数达到上限时直接拒绝
+        2. 发出下单任务
+        3. 返回排队凭证，前端通过凭证查询下单结果
+        """
+        user = self.request.user
+
+        # 1. 创建排队凭证，排队人数达到上限时直接拒绝
+        ticket = tickets.create_order_ticket(user.id)
+        if ticket is None:
+            return Response({'message': '下单人数过多，请稍后再试'}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+        # 2. 发出下单任务
+        data = {
+            'address': serializer.validated_data['address'].id,
+            'pay_method': serializer.validated_data['pay_method']
+        }
+        if 'snapshot' in serializer.validated_data:
+            # 传递签名的快照id，由任务重新校验
+            data['snapshot'] = serializer.initial_data['snapshot']
+
+        from celery_tasks.orders.tasks import place_order
+        place_order.delay(ticket, user.id, data)
+
+        # 3. 返回排队凭证
+        return Response({'ticket': ticket, 'status': tickets.TICKET_QUEUED}, status=status.HTTP_202_ACCEPTED)
+
+
+# GET /orders/tickets/(?P<ticket>[0-9a-f]+)/
+class OrderTicketView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, ticket):
+        """
+        查询异步下单的结果:
+        1. 获取排队凭证的处理状态
+        2. 返回处理状态，下单成功时包含订单id
+        """
+        # 1. 获取排队凭证的处理状态
+        data = tickets.get_order_ticket(ticket)
+        if data is None or data['user_id'] != request.user.id:
+            return Response({'message': '无效的下单凭证'}, status=status.HTTP_404_NOT_FOUND)
+
+        # 2. 返回处理状态
+        data.pop('user_id')
+        data['ticket'] = ticket
+        return Response(data)
+
 
 # GET /orders/settlement/
 class OrderSettlementView(APIView):
@@ -46,52 +137,48 @@ class OrderSettlementView(APIView):
         获取订单结算的数据:
         1. 从redis获取用户购物车中被勾选的商品id和对应数量count
         2. 根据商品的id获取对应商品的数据 & 订单运费
-        3. 将订单结算数据序列化并返回
+        3. 保存结算快照(商品数量和单价)，下单时传递快照id，按结算时的数据下单
+        4. 将订单结算数据序列化并返回
         """
         # 获取登录user
         user = request.user
 
         # 1. 从redis获取用户购物车中被勾选的商品id和对应数量count
-        redis_conn = get_redis_connection('cart')
-
-        # 从redis set中获取用户购物车被勾选的商品的id
-        cart_selected_key = 'cart_selected_%s' % user.id
-
-        # (b'<sku_id>', b'<sku_id>', ...)
-        sku_ids = redis_conn.smembers(cart_selected_key)
-
-        # 从redis hash中获取用户购物车中所有商品的id和对应数量count
-        cart_key = 'cart_%s' % user.id
-        # {
-        #     b'<sku_id>': b'<count>',
-        #     ...
-        # }
-        cart_dict = redis_conn.hgetall(cart_key)
-
-        # 组织数据
         # {
         #     '<sku_id>': '<count>',
         #     ...
         # }
-        cart = {}
-
-        for sku_id, count in cart_dict.items():
-            cart[int(sku_id)] = int(count)
+        cart = get_redis_cart(user.id).get_selected()
+        sku_ids = cart.keys()
 
         # 2. 根据商品的id获取对应商品的数据 & 订单运费
-        skus = SKU.objects.filter(id__in=sku_ids)
+        skus = get_sku_summaries(sku_ids)
+        if not skus:
+            # 没有勾选的商品(或勾选的商品都已删除)，不保存结算快照
+            return Response({'message': '购物车中没有勾选的商品'}, status=status.HTTP_400_BAD_REQUEST)
+
+        # 先读取价格版本号再从数据库读取价格，期间价格发生变化时下单会重新核对
+        version = get_sku_price_version()
+        prices = dict(SKU.objects.filter(id__in=[sku['id'] for sku in skus]).values_list('id', 'price'))
 
         for sku in skus:
-            # 给sku对象增加属性count，保存该商品所要结算的数量
-            sku.count = cart[sku.id]
+            # 给sku增加count，保存该商品所要结算的数量
+            sku['count'] = cart[sku['id']]
+            # 显示的价格与下单时的价格一致
+            sku['price'] = prices[sku['id']]
 
         # 组织运费
         freight = Decimal(10)
 
-        # 3. 将订单结算数据序列化并返回
+        # 3. 保存结算快照(已删除的商品不会结算)
+        snapshot = snapshots.create_settlement_snapshot(
+            user.id, {sku['id']: sku['count'] for sku in skus}, prices, version)
+
+        # 4. 将订单结算数据序列化并返回
         res_dict = {
             'freight': freight,
-            'skus': skus
+            'skus': skus,
+            'snapshot': snapshot
         }
 
         serializer = OrderSettlementSerializer(res_dict)
@@ -108,31 +195,12 @@ class OrderSettlementView(APIView):
         user = request.user
 
         # 1. 从redis获取用户购物车中被勾选的商品id和对应数量count
-        redis_conn = get_redis_connection('cart')
-
-        # 从redis set中获取用户购物车被勾选的商品的id
-        cart_selected_key = 'cart_selected_%s' % user.id
-
-        # (b'<sku_id>', b'<sku_id>', ...)
-        sku_ids = redis_conn.smembers(cart_selected_key)
-
-        # 从redis hash中获取用户购物车中所有商品的id和对应数量count
-        cart_key = 'cart_%s' % user.id
-        # {
-        #     b'<sku_id>': b'<count>',
-        #     ...
-        # }
-        cart_dict = redis_conn.hgetall(cart_key)
-
-        # 组织数据
         # {
         #     '<sku_id>': '<count>',
         #     ...
         # }
-        cart = {}
-
-        for sku_id, count in cart_dict.items():
-            cart[int(sku_id)] = int(count)
+        cart = get_redis_cart(user.id).get_selected()
+        sku_ids = cart.keys()
 
         # 2. 根据商品的id获取对应商品的数据 & 订单运费
         skus = SKU.objects.filter(id__in=sku_ids)
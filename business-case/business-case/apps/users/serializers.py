@@ -46,6 +46,10 @@ class BrowseHistorySerializer(serializers.Serializer):
         # 截取: 只保留最新的几个浏览记录。
         pl.ltrim(history_key, 0, constants.USER_BROWSING_HISTORY_COUNTS_LIMIT - 1)
 
+        # 滑动过期: 每次添加浏览记录时重新设置有效期，长期不活跃用户的浏览记录自动删除
+        if settings.HISTORY_EXPIRES:
+            pl.expire(history_key, settings.HISTORY_EXPIRES)
+
         # 一次性执行管道中的所有命令
         pl.execute()
 
@@ -15,8 +15,7 @@ from rest_framework_jwt.settings import api_settings
 from rest_framework_jwt.views import ObtainJSONWebToken, jwt_response_payload_handler
 
 from cart.utils import merge_cookie_cart_to_redis
-from goods.models import SKU
-from goods.serializers import SKUSerializer
+from goods.utils import get_sku_summaries
 from users import constants
 from users import serializers
 from users.models import User
@@ -71,16 +70,10 @@ class BrowseHistoryView(CreateAPIView):
         # [b'<sku_id>', b'<sku_id>', ...]
         sku_ids = redis_conn.lrange(history_key, 0, -1)
 
-        # 2. 根据sku_id获取对应商品的数据
-        skus = []
-
-        for sku_id in sku_ids:
-            sku = SKU.objects.get(id=sku_id)
-            skus.append(sku)
-
+        # 2. 根据sku_id批量获取对应商品的数据(按浏览顺序，已删除的商品直接忽略)
         # 3. 将商品数据序列化并返回
-        serializer = SKUSerializer(skus, many=True)
-        return Response(serializer.data)
+        skus = get_sku_summaries(sku_ids)
+        return Response(skus)
 
     # def post(self, request):
     #     """
@@ -334,11 +334,18 @@ CKEDITOR_UPLOAD_PATH = ''  # 上传图片保存路径，使用了FastDFS，所
 # 指定生成静态文件的保存目录
 GENERATED_STATIC_HTML_FILES_DIR = os.path.join(os.path.dirname(os.path.dirname(BASE_DIR)), 'front_end_pc')
 
+# 合并重新生成静态详情页面请求的时间窗口: s
+GENERATE_STATIC_HTML_COALESCE_WINDOW = 5
+
 
 # 定时任务
 CRONJOBS = [
-    # 每1分钟执行一次生成主页静态文件
-    ('*/1 * * * *', 'contents.crons.generate_static_index_html', '>> ' + os.path.dirname(BASE_DIR) + '/logs/crontab.log')
+    # 每1分钟检查一次首页数据版本号，数据变化时才重新生成主页静态文件(数据变化时也会通过celery任务及时生成)
+    ('*/1 * * * *', 'contents.crons.generate_static_index_html', '>> ' + os.path.dirname(BASE_DIR) + '/logs/crontab.log'),
+    # 每10分钟将redis中预扣的库存写回数据库，并按数据库修正redis中的库存镜像
+    ('*/10 * * * *', 'goods.crons.reconcile_sku_stock_mirror', '>> ' + os.path.dirname(BASE_DIR) + '/logs/crontab.log'),
+    # 每小时按数据库重新统计每个分类下已上架sku的数量
+    ('0 * * * *', 'goods.crons.reconcile_category_sku_count', '>> ' + os.path.dirname(BASE_DIR) + '/logs/crontab.log')
 ]
 
 # 解决crontab中文问题
@@ -365,3 +372,45 @@ ALIPAY_URL = 'https://openapi.alipaydev.com/gateway.do' # 支付网关地址
 
 # 指定收集静态文件的保存目录
 STATIC_ROOT = os.path.join(os.path.dirname(os.path.dirname(BASE_DIR)), 'front_end_pc/static')
+
+# 登录用户redis购物车记录的存储格式
+# split: cart_<user_id>(hash) + cart_selected_<user_id>(set)
+# packed: cart_packed_<user_id>(hash)，数量和勾选状态编码在同一个值中
+CART_STORAGE_FORMAT = 'split'
+
+# 登录时合并cookie购物车的方式
+# overwrite: cookie中的商品数量覆盖redis中的数量
+# sum: 数量累加，不超过商品库存
+CART_MERGE_POLICY = 'overwrite'
+
+# 登录用户redis购物车记录的有效期: s，每次修改购物车时重新计时，None表示不过期
+CART_EXPIRES = 90 * 24 * 60 * 60
+
+# 登录用户浏览记录的有效期: s，每次添加浏览记录时重新计时，None表示不过期
+HISTORY_EXPIRES = 30 * 24 * 60 * 60
+
+# 下单时是否在redis库存镜像中预扣库存，再由celery任务异步写回数据库
+# 关闭时使用数据库乐观锁扣减库存
+ORDER_STOCK_RESERVATION = False
+
+# 预扣库存写回数据库的延迟时间: s，时间窗口内的下单只会触发一次写回
+SKU_STOCK_FLUSH_DELAY = 1
+
+# 预扣库存的有效期: s，超过有效期仍未确认或释放的预扣由写回任务按订单是否已保存确认或释放
+# 需要大于保存订单事务的最长耗时
+SKU_STOCK_RESERVATION_EXPIRES = 60
+
+# 是否异步下单: 下单请求进入celery队列，由worker按固定并发数处理，前端通过排队凭证查询结果
+ORDER_ASYNC_PLACEMENT = False
+
+# 同时排队的下单请求数量上限，超过时直接拒绝
+ORDER_QUEUE_MAX_PENDING = 1000
+
+# 下单排队凭证的有效期: s
+ORDER_TICKET_EXPIRES = 600
+
+# 订单结算快照的有效期: s，有效期内按结算时的商品数量和价格下单
+ORDER_SETTLEMENT_EXPIRES = 15 * 60
+
+# 订单id生成器worker id(0-1023)租约的有效期: s，每个进程通过redis申请worker id并定期续期
+ORDER_ID_WORKER_LEASE_EXPIRES = 60
@@ -0,0 +1,19 @@
+"""
+运行测试使用的配置:
+在开发配置的基础上，redis缓存使用单独的数据库，测试用例会清空这些数据库，不会读写开发环境的数据
+python manage.py test 默认使用该配置
+"""
+from .dev import *  # noqa
+
+# 测试使用的redis数据库编号，与开发环境使用的数据库(0-5)分开
+TEST_REDIS_DATABASES = {
+    'default': 10,
+    'session': 11,
+    'verify_codes': 12,
+    'histories': 14,
+    'cart': 15,
+}
+
+CACHES = {alias: dict(config) for alias, config in CACHES.items()}
+for alias, db in TEST_REDIS_DATABASES.items():
+    CACHES[alias]['LOCATION'] = '%s/%s' % (CACHES[alias]['LOCATION'].rsplit('/', 1)[0], db)
@@ -0,0 +1,22 @@
+from django.db import transaction
+
+
+def on_commit_once(func, using=None):
+    """
+    在事务提交时执行func，同一个事务中多次注册同一个func只执行一次:
+    用于在信号处理中使缓存失效等只需要在提交之后执行一次的操作
+    不在事务中时立即执行
+
+    每次注册都在连接上记录func，提交时第一个执行的回调取出记录并执行func，其余的回调不再执行
+    事务回滚时回调不会执行，留下的记录由下一个事务的回调取出，不影响下一个事务
+    """
+    connection = transaction.get_connection(using)
+    pending = connection.__dict__.setdefault('_on_commit_once_pending', set())
+    pending.add(func)
+
+    def run():
+        if func in pending:
+            pending.discard(func)
+            func()
+
+    transaction.on_commit(run, using)
@@ -1,4 +1,15 @@
-from rest_framework.pagination import PageNumberPagination
+import base64
+import json
+from collections import OrderedDict
+from functools import partial
+
+from django.core.exceptions import ValidationError
+from django.core.paginator import Paginator
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import PageNumberPagination, BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
 
 
 class StandardResultPagination(PageNumberPagination):
@@ -9,3 +20,159 @@ class StandardResultPagination(PageNumberPagination):
     page_size_query_param = 'page_size'
     # 指定最大的页容量
     max_page_size = 20
+
+
+class CachedCountPaginator(Paginator):
+    """总数量由外部传入的分页器，分页时不再执行COUNT(*)"""
+    def __init__(self, object_list, per_page, count=0, **kwargs):
+        super().__init__(object_list, per_page, **kwargs)
+        self.count = count
+
+
+class CachedCountPagination(StandardResultPagination):
+    """
+    使用缓存总数量的分页类:
+    视图需要提供get_cached_count()方法，返回查询集的总数量
+    """
+    def paginate_queryset(self, queryset, request, view=None):
+        self.django_paginator_class = partial(CachedCountPaginator, count=view.get_cached_count())
+        return super().paginate_queryset(queryset, request, view)
+
+
+class KeysetPagination(BasePagination):
+    """
+    键集(游标)分页类:
+    按ordering中的多个字段排序，最后一个字段必须唯一(如id)，保证排序稳定
+    游标中保存上一页最后一条记录的排序字段值，下一页查询条件为 (字段1, 字段2, ...) 在该值之后，
+    不需要OFFSET和COUNT(*)，配合以排序字段结尾的联合索引，翻到多深的页面都和第一页一样快
+    只支持向后翻页，返回数据格式:
+    {
+        'next': '<下一页链接>',
+        'results': [...]
+    }
+    """
+    # 指定分页的页容量
+    page_size = 6
+    # 指定获取分页数据传递的页容量参数的名称
+    page_size_query_param = 'page_size'
+    # 指定最大的页容量
+    max_page_size = 20
+    # 指定游标参数的名称
+    cursor_query_param = 'cursor'
+    # 排序字段，'-'开头表示降序
+    ordering = ('-create_time', '-id')
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.ordering = self.get_ordering(request, queryset, view)
+        page_size = self.get_page_size(request)
+
+        cursor = self.decode_cursor(request)
+        if cursor is not None:
+            try:
+                queryset = queryset.filter(self.get_cursor_filter(cursor))
+            except (ValidationError, ValueError, TypeError):
+                raise NotFound('无效的cursor')
+
+        # 多查询一条，判断是否还有下一页
+        results = list(queryset.order_by(*self.ordering)[:page_size + 1])
+        self.has_next = len(results) > page_size
+        self.page = results[:page_size]
+
+        return self.page
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('results', data)
+        ]))
+
+    def get_ordering(self, request, queryset, view):
+        """返回排序字段，子类可以根据请求参数选择"""
+        return self.ordering
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+
+        if page_size <= 0:
+            return self.page_size
+
+        return min(page_size, self.max_page_size)
+
+    def get_cursor_filter(self, cursor):
+        """
+        生成 (字段1, 字段2, ...) 在游标之后的查询条件:
+        字段1 > 值1 or (字段1 = 值1 and 字段2 > 值2) or ...，降序字段使用 <
+        额外加上 字段1 >= 值1，便于数据库使用索引进行范围扫描
+        """
+        fields = [field.lstrip('-') for field in self.ordering]
+        lookups = ['lt' if field.startswith('-') else 'gt' for field in self.ordering]
+
+        condition = Q()
+        for i in range(len(fields)):
+            q = Q(**{'%s__%s' % (fields[i], lookups[i]): cursor[i]})
+            for j in range(i):
+                q &= Q(**{fields[j]: cursor[j]})
+            condition |= q
+
+        first = Q(**{'%s__%se' % (fields[0], lookups[0]): cursor[0]})
+
+        return first & condition
+
+    def decode_cursor(self, request):
+        """解析游标，游标无效时返回404"""
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None
+
+        try:
+            cursor = json.loads(base64.urlsafe_b64decode(encoded.encode()).decode())
+        except (TypeError, ValueError):
+            raise NotFound('无效的cursor')
+
+        if not isinstance(cursor, list) or len(cursor) != len(self.ordering):
+            raise NotFound('无效的cursor')
+
+        return cursor
+
+    def encode_cursor(self, instance):
+        """将记录的排序字段值编码为游标"""
+        values = []
+        for field in self.ordering:
+            value = getattr(instance, field.lstrip('-'))
+            if not isinstance(value, (int, str)):
+                # datetime、Decimal等类型保存为字符串，查询时由字段自行转换
+                value = value.isoformat() if hasattr(value, 'isoformat') else str(value)
+            values.append(value)
+
+        return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.page[-1]))
+
+
+class OrderingKeysetPagination(KeysetPagination):
+    """
+    根据OrderingFilter的排序参数选择排序字段的键集分页类:
+    ?ordering=<排序字段> 只能是视图ordering_fields中的字段，'-'开头表示降序
+    排序字段之后追加同方向的id作为唯一字段，未指定排序字段时按id排序
+    """
+    ordering_param = 'ordering'
+    tiebreaker = 'id'
+
+    def get_ordering(self, request, queryset, view):
+        tiebreaker = self.tiebreaker
+        ordering = request.query_params.get(self.ordering_param, '').split(',')[0].strip()
+
+        if ordering.lstrip('-') in getattr(view, 'ordering_fields', ()):
+            direction = '-' if ordering.startswith('-') else ''
+            return (ordering, direction + tiebreaker)
+
+        return (tiebreaker, )
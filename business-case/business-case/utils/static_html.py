@@ -0,0 +1,66 @@
+import hashlib
+import os
+import tempfile
+
+from django.conf import settings
+from django_redis import get_redis_connection
+
+# 保存已生成静态文件ETag的redis hash: {'<相对路径>': '<etag>', ...}
+STATIC_HTML_MANIFEST_KEY = 'static_html_manifest'
+
+
+def get_file_etag(save_path):
+    """计算已存在静态文件内容的ETag，文件不存在时返回None"""
+    if not os.path.exists(save_path):
+        return None
+
+    with open(save_path, 'rb') as f:
+        return hashlib.md5(f.read()).hexdigest()
+
+
+def write_static_html(file_name, html):
+    """
+    保存生成的静态页面:
+    file_name: 相对于GENERATED_STATIC_HTML_FILES_DIR的文件路径，如'goods/1.html'
+    html: 渲染之后的html页面内容
+    返回 (etag, 是否进行了写入)
+    """
+    save_path = os.path.join(settings.GENERATED_STATIC_HTML_FILES_DIR, file_name)
+
+    data = html.encode('utf-8')
+    etag = hashlib.md5(data).hexdigest()
+
+    redis_conn = get_redis_connection('default')
+
+    # 内容未变化时不重写文件，避免nginx和CDN缓存失效
+    old_etag = redis_conn.hget(STATIC_HTML_MANIFEST_KEY, file_name)
+    if old_etag is not None and old_etag.decode() == etag and os.path.exists(save_path):
+        return etag, False
+
+    if old_etag is None and get_file_etag(save_path) == etag:
+        redis_conn.hset(STATIC_HTML_MANIFEST_KEY, file_name, etag)
+        return etag, False
+
+    # 先写入同目录下的临时文件，再通过os.replace原子替换，读者不会看到写了一半的文件
+    save_dir = os.path.dirname(save_path)
+    fd, temp_path = tempfile.mkstemp(dir=save_dir, prefix='.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, save_path)
+    except Exception:
+        os.remove(temp_path)
+        raise
+
+    redis_conn.hset(STATIC_HTML_MANIFEST_KEY, file_name, etag)
+
+    return etag, True
+
+
+def get_static_html_etag(file_name):
+    """获取静态文件在清单中记录的ETag"""
+    redis_conn = get_redis_connection('default')
+    etag = redis_conn.hget(STATIC_HTML_MANIFEST_KEY, file_name)
+
+    return etag.decode() if etag is not None else None
@@ -1,2 +1,8 @@
 # 设置celery中间人地址
 broker_url = 'redis://172.16.179.139:6379/3'
+
+# 异步下单任务使用单独的队列，由专门的worker按固定并发数处理，控制同时访问数据库的下单数量:
+# celery -A celery_tasks.main worker -Q orders -c 4
+task_routes = {
+    'place_order': {'queue': 'orders'},
+}
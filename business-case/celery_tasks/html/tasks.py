@@ -1,55 +1,28 @@
 # 封装生成静态详情页面的任务函数
-import os
+import logging
+
 from celery_tasks.main import celery_app
 
 from django.conf import settings
+from django.template import loader
+from django_redis import get_redis_connection
 
-from goods.models import SKU
-from goods.utils import get_categories
-
+from goods.models import SKU, Goods
+from goods.utils import get_categories, SpecMatrix
+from meiduo_mall.utils.static_html import write_static_html
 
-@celery_app.task(name='generate_static_sku_detail_html')
-def generate_static_sku_detail_html(sku_id):
-    """生成指定商品的静态详情页面"""
-    # 从数据库获取商品详情页所需数据
-    # 商品分类菜单
-    categories = get_categories()
+logger = logging.getLogger('django')
 
-    # 获取当前sku的信息
-    sku = SKU.objects.get(id=sku_id)
-    sku.images = sku.skuimage_set.all()
-
-    # 面包屑导航信息中的频道
-    goods = sku.goods
-    goods.channel = goods.category1.goodschannel_set.all()[0]
-
-    # 构建当前商品的规格键
-    # sku_key = [规格1参数id， 规格2参数id， 规格3参数id, ...]
-    sku_specs = sku.skuspecification_set.order_by('spec_id')
-    sku_key = []
-    for spec in sku_specs:
-        sku_key.append(spec.option.id)
-
-    # 获取当前商品的所有SKU
-    skus = goods.sku_set.all()
-
-    # 构建不同规格参数（选项）的sku字典
-    # spec_sku_map = {
-    #     (规格1参数id, 规格2参数id, 规格3参数id, ...): sku_id,
-    #     (规格1参数id, 规格2参数id, 规格3参数id, ...): sku_id,
-    #     ...
-    # }
-    spec_sku_map = {}
-    for s in skus:
-        # 获取sku的规格参数
-        s_specs = s.skuspecification_set.order_by('spec_id')
-        # 用于形成规格参数-sku字典的键
-        key = []
-        for spec in s_specs:
-            key.append(spec.option.id)
-        # 向规格参数-sku字典添加记录
-        spec_sku_map[tuple(key)] = s.id
 
+def save_static_sku_detail_html(sku, goods, categories, spec_matrix, temp=None):
+    """
+    渲染并保存指定sku的静态详情页面:
+    sku: sku对象，需已设置images属性
+    goods: sku所属商品，需已设置channel属性
+    categories: 商品分类菜单
+    spec_matrix: 商品规格矩阵
+    temp: 模板对象，批量生成时可以复用
+    """
     # 获取当前商品的规格信息
     # specs = [
     #    {
@@ -59,32 +32,13 @@ def generate_static_sku_detail_html(sku_id):
     #            {'value': '15.4寸', 'sku_id': xxx},
     #        ]
     #    },
-    #    {
-    #        'name': '颜色',
-    #        'options': [
-    #            {'value': '银色', 'sku_id': xxx},
-    #            {'value': '黑色', 'sku_id': xxx}
-    #        ]
-    #    },
     #    ...
     # ]
-    specs = goods.goodsspecification_set.order_by('id')
+    specs = spec_matrix.get_sku_specs(sku.id)
     # 若当前sku的规格信息不完整，则不再继续
-    if len(sku_key) < len(specs):
+    if specs is None:
         return
 
-    for index, spec in enumerate(specs):
-        # 复制当前sku的规格键
-        key = sku_key[:]
-        # 该规格的选项
-        options = spec.specificationoption_set.all()
-        for option in options:
-            # 在规格参数sku字典中查找符合当前规格的sku
-            key[index] = option.id
-            option.sku_id = spec_sku_map.get(tuple(key))
-
-        spec.options = options
-
     # 使用模板`detail.html`，进行模板渲染，获取渲染之后的html页面内容
     context = {
         'categories': categories,
@@ -94,26 +48,193 @@ def generate_static_sku_detail_html(sku_id):
     }
 
     # 加载模板: 获取模板对象
-    from django.template import loader
-    temp = loader.get_template('detail.html')
+    if temp is None:
+        temp = loader.get_template('detail.html')
 
     # 模板渲染: 给模板文件传递数据，获取渲染之后html页面内容
     res_html = temp.render(context)
 
-    # 将渲染之后的html页面内容保存成一个静态文件
-    save_path = os.path.join(settings.GENERATED_STATIC_HTML_FILES_DIR, 'goods/%s.html' % sku_id)
+    # 将渲染之后的html页面内容保存成一个静态文件(内容未变化时不重写)
+    write_static_html('goods/%s.html' % sku.id, res_html)
 
-    with open(save_path, 'w') as f:
-        f.write(res_html)
 
+@celery_app.task(name='generate_static_sku_detail_html')
+def generate_static_sku_detail_html(sku_id):
+    """生成指定商品的静态详情页面"""
+    # 从数据库获取商品详情页所需数据
+    # 商品分类菜单
+    categories = get_categories()
+
+    # 获取当前sku的信息
+    sku = SKU.objects.get(id=sku_id)
+    sku.images = sku.skuimage_set.all()
+
+    # 面包屑导航信息中的频道
+    goods = sku.goods
+    goods.channel = goods.category1.goodschannel_set.all()[0]
 
+    # 批量加载当前商品的规格矩阵
+    spec_matrix = SpecMatrix(goods)
 
+    save_static_sku_detail_html(sku, goods, categories, spec_matrix)
 
 
+@celery_app.task(name='generate_static_goods_detail_html')
+def generate_static_goods_detail_html(goods_id):
+    """生成指定商品(SPU)下所有SKU的静态详情页面"""
+    # 同一商品下所有SKU共享的数据只查询一次
+    # 商品分类菜单
+    categories = get_categories()
 
+    # 面包屑导航信息中的频道
+    goods = Goods.objects.select_related('category1', 'category2', 'category3').get(id=goods_id)
+    goods.channel = goods.category1.goodschannel_set.all()[0]
 
+    # 批量加载当前商品的规格矩阵
+    spec_matrix = SpecMatrix(goods)
 
+    # 加载模板: 获取模板对象
+    temp = loader.get_template('detail.html')
 
+    # 获取当前商品的所有SKU及其图片
+    skus = goods.sku_set.prefetch_related('skuimage_set')
+
+    for sku in skus:
+        sku.images = sku.skuimage_set.all()
+        save_static_sku_detail_html(sku, goods, categories, spec_matrix, temp)
+
+
+# 待重新生成详情页面的商品(SPU)id集合
+PENDING_GOODS_KEY = 'static_html_pending_goods'
+# 待重新生成详情页面的sku id集合
+PENDING_SKUS_KEY = 'static_html_pending_skus'
+# 合并窗口内已安排flush任务的标记
+FLUSH_SCHEDULED_KEY = 'static_html_flush_scheduled'
+# 收到的重新生成请求数量计数
+REQUESTS_COUNTER_KEY = 'static_html_requests'
+# 实际进行的页面生成次数计数
+RENDERS_COUNTER_KEY = 'static_html_renders'
+# 生成失败的次数: hash {'goods_<goods_id>': '<次数>', 'sku_<sku_id>': '<次数>', ...}
+ATTEMPTS_KEY = 'static_html_attempts'
+# 每个商品或sku最多生成失败的次数，达到之后不再重新登记
+MAX_ATTEMPTS = 3
+
+
+def _request_static_detail_html(pending_key, *member_ids, retry=False):
+    """
+    登记重新生成详情页面的请求:
+    合并窗口内对同一商品或sku的重复请求只会在flush时生成一次
+    retry: 是否为生成失败之后的重试，重试不计入请求数量，也不清除失败次数
+    """
+    redis_conn = get_redis_connection('default')
+    window = settings.GENERATE_STATIC_HTML_COALESCE_WINDOW
+
+    pl = redis_conn.pipeline()
+    pl.sadd(pending_key, *member_ids)
+    # 若当前窗口内还未安排flush任务，则设置标记
+    pl.set(FLUSH_SCHEDULED_KEY, 1, ex=window, nx=True)
+    if not retry:
+        pl.incr(REQUESTS_COUNTER_KEY)
+        # 新的请求重新计算失败次数
+        prefix = 'goods_' if pending_key == PENDING_GOODS_KEY else 'sku_'
+        pl.hdel(ATTEMPTS_KEY, *[prefix + str(member_id) for member_id in member_ids])
+    scheduled = pl.execute()[1]
+
+    if scheduled:
+        # 窗口结束时统一生成
+        flush_static_detail_html.apply_async(countdown=window)
+
+
+def request_static_goods_detail_html(goods_id):
+    """请求重新生成指定商品(SPU)下所有SKU的静态详情页面"""
+    _request_static_detail_html(PENDING_GOODS_KEY, goods_id)
+
+
+def request_static_sku_detail_html(sku_id):
+    """请求重新生成指定sku的静态详情页面"""
+    _request_static_detail_html(PENDING_SKUS_KEY, sku_id)
+
+
+def get_static_html_counters():
+    """
+    获取详情页面重新生成的计数:
+    {
+        'requests': '<收到的请求数量>',
+        'renders': '<实际生成次数>'
+    }
+    """
+    redis_conn = get_redis_connection('default')
+    requests, renders = redis_conn.mget(REQUESTS_COUNTER_KEY, RENDERS_COUNTER_KEY)
 
+    return {
+        'requests': int(requests or 0),
+        'renders': int(renders or 0)
+    }
 
 
+@celery_app.task(name='flush_static_detail_html')
+def flush_static_detail_html():
+    """生成合并窗口内登记的所有详情页面"""
+    redis_conn = get_redis_connection('default')
+
+    # 原子地取出待生成的商品和sku，并清除flush标记，之后到达的请求会安排新的flush任务
+    pl = redis_conn.pipeline()
+    pl.delete(FLUSH_SCHEDULED_KEY)
+    pl.smembers(PENDING_GOODS_KEY)
+    pl.smembers(PENDING_SKUS_KEY)
+    pl.delete(PENDING_GOODS_KEY, PENDING_SKUS_KEY)
+    _, goods_ids, sku_ids = pl.execute()[:3]
+
+    goods_ids = {int(goods_id) for goods_id in goods_ids}
+    sku_ids = {int(sku_id) for sku_id in sku_ids}
+
+    # 所属商品已经整体重新生成的sku不再单独生成
+    if sku_ids and goods_ids:
+        sku_ids = set(SKU.objects.filter(id__in=sku_ids).exclude(goods_id__in=goods_ids).values_list('id', flat=True))
+
+    # 单个页面生成失败不影响其他页面
+    renders = _generate_pending(redis_conn, 'goods', PENDING_GOODS_KEY, goods_ids, Goods.DoesNotExist,
+                                generate_static_goods_detail_html)
+    renders += _generate_pending(redis_conn, 'sku', PENDING_SKUS_KEY, sku_ids, SKU.DoesNotExist,
+                                 generate_static_sku_detail_html)
+
+    if renders:
+        redis_conn.incrby(RENDERS_COUNTER_KEY, renders)
+
+
+def _generate_pending(redis_conn, name, pending_key, member_ids, does_not_exist, generate):
+    """
+    依次生成flush取出的商品或sku的详情页面，返回成功生成的数量:
+    已被删除的商品或sku直接忽略；其余失败的id重新登记，由之后的flush重试，失败MAX_ATTEMPTS次之后不再重试
+    """
+    renders = 0
+    failed_ids = []
+    for member_id in member_ids:
+        field = '%s_%s' % (name, member_id)
+        try:
+            generate(member_id)
+        except does_not_exist:
+            logger.warning('生成详情页面[已删除][ %s_id: %s ]' % (name, member_id))
+            redis_conn.hdel(ATTEMPTS_KEY, field)
+        except Exception as e:
+            if redis_conn.hincrby(ATTEMPTS_KEY, field, 1) >= MAX_ATTEMPTS:
+                logger.error('生成详情页面[失败][放弃][ %s_id: %s, message: %s ]' % (name, member_id, e))
+                redis_conn.hdel(ATTEMPTS_KEY, field)
+            else:
+                logger.error('生成详情页面[失败][ %s_id: %s, message: %s ]' % (name, member_id, e))
+                failed_ids.append(member_id)
+        else:
+            renders += 1
+            redis_conn.hdel(ATTEMPTS_KEY, field)
+
+    if failed_ids:
+        _request_static_detail_html(pending_key, *failed_ids, retry=True)
+
+    return renders
+
+
+@celery_app.task(name='generate_static_index_html')
+def generate_static_index_html():
+    """首页数据发生变化之后重新生成静态首页"""
+    from contents import crons
+    crons.generate_static_index_html()
@@ -0,0 +1,9 @@
+# 封装异步下单的任务函数
+from celery_tasks.main import celery_app
+
+
+@celery_app.task(name='place_order')
+def place_order(ticket, user_id, data):
+    """处理排队中的下单请求"""
+    from orders import tickets
+    tickets.process_order_ticket(ticket, user_id, data)
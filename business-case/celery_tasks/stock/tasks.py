@@ -0,0 +1,9 @@
+# 封装库存写回数据库的任务函数
+from celery_tasks.main import celery_app
+
+
+@celery_app.task(name='flush_sku_stocks')
+def flush_sku_stocks():
+    """将redis中预扣的商品库存和销量写回数据库"""
+    from goods import stock
+    stock.flush_sku_stocks()
@@ -5,6 +5,9 @@ import sys
 if __name__ == "__main__":
     # sys.path: 搜索包目录列表
     # print(sys.path)
+    # 运行测试时使用单独的redis数据库
+    if sys.argv[1:2] == ['test']:
+        os.environ.setdefault("DJANGO_SETTINGS_MODULE", "business-case.settings.test")
     os.environ.setdefault("DJANGO_SETTINGS_MODULE", "business-case.settings.dev")
     try:
         from django.core.management import execute_from_command_line